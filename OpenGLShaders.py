@@ -1,5 +1,29 @@
-vertex_shader_source = """
+# GLSL code shading the RGB image, shared by the fragment shaders below
+lighting_source = """
+                                uniform sampler2D Texture;
+                                uniform vec4 Color;
+                                uniform vec3 Light;
+
+                                vec4 shade(vec3 vert, vec3 norm, vec3 text) {
+                                        float lum = dot(normalize(norm), normalize(vert - Light));
+                                        lum = acos(lum) / 3.14159265;
+                                        lum = clamp(lum, 0.0, 1.0);
+                                        lum = lum * lum;
+                                        lum = smoothstep(0.0, 1.0, lum);
+
+                                        lum *= smoothstep(0.0, 80.0, vert.z) * 0.3 + 0.7;
+
+                                        lum = lum * 0.3 + 0.7;
+
+                                        vec3 color = texture(Texture, text.xy).rgb;
+                                        color = color * (1.0 - Color.a) + Color.rgb * Color.a;
+                                        return vec4(color * lum, 1.0);
+                                }
+                                """
+# Shaders writing the RGB image, the XYZ image, the linear depth and the normals into four color attachments in a single pass
+vertex_shader_RGBD_source = """#version 330
                         uniform mat4 Mvp;
+                        uniform mat4 Model;
 
                         in vec3 in_vert;
                         in vec3 in_norm;
@@ -10,59 +34,87 @@ vertex_shader_source = """
                         out vec3 v_text;
 
                         void main() {
-                                v_vert = in_vert;
-                                v_norm = in_norm;
+                                v_vert = (Model * vec4(in_vert, 1.0)).xyz;
+                                v_norm = mat3(Model) * in_norm;
                                 v_text = in_text;
                                 gl_Position = Mvp * vec4(v_vert, 1.0);
                         }
                         """
 
-fragment_shader_RGB_source = """uniform sampler2D Texture;
-                                uniform vec4 Color;
-                                uniform vec3 Light;
+fragment_shader_RGBD_source = "#version 330\n" + lighting_source + """
+                                in vec3 v_vert;
+                                in vec3 v_norm;
+                                in vec3 v_text;
+
+                                layout(location = 0) out vec4 f_color;
+                                layout(location = 1) out vec4 f_xyz;
+                                layout(location = 2) out float f_depth;
+                                layout(location = 3) out vec4 f_normal;
+
+                                void main() {
+                                        f_color = shade(v_vert, v_norm, v_text);
+
+                                        // the alpha channel flags the pixels covered by the mesh
+                                        f_xyz = vec4(v_vert, 1.0);
+                                        f_depth = v_vert.z;
+
+                                        // normals are oriented toward the camera located at the origin
+                                        vec3 normal = normalize(v_norm);
+                                        if (dot(normal, v_vert) > 0.0) normal = -normal;
+                                        f_normal = vec4(normal, 1.0);
+                                }"""
+# Shaders rendering a batch of poses with instancing, each instance is drawn into its own tile of a large framebuffer
+vertex_shader_batch_source = """#version 330
+                        uniform mat4 Mvp;
+                        uniform ivec2 Tiles;
+
+                        in vec3 in_vert;
+                        in vec3 in_norm;
+                        in vec3 in_text;
+                        in mat4 in_model;
+
+                        out vec3 v_vert;
+                        out vec3 v_norm;
+                        out vec3 v_text;
+                        flat out ivec2 v_tile;
+
+                        void main() {
+                                v_vert = (in_model * vec4(in_vert, 1.0)).xyz;
+                                v_norm = mat3(in_model) * in_norm;
+                                v_text = in_text;
+                                v_tile = ivec2(gl_InstanceID % Tiles.x, gl_InstanceID / Tiles.x);
+                                vec4 position = Mvp * vec4(v_vert, 1.0);
+                                // moving the image of the instance into its tile
+                                vec2 scale = 1.0 / vec2(Tiles);
+                                vec2 offset = (2.0 * vec2(v_tile) + 1.0) * scale - 1.0;
+                                position.xy = position.xy * scale + offset * position.w;
+                                gl_Position = position;
+                        }
+                        """
+
+fragment_shader_batch_source = "#version 330\n" + lighting_source + """
+                                uniform ivec2 TileSize;
 
                                 in vec3 v_vert;
                                 in vec3 v_norm;
                                 in vec3 v_text;
+                                flat in ivec2 v_tile;
 
-                                out vec4 f_color;
+                                layout(location = 0) out vec4 f_color;
+                                layout(location = 1) out vec4 f_xyz;
+                                layout(location = 2) out float f_depth;
+                                layout(location = 3) out vec4 f_normal;
 
                                 void main() {
-                                        float lum = dot(normalize(v_norm), normalize(v_vert - Light));
-                                        lum = acos(lum) / 3.14159265;
-                                        lum = clamp(lum, 0.0, 1.0);
-                                        lum = lum * lum;
-                                        lum = smoothstep(0.0, 1.0, lum);
+                                        // triangles crossing the border of the camera frustum would otherwise spill into the neighbouring tiles
+                                        if (ivec2(gl_FragCoord.xy) / TileSize != v_tile) discard;
 
-                                        lum *= smoothstep(0.0, 80.0, v_vert.z) * 0.3 + 0.7;
+                                        f_color = shade(v_vert, v_norm, v_text);
 
-                                        lum = lum * 0.3 + 0.7;
+                                        f_xyz = vec4(v_vert, 1.0);
+                                        f_depth = v_vert.z;
 
-                                        vec3 color = texture(Texture, v_text.xy).rgb;
-                                        color = color * (1.0 - Color.a) + Color.rgb * Color.a;
-                                        f_color = vec4(color * lum, 1.0);
-                                }"""
-fragment_shader_XYZ_source="""
-                            in vec3 v_vert;
-                            in vec3 v_norm;
-                            in vec3 v_text;
-                            uniform vec3 boxmin;
-                            uniform vec3 boxmax;
-                            out vec4 f_color;
-
-                            void main() {
-                                    f_color=vec4((v_vert-boxmin)/(boxmax-boxmin), 1);
-
-                            }"""
-fragment_shader_Depth_source="""
-                            in vec3 v_vert;
-                            in vec3 v_norm;
-                            in vec3 v_text;
-                            uniform vec3 boxmin;
-                            uniform vec3 boxmax;
-                            out vec4 f_color;
-
-                            void main() {
-                                    f_color=vec4((v_vert-boxmin)/(boxmax-boxmin), 1);
-
-                            }"""
\ No newline at end of file
+                                        vec3 normal = normalize(v_norm);
+                                        if (dot(normal, v_vert) > 0.0) normal = -normal;
+                                        f_normal = vec4(normal, 1.0);
+                                }"""
\ No newline at end of file
@@ -29,8 +29,10 @@
 # of the authors and should not be interpreted as representing official policies,
 # either expressed or implied, of the FreeBSD Project.
 
-import ModernGL
-from ModernGL.ext.obj import Obj
+try:
+    import ModernGL
+except ImportError:
+    ModernGL=None # the frames can still be rendered with the software backend
 from PIL import Image
 from pyrr import Matrix44
 from mpl_toolkits.mplot3d import Axes3D
@@ -39,169 +41,450 @@ import numpy as np
 import subprocess
 import os
 import pointCloudIO
+import RGBDSequenceIO
+import pointCloudProcessing
 import OpenGLShaders
-from scipy.misc import imsave
+import softwareRenderer
+import rayCaster
 import copy
 import imageio
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 
-def generateRGBD(vertex_data,texture_image,modelTransform,imageSize,focal_length,light,idFrame):
-    """This function generqtes two numpy arrays, continaining respectively the RGB image and the 3D point cloud scene from the camera"""
-    vertex_dataCopy=copy.copy(vertex_data)
-    objPoints=np.array(vertex_dataCopy.vert)
+class RGBDRenderer():
+    """This class keeps the OpenGL context, the shader program, the mesh vertex buffer, the texture and the framebuffer
+    alive between frames so that only the model transform has to be updated to render a new pose.
+    The RGB image, the XYZ image, the linear depth and the normals are obtained from a single draw call
+    using a framebuffer with four color attachments"""
 
-    # Context creation
-    ctx = ModernGL.create_standalone_context()
-    
-    # Shaders
-    progRGB = ctx.program(vertex_shader=OpenGLShaders.vertex_shader_source, fragment_shader=OpenGLShaders.fragment_shader_RGB_source)
-    progXYZ = ctx.program(vertex_shader=OpenGLShaders.vertex_shader_source, fragment_shader=OpenGLShaders.fragment_shader_XYZ_source)
-    progDepth= ctx.program(vertex_shader=OpenGLShaders.vertex_shader_source, fragment_shader=OpenGLShaders.fragment_shader_Depth_source)
-    
-    # Setting up camera
-    fov= 2 * np.arctan (imageSize/(focal_length * 2))*180/np.pi
-    perspective = Matrix44.perspective_projection(fov, 1.0, 0.1, 1000.0)
-    lookat = Matrix44.look_at( (0, 0, 0), (0.0, 0.0, 1), (0.0, 1.0, 0))
-    mvp = perspective * lookat
-    
-    #
-    progRGB['Light'].value = light
-    progRGB['Color'].value = (1.0, 1.0, 1.0, 0.25)
-    progRGB['Mvp'].write(mvp.astype('float32').tobytes())
-    progXYZ['Mvp'].write(mvp.astype('float32').tobytes())
- 
-    
-    # Texture   
-    texture = ctx.texture(texture_image.size, len(texture_image.split()), texture_image.transpose(Image.FLIP_TOP_BOTTOM).tobytes())
-    texture.build_mipmaps()
-    
-    # moving the mesh using the modelTransform
-   
-    originalVertices=np.array(vertex_dataCopy.vert)
-    newVertices=originalVertices.dot(modelTransform[:3,:3].T)+modelTransform[:3,3][None,:]
-    
-    # compputing the box around the displaced mesh to get maximum accuracy of the xyz point cloud using unit8 opengl type
-    boxmin=np.min(newVertices,axis=0)
-    boxmax=np.max(newVertices,axis=0)
-    progXYZ['boxmin'].value=tuple(boxmin)
-    progXYZ['boxmax'].value=tuple(boxmax)
-    vertex_dataCopy.vert=newVertices
-        
-    vbo = ctx.buffer(vertex_dataCopy.pack())
-    vao = ctx.simple_vertex_array(progRGB, vbo, *['in_vert', 'in_text', 'in_norm'])
-    vaoXYZ = ctx.simple_vertex_array(progXYZ, vbo, *['in_vert', 'in_text', 'in_norm'])
-    
-    # Framebuffers
-    fbo = ctx.framebuffer(
-        ctx.renderbuffer((imageSize, imageSize)),
-        ctx.depth_renderbuffer((imageSize, imageSize)),
-    )   
-    fboXYZ = ctx.framebuffer(     
-        ctx.renderbuffer((imageSize, imageSize)),
-        ctx.depth_renderbuffer((imageSize, imageSize)),
-    )
-    
-    # Rendering the RGB image
-    fbo.use()
-    ctx.enable(ModernGL.DEPTH_TEST)
-    ctx.clear(0.9, 0.9, 0.9)
-    texture.use()
-    vao.render()    
-    data = fbo.read(components=3, alignment=1)
-    img = Image.frombytes('RGB', fbo.size, data, 'raw', 'RGB', 0, -1)
-    array_rgb=np.array(img);
-    
-    # Rendering the XYZ image using OpenGL , limited to 8bit precision for now so we rescale using a bounding 3D box
-    fboXYZ.use()
-    ctx.enable(ModernGL.DEPTH_TEST)
-    ctx.clear(0, 0, 0)
-    texture.use()
-    vaoXYZ.render()
-    data = fboXYZ.read(components=3, alignment=1)
-    img = Image.frombytes('RGB', fboXYZ.size, data, 'raw', 'RGB', 0, -1)
-    img=np.array(img)
-    keep=(img[:,:,0]!=0)|(img[:,:,1]!=0)|(img[:,:,2]!=0)
-    array_xyz=np.array(img).astype(np.float32)*((boxmax-boxmin)/255)[None,None,:]+boxmin[None,None,:]; 
-    
-    # seting background pixels to nan
-    array_xyz[~np.tile(keep[:,:,None],[1,1,3])]=np.nan
-    
+    def __init__(self,vertex_data,texture_image,imageSize,focal_length,light,batchSize=64):
+
+        if ModernGL is None:
+            raise ImportError('ModernGL is not installed, use the software render backend instead')
+        self.imageSize=imageSize
+        self.focal_length=focal_length
+        self.light=light
+        self.batchSize=batchSize
+
+        # Context creation
+        self.ctx = ModernGL.create_standalone_context()
+        ctx=self.ctx
+
+        # Shaders
+        self.prog = ctx.program(vertex_shader=OpenGLShaders.vertex_shader_RGBD_source, fragment_shader=OpenGLShaders.fragment_shader_RGBD_source)
+
+        # Setting up camera
+        fov= 2 * np.arctan (imageSize/(focal_length * 2))*180/np.pi
+        perspective = Matrix44.perspective_projection(fov, 1.0, 0.1, 1000.0)
+        lookat = Matrix44.look_at( (0, 0, 0), (0.0, 0.0, 1), (0.0, 1.0, 0))
+        mvp = perspective * lookat
+        self.mvp=mvp
+
+        #
+        self.prog['Light'].value = light
+        self.prog['Color'].value = (1.0, 1.0, 1.0, 0.25)
+        self.prog['Mvp'].write(mvp.astype('float32').tobytes())
+
+        # Texture
+        self.texture = ctx.texture(texture_image.size, len(texture_image.split()), texture_image.transpose(Image.FLIP_TOP_BOTTOM).tobytes())
+        self.texture.build_mipmaps()
+
+        # the mesh is uploaded once, it is then moved using the Model uniform. vertex_data is either the interleaved
+        # float32 array given by pointCloudIO.interleaveOBJ or an object with a pack() method such as ModernGL.ext.obj.Obj
+        if hasattr(vertex_data,'pack'):
+            self.vbo = ctx.buffer(vertex_data.pack())
+        else:
+            self.vbo = ctx.buffer(np.ascontiguousarray(vertex_data,dtype=np.float32).tobytes())
+        self.vao = ctx.simple_vertex_array(self.prog, self.vbo, *['in_vert', 'in_text', 'in_norm'])
+
+        # Framebuffer with the RGB, XYZ, depth and normals attachments, the last three use float32 to avoid any quantization
+        self.renderbuffers=[
+            ctx.renderbuffer((imageSize, imageSize)),
+            ctx.renderbuffer((imageSize, imageSize), components=4, dtype='f4'),
+            ctx.renderbuffer((imageSize, imageSize), components=1, dtype='f4'),
+            ctx.renderbuffer((imageSize, imageSize), components=4, dtype='f4'),
+        ]
+        self.depthbuffer=ctx.depth_renderbuffer((imageSize, imageSize))
+        self.fbo = ctx.framebuffer(self.renderbuffers,self.depthbuffer)
+
+        # buffers the framebuffer attachments are read into, allocated once
+        self.bufferRGB=np.empty((imageSize,imageSize,3),dtype=np.uint8)
+        self.bufferXYZ=np.empty((imageSize,imageSize,4),dtype=np.float32)
+        self.bufferDepth=np.empty((imageSize,imageSize),dtype=np.float32)
+        self.bufferNormals=np.empty((imageSize,imageSize,4),dtype=np.float32)
+
+        # the batch rendering objects are only created when needed
+        self.progBatch=None
+
+    def setModelTransform(self,modelTransform):
+        """moves the mesh using the 4x4 modelTransform, OpenGL expects column major matrices"""
+        self.prog['Model'].write(np.ascontiguousarray(np.array(modelTransform).T,dtype=np.float32).tobytes())
+
+    def renderMaps(self,modelTransform):
+        """returns the RGB image, the XYZ image, the linear depth (distance along the optical axis) and the normals
+        oriented toward the camera, all obtained from a single rasterization pass. Background pixels are nan in the last three"""
+        ctx=self.ctx
+        self.setModelTransform(modelTransform)
+
+        # the clear color gives the gray background of the RGB image, a zero alpha flags the background in the other attachments
+        self.fbo.use()
+        ctx.enable(ModernGL.DEPTH_TEST)
+        ctx.clear(0.9, 0.9, 0.9, 0.0)
+        self.texture.use()
+        self.vao.render()
+        self.fbo.read_into(self.bufferRGB, components=3, alignment=1, attachment=0)
+        self.fbo.read_into(self.bufferXYZ, components=4, alignment=1, attachment=1, dtype='f4')
+        self.fbo.read_into(self.bufferDepth, components=1, alignment=1, attachment=2, dtype='f4')
+        self.fbo.read_into(self.bufferNormals, components=4, alignment=1, attachment=3, dtype='f4')
+
+        # OpenGL images are stored bottom-up
+        array_rgb=self.bufferRGB[::-1].copy()
+        array_xyz=self.bufferXYZ[::-1,:,:3].copy()
+        array_depth=self.bufferDepth[::-1].copy()
+        array_normals=self.bufferNormals[::-1,:,:3].copy()
+
+        # seting background pixels to nan
+        background=self.bufferXYZ[::-1,:,3]==0
+        array_xyz[background]=np.nan
+        array_depth[background]=np.nan
+        array_normals[background]=np.nan
+
+        return array_rgb,array_xyz,array_depth,array_normals
+
+    def render(self,modelTransform):
+        """returns two numpy arrays, containing respectively the RGB image and the 3D point cloud scene from the camera"""
+        array_rgb,array_xyz,array_depth,array_normals=self.renderMaps(modelTransform)
+        return array_rgb,array_xyz
+
+    def renderDepth(self,modelTransform):
+        """returns the linear depth map (distance along the optical axis), with nan on the background"""
+        return self.renderMaps(modelTransform)[2]
+
+    def initBatchRendering(self):
+        """creates the instanced shader program and a framebuffer tiled with batchSize images of size imageSize"""
+        ctx=self.ctx
+        imageSize=self.imageSize
+        maxSize=min(ctx.info['GL_MAX_RENDERBUFFER_SIZE'],*ctx.info['GL_MAX_VIEWPORT_DIMS'])
+        maxTilesPerSide=max(maxSize//imageSize,1)
+        self.batchSize=min(self.batchSize,maxTilesPerSide**2)
+        nbTilesX=min(int(np.ceil(np.sqrt(self.batchSize))),maxTilesPerSide)
+        nbTilesY=int(np.ceil(self.batchSize/float(nbTilesX)))
+        self.tiles=(nbTilesX,nbTilesY)
+
+        self.progBatch = ctx.program(vertex_shader=OpenGLShaders.vertex_shader_batch_source, fragment_shader=OpenGLShaders.fragment_shader_batch_source)
+        self.progBatch['Light'].value = self.light
+        self.progBatch['Color'].value = (1.0, 1.0, 1.0, 0.25)
+        self.progBatch['Mvp'].write(self.mvp.astype('float32').tobytes())
+        self.progBatch['Tiles'].value = self.tiles
+        self.progBatch['TileSize'].value = (imageSize,imageSize)
+
+        # one 4x4 float32 model transform per instance
+        self.instancesBuffer = ctx.buffer(reserve=self.batchSize*64)
+        self.vaoBatch = ctx.vertex_array(self.progBatch, [(self.vbo, '3f 3f 3f', 'in_vert', 'in_text', 'in_norm'),(self.instancesBuffer, '16f/i', 'in_model')])
+
+        size=(nbTilesX*imageSize,nbTilesY*imageSize)
+        self.renderbuffersBatch=[
+            ctx.renderbuffer(size),
+            ctx.renderbuffer(size, components=4, dtype='f4'),
+            ctx.renderbuffer(size, components=1, dtype='f4'),
+            ctx.renderbuffer(size, components=4, dtype='f4'),
+        ]
+        self.depthbufferBatch=ctx.depth_renderbuffer(size)
+        self.fboBatch = ctx.framebuffer(self.renderbuffersBatch,self.depthbufferBatch)
+
+        self.bufferBatchRGB=np.empty((size[1],size[0],3),dtype=np.uint8)
+        self.bufferBatchXYZ=np.empty((size[1],size[0],4),dtype=np.float32)
+        self.bufferBatchDepth=np.empty((size[1],size[0],1),dtype=np.float32)
+        self.bufferBatchNormals=np.empty((size[1],size[0],4),dtype=np.float32)
+
+    def splitTiles(self,buffer,nbImages):
+        """converts the tiled framebuffer content into a (nbImages,imageSize,imageSize,channels) array with top-down images"""
+        nbTilesX,nbTilesY=self.tiles
+        imageSize=self.imageSize
+        tiles=buffer.reshape(nbTilesY,imageSize,nbTilesX,imageSize,-1).transpose(0,2,1,3,4)
+        images=np.empty((nbTilesY,nbTilesX,imageSize,imageSize,buffer.shape[2]),dtype=buffer.dtype)
+        images[...]=tiles[:,:,::-1]
+        return images.reshape(nbTilesX*nbTilesY,imageSize,imageSize,-1)[:nbImages]
+
+    def renderMapsBatch(self,modelTransforms):
+        """renders the mesh in each of the poses given by the (N,4,4) array modelTransforms using a single instanced
+        draw call per batch of batchSize poses and returns (N,H,W,3) RGB and XYZ arrays, the (N,H,W) depths and (N,H,W,3) normals"""
+        modelTransforms=np.asarray(modelTransforms).reshape(-1,4,4)
+        results=[np.concatenate(maps) for maps in zip(*[chunk for start,chunk in self.iterateBatches(modelTransforms)])]
+        return tuple(results)
+
+    def renderBatch(self,modelTransforms):
+        """renders the mesh in each of the poses given by the (N,4,4) array modelTransforms and returns
+        (N,H,W,3) RGB and XYZ arrays"""
+        array_rgb,array_xyz,array_depth,array_normals=self.renderMapsBatch(modelTransforms)
+        return array_rgb,array_xyz
+
+    def iterateBatches(self,modelTransforms):
+        """generator rendering the poses by chunks of batchSize, yields the index of the first pose of the chunk
+        and the tuple of maps returned by renderMapsBatch for this chunk, this allows to write them out without
+        keeping the whole sequence in memory"""
+        if self.progBatch is None:
+            self.initBatchRendering()
+        ctx=self.ctx
+        modelTransforms=np.asarray(modelTransforms).reshape(-1,4,4)
+        for start in range(0,len(modelTransforms),self.batchSize):
+            chunk=modelTransforms[start:start+self.batchSize]
+            # OpenGL expects column major matrices
+            self.instancesBuffer.write(np.ascontiguousarray(chunk.transpose(0,2,1),dtype=np.float32).tobytes())
+
+            self.fboBatch.use()
+            ctx.enable(ModernGL.DEPTH_TEST)
+            ctx.clear(0.9, 0.9, 0.9, 0.0)
+            self.texture.use()
+            self.vaoBatch.render(instances=len(chunk))
+            self.fboBatch.read_into(self.bufferBatchRGB, components=3, alignment=1, attachment=0)
+            self.fboBatch.read_into(self.bufferBatchXYZ, components=4, alignment=1, attachment=1, dtype='f4')
+            self.fboBatch.read_into(self.bufferBatchDepth, components=1, alignment=1, attachment=2, dtype='f4')
+            self.fboBatch.read_into(self.bufferBatchNormals, components=4, alignment=1, attachment=3, dtype='f4')
+
+            array_rgb=self.splitTiles(self.bufferBatchRGB,len(chunk))
+            xyzw=self.splitTiles(self.bufferBatchXYZ,len(chunk))
+            array_xyz=xyzw[...,:3]
+            array_depth=self.splitTiles(self.bufferBatchDepth,len(chunk))[...,0]
+            array_normals=self.splitTiles(self.bufferBatchNormals,len(chunk))[...,:3]
+
+            # seting background pixels to nan
+            background=xyzw[...,3]==0
+            array_xyz[background]=np.nan
+            array_depth[background]=np.nan
+            array_normals[background]=np.nan
+
+            yield start,(array_rgb,array_xyz,array_depth,array_normals)
+
+    def release(self):
+        """frees the OpenGL objects and the context"""
+        for obj in [self.vao,self.vbo,self.texture,self.fbo,self.depthbuffer]+self.renderbuffers+[self.prog]:
+            obj.release()
+        if self.progBatch is not None:
+            for obj in [self.vaoBatch,self.instancesBuffer,self.fboBatch,self.depthbufferBatch]+self.renderbuffersBatch+[self.progBatch]:
+                obj.release()
+        self.ctx.release()
+
+def createRenderer(vertex_data,texture_image,imageSize,focal_length,light,batchSize=64,backend='opengl'):
+    """creates the renderer of the given backend, 'opengl' for a RGBDRenderer, 'software' for a
+    softwareRenderer.SoftwareRenderer that rasterizes the frames with numpy on a pool of processes without OpenGL
+    or 'raycast' for a rayCaster.RayCaster that intersects the camera rays with a bounding volume hierarchy of the
+    mesh built once per mesh. They all have the same methods and return the same maps"""
+    if backend=='opengl':
+        return RGBDRenderer(vertex_data,texture_image,imageSize,focal_length,light,batchSize)
+    if backend=='software':
+        return softwareRenderer.SoftwareRenderer(vertex_data,texture_image,imageSize,focal_length,light,batchSize)
+    if backend=='raycast':
+        return rayCaster.RayCaster(vertex_data,texture_image,imageSize,focal_length,light,batchSize)
+    raise ValueError('unknown render backend %s'%backend)
+
+def generateRGBD(vertex_data,texture_image,modelTransform,imageSize,focal_length,light,idFrame,backend='opengl'):
+    """This function generqtes two numpy arrays, continaining respectively the RGB image and the 3D point cloud scene from the camera.
+    It creates a new renderer for each call, use createRenderer to render several frames of the same mesh"""
+    renderer=createRenderer(vertex_data,texture_image,imageSize,focal_length,light,backend=backend)
+    array_rgb,array_xyz=renderer.render(modelTransform)
+    renderer.release()
     return array_rgb,array_xyz
 
-def convertToPointCLoud(array_rgb,array_xyz,subsamplingStep):
-   
-    keep=~np.isnan(array_xyz[:,:,0])
-    colors=array_rgb[::subsamplingStep,::subsamplingStep,:].reshape(-1,3)/255.0
-    X=array_xyz[::subsamplingStep,::subsamplingStep,0].flatten()
-    Y=array_xyz[::subsamplingStep,::subsamplingStep,1].flatten()
-    Z=array_xyz[::subsamplingStep,::subsamplingStep,2].flatten()
-    keepSubsampled=keep[::subsamplingStep,::subsamplingStep].flatten()
-    #colors[:,2]=np.random.rand(colors.shape[0])
-    useMatPlotLib=True
-    scenePointCloud=np.column_stack((X[keepSubsampled], Y[keepSubsampled], Z[keepSubsampled])).astype(np.float32)
-    scenePointCloudColors=colors[keepSubsampled]
-    return scenePointCloud,scenePointCloudColors
-    
-def generateSequence(objFile,texture_image,sequenceFolder):
+def convertToPointCLoud(array_rgb,array_xyz,subsamplingStep,averaging=False):
+    """point cloud of the object pixels keeping one pixel out of subsamplingStep in each direction, or averaging the
+    object pixels of each block of subsamplingStep x subsamplingStep pixels if averaging is True, which reduces the noise"""
+    return pointCloudProcessing.organizedPointCloud(array_rgb,array_xyz,subsamplingStep,averaging)
     
-    if not os.path.exists(sequenceFolder):
-        os.mkdir(sequenceFolder)
-    vertex_data = Obj.open(objFile)
-    
-    nbFrames=50
-    center=np.mean(np.array(vertex_data.vert),axis=0)
-    angles=np.array([[-0.3,0.4,-0.4],[-0.3,-0.4,0.4],[-0.3,-0.4,0],[-0.3,0.4,-0.4]])
-    anglesInterpolated=np.column_stack([np.interp(np.linspace(0, len(angles)-1,nbFrames), np.arange(len(angles)), angles[:,i]) for i in range(3)])
-    translations=np.array([[0,0,3]-center,[0,0.3,3]-center,[0,-0.2,3]-center,[0,0,3]-center])
-    translationsInterpolated=np.column_stack([np.interp(np.linspace(0, len(translations)-1,nbFrames), np.arange(len(angles)), translations[:,i]) for i in range(3)])
-    light=(-140.0, -300.0, 350.0)
-    subsamplingStep=1
-    imageSize=300
-    focal_length=400    
-    imagesRGB = []
-    imagesDepth=[]
-    pcdFileNames=[]
-    maxDepthIntensity=0
-	
-    for idFrame in range(nbFrames):
-        
-        modelTransform=np.array(Matrix44.from_eulers(anglesInterpolated[idFrame]))
-        modelTransform[:3,3]=translationsInterpolated[idFrame]  
-        array_rgb,array_xyz=generateRGBD(vertex_data,texture_image,modelTransform,imageSize,focal_length,light,idFrame)
-        imagesRGB.append(array_rgb)
-        
+def depthPreview(array_depth):
+    """converts a depth map into a [0,1] image where closer points are brighter and the background is black"""
+    tmp=(1-array_depth/np.nanmax(array_depth))
+    tmp[np.isnan(tmp)]=0
+    return tmp
+
+def writeFrame(sequenceFolder,idFrame,array_rgb,array_depth,array_xyz,array_normals,outputFormats,subsamplingStep,pcdFormat='binary'):
+    """writes the files of a frame in the requested formats among 'rgb', 'depth', 'pcd' and 'ptx'
+    pcdFormat is one of the data formats supported by pointCloudIO.savePCD"""
+    if 'rgb' in outputFormats:
         rgbImageName=os.path.join(sequenceFolder,'rgb%03.0d.png'%idFrame)
-        imsave(rgbImageName, array_rgb)
+        imageio.imwrite(rgbImageName, array_rgb)
+    if 'depth' in outputFormats:
         depthImageName=os.path.join(sequenceFolder,'depth%03.0d.png'%idFrame)
-        tmp=(1-array_xyz[:,:,2]/np.nanmax(array_xyz[:,:,2]))
-        tmp[np.isnan(tmp)]=0
-        imsave(depthImageName,np.tile(tmp[:,:,None],[1,1,3]))        
-        imagesDepth.append(tmp)
-        maxDepthIntensity=max(maxDepthIntensity, np.max(imagesDepth))
+        tmp=depthPreview(array_depth)
+        # stretched to the full intensity range as scipy.misc.imsave did, the background is black
+        tmp=np.round(255*tmp/max(np.max(tmp),1e-12)).astype(np.uint8)
+        imageio.imwrite(depthImageName,np.tile(tmp[:,:,None],[1,1,3]))
+    if ('pcd' in outputFormats) or ('ptx' in outputFormats):
         scenePointCloud,scenePointCloudColors=convertToPointCLoud(array_rgb,array_xyz,subsamplingStep)
+    if 'pcd' in outputFormats:
+        # the rendered normals are saved along the points so that they do not need to be estimated by the tracker
+        sceneNormals=array_normals[::subsamplingStep,::subsamplingStep].reshape(-1,3)
+        sceneNormals=sceneNormals[~np.isnan(sceneNormals[:,0])].astype(np.float32)
+        normalsData=dict([('normal_x',sceneNormals[None,:,0]),('normal_y',sceneNormals[None,:,1]),('normal_z',sceneNormals[None,:,2])])
         pcdFileName=os.path.join(sequenceFolder,'pointCLoud%03.0d.pcd'%idFrame)
-        pcdFileRelativePath='pointCLoud%03.0d.pcd'%idFrame
-        pcdFileNames.append(pcdFileRelativePath)
-        pointCloudIO.savePCD(pcdFileName, None, scenePointCloud.reshape(1,-1,3), 255*scenePointCloudColors.reshape(1,-1,3),format='binary')
+        pointCloudIO.savePCD(pcdFileName, None, scenePointCloud.reshape(1,-1,3), 255*scenePointCloudColors.reshape(1,-1,3),data=normalsData,format=pcdFormat)
+    if 'ptx' in outputFormats:
         ptxFileName=os.path.join(sequenceFolder,'pointCLoud%03.0d.ptx'%idFrame)
-        print('Saving %s'%ptxFileName);
         pointCloudIO.savePTX(ptxFileName,  scenePointCloud.reshape(1,-1,3), 255*scenePointCloudColors.reshape(1,-1,3))
+    print('Saved frame %d'%idFrame)
+
+class FrameWriter():
+    """Writes the frames on a pool of workers behind a bounded queue, so that rendering the next frames overlaps
+    with the encoding and writing of the previous ones. At most maxPending frames wait in the queue, write blocks
+    when it is full. Processes are used by default as the text formats are mostly formatted while holding the GIL"""
+
+    def __init__(self,sequenceFolder,outputFormats,subsamplingStep=1,nbWorkers=4,maxPending=8,useProcesses=True,pcdFormat='binary'):
+        self.sequenceFolder=sequenceFolder
+        self.outputFormats=outputFormats
+        self.subsamplingStep=subsamplingStep
+        self.pcdFormat=pcdFormat
+        if useProcesses:
+            self.executor=ProcessPoolExecutor(nbWorkers)
+        else:
+            self.executor=ThreadPoolExecutor(nbWorkers)
+        self.slots=threading.BoundedSemaphore(maxPending)
+        self.pending=collections.deque()
+
+    def checkErrors(self,block=False):
+        """raises the exception of the first failed write among the finished ones"""
+        while self.pending and (block or self.pending[0].done()):
+            self.pending.popleft().result()
+
+    def write(self,idFrame,array_rgb,array_depth,array_xyz,array_normals):
+        self.checkErrors()
+        self.slots.acquire()
+        future=self.executor.submit(writeFrame,self.sequenceFolder,idFrame,array_rgb,array_depth,array_xyz,array_normals,self.outputFormats,self.subsamplingStep,self.pcdFormat)
+        future.add_done_callback(lambda future:self.slots.release())
+        self.pending.append(future)
 
-    imageio.mimsave(os.path.join(sequenceFolder,'rgbd_sequence.gif'), [np.column_stack((im[0],(255*np.tile(im[1][:,:,None],[1,1,3])/maxDepthIntensity).astype(np.uint8))) for im in zip(imagesRGB,imagesDepth)]) 
+    def close(self):
+        """waits for all the frames to be written"""
+        try:
+            self.checkErrors(block=True)
+        finally:
+            self.executor.shutdown()
+
+class PreviewWriter():
+    """Appends the RGB image and the depth preview side by side to an animated gif as the frames arrive, so that
+    the memory used does not grow with the number of frames. The depth previews are divided by maxDepthIntensity
+    if it is provided, otherwise by the running maximum of the previews seen so far"""
+
+    def __init__(self,fileName,maxDepthIntensity=None):
+        self.writer=imageio.get_writer(fileName, format='GIF-PIL', mode='I')
+        self.runningMaximum=maxDepthIntensity is None
+        self.maxDepthIntensity=0 if maxDepthIntensity is None else maxDepthIntensity
+
+    def append(self,array_rgb,array_depth):
+        tmp=depthPreview(array_depth)
+        if self.runningMaximum:
+            self.maxDepthIntensity=max(self.maxDepthIntensity, np.max(tmp))
+        scale=255/self.maxDepthIntensity if self.maxDepthIntensity>0 else 0
+        depthImage=np.clip(tmp*scale,0,255).astype(np.uint8)
+        self.writer.append_data(np.column_stack((array_rgb,np.tile(depthImage[:,:,None],[1,1,3]))))
+
+    def close(self):
+        self.writer.close()
+
+# camera and light of the test sequences
+sequenceLight=(-140.0, -300.0, 350.0)
+sequenceImageSize=300
+sequenceFocalLength=400
+
+def sequenceFocalLengthAt(imageSize):
+    """focal length of the camera of the test sequences rendering images of size imageSize with the same field of view"""
+    return sequenceFocalLength*imageSize/float(sequenceImageSize)
+
+def sequencePoses(center,nbFrames):
+    """model to camera transforms of the test sequences, interpolated between a few key poses of the model whose center is given"""
+    angles=np.array([[-0.3,0.4,-0.4],[-0.3,-0.4,0.4],[-0.3,-0.4,0],[-0.3,0.4,-0.4]])
+    anglesInterpolated=np.column_stack([np.interp(np.linspace(0, len(angles)-1,nbFrames), np.arange(len(angles)), angles[:,i]) for i in range(3)])
+    translations=np.array([[0,0,3]-center,[0,0.3,3]-center,[0,-0.2,3]-center,[0,0,3]-center])
+    translationsInterpolated=np.column_stack([np.interp(np.linspace(0, len(translations)-1,nbFrames), np.arange(len(angles)), translations[:,i]) for i in range(3)])
+    modelTransforms=np.empty((nbFrames,4,4))
+    for idFrame in range(nbFrames):
+        modelTransforms[idFrame]=np.array(Matrix44.from_eulers(anglesInterpolated[idFrame]))
+        modelTransforms[idFrame,:3,3]=translationsInterpolated[idFrame]
+    return modelTransforms
+
+def iterateSequenceMaps(objFile,texture_image,nbFrames=50,batchSize=64,backend='opengl',sensor=None,imageSize=sequenceImageSize):
+    """generator rendering the frames of the test sequence of the model by batches of batchSize poses, yields
+    (idFrame,array_rgb,array_xyz,array_depth,array_normals,modelTransform) for each frame. Only one batch is kept
+    in memory, the renderer of the backend (see createRenderer) is created in the thread that starts the iteration
+    and released when it ends. If sensor is a dictionary, the artifacts of a depth sensor are added to the XYZ images
+    by rayCaster.simulateDepthSensor called with these keyword arguments and a random generator seeded with the
+    index of the frame, so that the sequence does not depend on the batch size. imageSize changes the resolution of
+    the images keeping the field of view of the camera"""
+    vertices,texcoords,normals,faces=pointCloudIO.loadOBJ(objFile)
+    vertex_data=pointCloudIO.interleaveOBJ(vertices,texcoords,normals,faces)
+    modelTransforms=sequencePoses(np.mean(vertices,axis=0),nbFrames)
+    focal_length=sequenceFocalLengthAt(imageSize)
+    renderer=createRenderer(vertex_data,texture_image,imageSize,focal_length,sequenceLight,batchSize,backend)
+    try:
+        for start,maps in renderer.iterateBatches(modelTransforms):
+            for idInBatch,(array_rgb,array_xyz,array_depth,array_normals) in enumerate(zip(*maps)):
+                idFrame=start+idInBatch
+                if sensor is not None:
+                    array_xyz,array_depth,array_normals=rayCaster.simulateDepthSensor(array_xyz,array_normals,focal_length,np.random.default_rng(idFrame),**sensor)
+                yield idFrame,array_rgb,array_xyz,array_depth,array_normals,modelTransforms[idFrame]
+    finally:
+        renderer.release()
+
+def iterateSequence(objFile,texture_image,nbFrames=50,batchSize=8,backend='opengl',sensor=None,imageSize=sequenceImageSize):
+    """generator yielding (array_rgb,array_xyz,modelTransform) for each frame of the test sequence without writing
+    anything to disk, the model transform being the ground truth pose. It can be chained with the stages of
+    framePipeline and given to surfaceAlign.trackFrames"""
+    for idFrame,array_rgb,array_xyz,array_depth,array_normals,modelTransform in iterateSequenceMaps(objFile,texture_image,nbFrames,batchSize,backend,sensor,imageSize):
+        yield array_rgb,array_xyz,modelTransform
+
+def generateSequence(objFile,texture_image,sequenceFolder,nbFrames=50,batchSize=64,outputFormats=('rgb','depth','pcd','ptx','gif'),nbWorkers=4,useProcesses=True,gifMaxDepthIntensity=None,pcdFormat='binary',backend='opengl',sensor=None,imageSize=sequenceImageSize):
+    """renders the test sequence of the model and writes its frames in sequenceFolder in the outputFormats, the ground
+    truth poses (model to camera transforms) are always saved in groundTruthPoses.txt with pointCloudIO.savePoses.
+    Add 'sequence' to outputFormats to also write all the frames in the single file rgbd_sequence.rgbdseq"""
+
+    if not os.path.exists(sequenceFolder):
+        os.mkdir(sequenceFolder)
+    subsamplingStep=1
+    # the pool of workers is only started if there are files to write for each frame
+    writer=None
+    if any(format in outputFormats for format in ('rgb','depth','pcd','ptx')):
+        writer=FrameWriter(sequenceFolder,outputFormats,subsamplingStep,nbWorkers,maxPending=2*nbWorkers,useProcesses=useProcesses,pcdFormat=pcdFormat)
+    if 'gif' in outputFormats:
+        previewWriter=PreviewWriter(os.path.join(sequenceFolder,'rgbd_sequence.gif'),gifMaxDepthIntensity)
+    if 'sequence' in outputFormats:
+        # all the frames in a single file, see RGBDSequenceIO
+        sequenceWriter=RGBDSequenceIO.RGBDSequenceWriter(os.path.join(sequenceFolder,'rgbd_sequence.rgbdseq'),imageSize,imageSize,RGBDSequenceIO.cameraIntrinsics(imageSize,sequenceFocalLengthAt(imageSize)))
+	
+    # the poses are rendered by batches (using instancing with OpenGL) while the previous frames are being written
+    groundTruthPoses=[]
+    try:
+        for idFrame,array_rgb,array_xyz,array_depth,array_normals,modelTransform in iterateSequenceMaps(objFile,texture_image,nbFrames,batchSize,backend,sensor,imageSize):
+            groundTruthPoses.append(modelTransform)
+            if writer is not None:
+                writer.write(idFrame,array_rgb,array_depth,array_xyz,array_normals)
+            if 'gif' in outputFormats:
+                previewWriter.append(array_rgb,array_depth)
+            if 'sequence' in outputFormats:
+                sequenceWriter.append(array_rgb,array_xyz,modelTransform)
+    finally:
+        if writer is not None:
+            writer.close()
+        if 'gif' in outputFormats:
+            previewWriter.close()
+        if 'sequence' in outputFormats:
+            sequenceWriter.close()
+    pointCloudIO.savePoses(os.path.join(sequenceFolder,'groundTruthPoses.txt'),groundTruthPoses)
     
-    file = open(os.path.join(sequenceFolder,'pcdSequence.txt'),'w')
-    for pcdFileName in pcdFileNames:
-        file.write(pcdFileName+'\n') 
-    file.close()  
+    if 'pcd' in outputFormats:
+        file = open(os.path.join(sequenceFolder,'pcdSequence.txt'),'w')
+        for idFrame in range(nbFrames):
+            file.write('pointCLoud%03.0d.pcd'%idFrame+'\n') 
+        file.close()  
 	
 if __name__ == "__main__":
      
     objFile='data/crate/crate.obj' 
     texture_image = Image.open('data/crate/T_crate1_D.png')
     sequenceFolder='sequence/crate/'
-    generateSequence(objFile,texture_image,sequenceFolder)
+    generateSequence(objFile,texture_image,sequenceFolder,outputFormats=('rgb','depth','pcd','ptx','gif','sequence'))
     
     objFile='data/duck/duck.obj' 
     texture_image = Image.open('data/duck/duckCM.png')
     sequenceFolder='sequence/duck/'
-    generateSequence(objFile,texture_image,sequenceFolder)   
+    generateSequence(objFile,texture_image,sequenceFolder,outputFormats=('rgb','depth','pcd','ptx','gif','sequence'))   
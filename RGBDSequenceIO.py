@@ -0,0 +1,147 @@
+# This file contains a single file container for RGBD sequences, storing the RGB images, the XYZ images and the
+# poses of all the frames together with the camera intrinsics.
+#
+# The file starts with a fixed size header: an 8 bytes magic string, the size of the JSON description that follows
+# and the JSON description itself, padded with spaces. The frames are then stored one after the other as fixed
+# size records of a numpy structured dtype, so that frame i starts at dataOffset+i*recordSize. The reader memory
+# maps the records, which gives constant time access to any frame and slicing without reading the whole file.
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import json
+import os
+
+magic=b'RGBDSEQ1'
+headerSize=4096
+
+
+def cameraIntrinsics(imageSize,focal_length):
+	"""3x3 matrix K of the camera used by RGBDRenderer, a point (X,Y,Z) in camera coordinates projects on the pixel
+	(column,row)=(K[0,0]*X/Z+K[0,2],K[1,1]*Y/Z+K[1,2]). The focal lengths are negative as the x and y axes
+	of the camera point to the left and to the top of the image"""
+	center=(imageSize-1)/2.0
+	return np.array([[-focal_length,0,center],[0,-focal_length,center],[0,0,1]],dtype=np.float64)
+
+
+def recordDtype(height,width):
+	"""structured dtype of a frame"""
+	return np.dtype([('rgb',np.uint8,(height,width,3)),('xyz','<f4',(height,width,3)),('pose','<f8',(4,4))])
+
+
+class RGBDSequenceWriter():
+	"""Appends frames to a sequence file, the header is rewritten with the number of frames when closing.
+	A file that has not been closed can still be read, the number of frames is then deduced from its size"""
+
+	def __init__(self,filename,height,width,intrinsics):
+		self.filename=filename
+		self.dtype=recordDtype(height,width)
+		self.description=dict([('version',1),('height',height),('width',width),('intrinsics',np.asarray(intrinsics,dtype=np.float64).tolist()),
+			('recordDescr',self.dtype.descr),('recordSize',self.dtype.itemsize),('dataOffset',headerSize),('nbFrames',-1)])
+		self.nbFrames=0
+		self.file=open(filename,'wb')
+		self.writeHeader()
+
+	def writeHeader(self):
+		description=json.dumps(self.description).encode('ascii')
+		if len(magic)+8+len(description)>headerSize:
+			raise ValueError('sequence description too long')
+		self.file.seek(0)
+		self.file.write(magic)
+		self.file.write(np.array([len(description)],dtype='<u8').tobytes())
+		self.file.write(description.ljust(headerSize-len(magic)-8))
+		self.file.seek(0,os.SEEK_END)
+
+	def append(self,array_rgb,array_xyz,pose):
+		record=np.empty(1,dtype=self.dtype)
+		record['rgb']=array_rgb
+		record['xyz']=array_xyz
+		record['pose']=pose
+		record.tofile(self.file)
+		self.nbFrames+=1
+
+	def close(self):
+		self.description['nbFrames']=self.nbFrames
+		self.writeHeader()
+		self.file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
+
+
+class RGBDSequenceReader():
+	"""Memory maps the frames of a sequence file. reader[i] returns the RGB image, the XYZ image and the pose of frame i,
+	reader[start:end] returns arrays with the frames along the first axis, all as read only views of the file.
+	The rgb, xyz and poses attributes give views of the whole sequence"""
+
+	def __init__(self,filename):
+		self.filename=filename
+		with open(filename,'rb') as f:
+			if f.read(len(magic))!=magic:
+				raise ValueError('%s is not a RGBD sequence file'%filename)
+			descriptionSize=int(np.frombuffer(f.read(8),dtype='<u8')[0])
+			self.description=json.loads(f.read(descriptionSize).decode('ascii'))
+		self.height=self.description['height']
+		self.width=self.description['width']
+		self.intrinsics=np.array(self.description['intrinsics'])
+		self.dtype=recordDtype(self.height,self.width)
+		dataOffset=self.description['dataOffset']
+		nbFrames=self.description['nbFrames']
+		if nbFrames<0:
+			# the writer has not been closed, only complete records are used
+			nbFrames=(os.path.getsize(filename)-dataOffset)//self.dtype.itemsize
+		self.nbFrames=nbFrames
+		if nbFrames>0:
+			self.records=np.memmap(filename,dtype=self.dtype,mode='r',offset=dataOffset,shape=(nbFrames,))
+		else:
+			self.records=np.empty(0,dtype=self.dtype)
+		self.rgb=self.records['rgb']
+		self.xyz=self.records['xyz']
+		self.poses=self.records['pose']
+
+	def __len__(self):
+		return self.nbFrames
+
+	def __getitem__(self,index):
+		return self.rgb[index],self.xyz[index],self.poses[index]
+
+	def __iter__(self):
+		for idFrame in range(self.nbFrames):
+			yield self[idFrame]
+
+	def close(self):
+		"""releases the memory map, the views obtained from this object keep it open until they are deleted"""
+		self.records=None
+		self.rgb=None
+		self.xyz=None
+		self.poses=None
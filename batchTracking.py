@@ -0,0 +1,277 @@
+# This file contains a driver that tracks several models in several sequences at once on a pool of processes, the jobs
+# being listed in a manifest, as the runTrackingPCL_*.bat scripts do for one model and one sequence
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+try:
+	from queue import Empty
+except ImportError:
+	from Queue import Empty
+from scipy.spatial import cKDTree
+import pointCloudIO
+import RGBDSequenceIO
+import surfaceAlign
+import modelCache
+
+
+class SharedArrays():
+	"""Copies a dictionary of arrays once into shared memory blocks, the worker processes attach the same memory
+	using attachSharedArrays with the descriptor attribute instead of receiving a copy of the arrays"""
+
+	def __init__(self,arrays):
+		self.blocks=[]
+		self.descriptor=dict()
+		try:
+			for name,array in arrays.items():
+				array=np.ascontiguousarray(array)
+				block=shared_memory.SharedMemory(create=True,size=max(array.nbytes,1))
+				self.blocks.append(block)
+				np.ndarray(array.shape,array.dtype,buffer=block.buf)[...]=array
+				self.descriptor[name]=(block.name,array.shape,array.dtype.str)
+		except:
+			self.close()
+			raise
+
+	def close(self):
+		"""frees the shared memory, the arrays attached by other processes must not be used anymore"""
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks=[]
+
+
+def attachSharedArrays(descriptor):
+	"""read only views of the shared memory blocks described by SharedArrays.descriptor, also returns the blocks,
+	that must be kept open while the arrays are used"""
+	arrays=dict()
+	blocks=[]
+	for name,(blockName,shape,dtype) in descriptor.items():
+		block=shared_memory.SharedMemory(name=blockName)
+		blocks.append(block)
+		array=np.ndarray(shape,dtype,buffer=block.buf)
+		array.flags.writeable=False
+		arrays[name]=array
+	return arrays,blocks
+
+
+workerData={}
+
+
+def initWorker(progressQueue):
+	workerData['progressQueue']=progressQueue
+	workerData['models']=dict()
+
+
+def attachModel(descriptor):
+	"""model assets shared by the main process, attached once per worker process. The KD-trees are rebuilt in each
+	process on top of the shared arrays, which they do not copy"""
+	key=tuple(sorted((name,value[0]) for name,value in descriptor.items()))
+	if key not in workerData['models']:
+		model,blocks=attachSharedArrays(descriptor)
+		model['modelTree']=cKDTree(model['points'],copy_data=False)
+		if 'features' in model:
+			model['featureTree']=cKDTree(model['features'],copy_data=False)
+		workerData['models'][key]=(model,blocks)
+	return workerData['models'][key][0]
+
+
+def openSequence(sequenceFile):
+	"""scenes of a RGBD sequence file (.rgbdseq) or of a list of PCD files, their number and the camera intrinsics
+	(None for the PCD files, that can only be tracked with the nearest neighbour association)"""
+	if sequenceFile.endswith('.rgbdseq'):
+		sequence=RGBDSequenceIO.RGBDSequenceReader(sequenceFile)
+		return sequence.xyz,len(sequence),sequence.intrinsics
+	frames=pointCloudIO.openPCDSequence(sequenceFile)
+	return (frame.points for frame in frames),len(frames),None
+
+
+def runJob(job,descriptor):
+	"""tracks the model of the job in its sequence in a worker process, sends the progress of each frame to the main
+	process and saves the poses in the output folder of the job, returns the summary of the job"""
+	model=attachModel(descriptor)
+	progressQueue=workerData['progressQueue']
+	# the initial alignment runs in the worker itself rather than on a pool of its own
+	parameters=dict(job['parameters'])
+	parameters['nbWorkers']=0
+	scenes,nbFrames,intrinsics=openSequence(job['sequence'])
+	association=job.get('association','nearest' if intrinsics is None else 'projective')
+	tracker=surfaceAlign.createTracker(model,parameters,job.get('errorMetric'),association,intrinsics)
+	iterations=[]
+
+	def progress(idFrame,pose,info):
+		iterations.append(info['iterations'])
+		progressQueue.put((job['name'],idFrame,nbFrames,info['fitness']))
+
+	start=time.time()
+	initialPose=None if job.get('initialPose') is None else np.array(job['initialPose'],dtype=np.float64)
+	poses=surfaceAlign.runTracker(tracker,scenes,initialPose,job['outputFolder'],model if job.get('globalInitialization') else None,
+		parameters,progress)
+	duration=time.time()-start
+	return dict([('name',job['name']),('model',job['model']),('sequence',job['sequence']),('frames',len(poses)),
+		('seconds',duration),('fps',len(poses)/duration if duration>0 else None),
+		('meanIterations',float(np.mean(iterations)) if iterations else None),
+		('poses',os.path.join(job['outputFolder'],'poses.txt'))])
+
+
+def loadManifest(fileName):
+	"""reads a JSON manifest, either a list of jobs or a dictionary with the list of jobs and an optional output folder.
+	A job is a dictionary with the OBJ file of the model, the sequence file (a PCD files list such as pcdSequence.txt
+	or a .rgbdseq file) and optionally its name, its parameters (a dictionary or the name of a set of
+	surfaceAlign.trackingParameters), initialPose, globalInitialization, errorMetric and association.
+	The relative paths are relative to the folder of the manifest. Returns the jobs and the output folder"""
+	with open(fileName,'r') as f:
+		manifest=json.load(f)
+	if isinstance(manifest,list):
+		manifest=dict([('jobs',manifest)])
+	folder=os.path.dirname(os.path.abspath(fileName))
+	jobs=[]
+	for job in manifest['jobs']:
+		job=dict(job)
+		job['model']=os.path.join(folder,job['model'])
+		job['sequence']=os.path.join(folder,job['sequence'])
+		jobs.append(job)
+	outputFolder=manifest.get('outputFolder')
+	return jobs,None if outputFolder is None else os.path.join(folder,outputFolder)
+
+
+def prepareJobs(jobs,outputFolder):
+	"""jobs with their default name, their parameters and the folder their poses are written to"""
+	prepared=[]
+	for index,job in enumerate(jobs):
+		job=dict(job)
+		job.setdefault('name','%03d_%s'%(index,os.path.splitext(os.path.basename(job['model']))[0]))
+		parameters=job.get('parameters',dict())
+		if not isinstance(parameters,dict):
+			parameters=surfaceAlign.trackingParameters[parameters]
+		job['parameters']=dict(parameters)
+		job['outputFolder']=os.path.join(outputFolder,job['name'])
+		prepared.append(job)
+	names=[job['name'] for job in prepared]
+	if len(set(names))<len(names):
+		raise ValueError('the names of the jobs are not unique')
+	return prepared
+
+
+def modelKey(job):
+	"""the assets of a model are computed and shared once for all the jobs with the same key"""
+	if job.get('globalInitialization'):
+		return (os.path.abspath(job['model']),job['parameters'].get('RadiusSearch',0.05),job['parameters'].get('featureRadius',0.1))
+	return (os.path.abspath(job['model']),None,None)
+
+
+def printProgress(name,idFrame,nbFrames,fitness):
+	print('%s: frame %d/%d, score %f'%(name,idFrame+1,nbFrames,fitness))
+
+
+def trackBatch(jobs,outputFolder,nbWorkers=None,cache=None,progress=printProgress):
+	"""runs the tracking jobs (see loadManifest) on a pool of nbWorkers processes, one job per process at a time.
+	The assets of each model are computed once in this process, or loaded from the modelCache.ModelCache cache, and
+	shared read only with the workers through shared memory. progress(name,idFrame,nbFrames,fitness) is called in
+	this process as the frames are tracked. The poses of each job are saved in outputFolder/name/poses.txt with
+	pointCloudIO.savePoses and the summary of the jobs in outputFolder/results.json. A failed job does not stop the
+	others, its error is reported in the summary, which is returned"""
+	jobs=prepareJobs(jobs,outputFolder)
+	start=time.time()
+	shared=dict()
+	results=[None]*len(jobs)
+	progressQueue=multiprocessing.Queue()
+
+	def forwardProgress(timeout):
+		"""calls progress for the messages received, waiting at most timeout seconds for the first one,
+		returns the number of messages"""
+		nbMessages=0
+		try:
+			while True:
+				message=progressQueue.get(timeout=timeout) if nbMessages==0 else progressQueue.get_nowait()
+				nbMessages+=1
+				if progress is not None:
+					progress(*message)
+		except Empty:
+			return nbMessages
+
+	try:
+		for job in jobs:
+			key=modelKey(job)
+			if key not in shared:
+				assets=modelCache.loadModelAssets(job['model'],key[1],key[2],cache)
+				shared[key]=SharedArrays(dict((name,value) for name,value in assets.items() if not name.endswith('Tree')))
+		nbMessages=0
+		with ProcessPoolExecutor(nbWorkers,initializer=initWorker,initargs=(progressQueue,)) as pool:
+			futures=dict((pool.submit(runJob,job,shared[modelKey(job)].descriptor),index) for index,job in enumerate(jobs))
+			pending=set(futures)
+			while pending:
+				nbMessages+=forwardProgress(0.1)
+				done,pending=wait(pending,timeout=0,return_when=FIRST_COMPLETED)
+				for future in done:
+					index=futures[future]
+					try:
+						results[index]=future.result()
+					except Exception as error:
+						results[index]=dict([('name',jobs[index]['name']),('model',jobs[index]['model']),
+							('sequence',jobs[index]['sequence']),('error',repr(error))])
+		# the last messages may arrive after the results
+		nbFrames=sum(result.get('frames',0) for result in results)
+		while nbMessages<nbFrames:
+			received=forwardProgress(1.0)
+			if received==0:
+				break
+			nbMessages+=received
+	finally:
+		for arrays in shared.values():
+			arrays.close()
+
+	duration=time.time()-start
+	summary=dict([('jobs',results),('seconds',duration),('frames',nbFrames),('fps',nbFrames/duration if duration>0 else None)])
+	if not os.path.exists(outputFolder):
+		os.makedirs(outputFolder)
+	with open(os.path.join(outputFolder,'results.json'),'w') as f:
+		json.dump(summary,f,indent=1)
+	return summary
+
+
+if __name__ == "__main__":
+	if len(sys.argv)>1:
+		jobs,outputFolder=loadManifest(sys.argv[1])
+	else:
+		# the jobs of runTrackingPCL_Crate.bat and runTrackingPCL_Duck.bat
+		jobs=[dict([('name','crate'),('model','data/crate/crateResampled.obj'),('sequence','sequence/crate/pcdSequence.txt'),
+				('parameters','crate'),('globalInitialization',True)]),
+			dict([('name','duck'),('model','data/duck/duckResampled.obj'),('sequence','sequence/duck/pcdSequence.txt'),
+				('parameters','duck'),('globalInitialization',True)])]
+		outputFolder=None
+	trackBatch(jobs,outputFolder or 'result/batch',cache=modelCache.ModelCache('cache'))
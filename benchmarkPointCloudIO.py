@@ -0,0 +1,328 @@
+# Micro-benchmarks of the point cloud readers and writers of pointCloudIO
+#
+# Each benchmark compares the current implementation with the previous per-point implementation, which is kept
+# here as a reference, checks that both produce the same output and prints the number of points per second.
+#
+#	python benchmarkPointCloudIO.py
+
+import numpy as np
+import os
+import time
+import tempfile
+import pointCloudIO
+
+
+def savePCDAsciiReference(filename,points,colors,data=None):
+	"""previous implementation of savePCD(...,format='ascii') formatting one point at a time, only the body
+	of the file after the DATA line is written"""
+	with open(filename, 'w') as f:
+		colors_unint32=colors.astype(np.uint32)
+		rgb_int = (colors_unint32[:,:,0] << 16) | (colors_unint32[:,:,1] << 8) | (colors_unint32[:,:,2])
+		colors_float=rgb_int.view(np.float32)
+		for i in range(points.shape[0]):
+			for j in range(points.shape[1]):
+				p=points[i,j]
+
+				rgb_string= "%.8e"%	colors_float[i,j]
+				s='%.7f'%p[0]+' '+'%.7f'%p[1]+' '+'%.7f'%p[2]+' '+rgb_string
+				if data:
+					for k in data.keys():
+						s+=' '+str(data[k][i,j])
+				f.write(s+'\n')
+
+
+def savePTXReference(filename,points,colors):
+	"""previous implementation of savePTX formatting the rows with np.savetxt, with the identity transform"""
+	transformMtx=np.column_stack((np.eye(3),np.zeros((3,1))))
+	with open(filename, 'w') as f:
+		f.write(str(points.shape[1])+'\n')
+		f.write(str(points.shape[0])+'\n')
+		np.savetxt(f,transformMtx[:,3].reshape([1,3]),'%.5f')
+		np.savetxt(f,transformMtx[:3,:3].T,'%.5f')
+		M=np.zeros((4,4))
+		M[3,3]=1
+		M[:3,:3]=transformMtx[:3,:3].T
+		np.savetxt(f,M,'%.5f')
+		p=np.dstack((np.flipud(points.astype(np.float64)),np.ones((points.shape[0],points.shape[1],1),dtype=np.uint8),np.flipud(colors)))
+		np.savetxt(f,np.transpose(p,[1,0,2]).reshape(-1,7),'%.5f %.5f %.5f %d %d %d %d')
+
+
+def loadPTXReference(filename):
+	"""previous implementation of loadPTX parsing the body with np.fromfile, without the points transformation"""
+	with open(filename, 'r') as f:
+		nbcols=int(f.readline())
+		nblines=int(f.readline())
+		np.fromfile(f, sep=' ', count=3+9+16)
+		points_with_color=np.fromfile(f,  sep=' ',count=-1).reshape(-1,7)
+		points=np.transpose(points_with_color[:,:3].reshape((nbcols,nblines,3)),[1,0,2])[::-1,:,:]
+		colors=np.transpose(points_with_color[:,4:7].reshape((nbcols,nblines,3)).astype(int),[1,0,2])[::-1,:,:]
+		return points,colors
+
+
+def loadPLYReference(filename,getFaces=True):
+	"""previous implementation of loadPLY reading the faces one at a time, ascii files only"""
+	header_dict=dict()
+	with open(filename, 'r') as f:
+		line=f.readline().rstrip('\n')
+		assert(line=='ply')
+		line=f.readline().rstrip('\n')
+		assert(line=='format ascii 1.0')
+		fields_vertex_names=[]
+		fields_vertex_types=[]
+		fields_face_names=[]
+		fields_face_types=[]	
+		fields_edges_names=[]
+		fields_edges_types=[]			
+		nbFaces=0
+		nbEdges=0
+		while True:
+			line=f.readline()
+			line = line.rstrip('\n')
+			t=line.split(' ')
+
+			if t[0]=='comment':
+				continue
+			elif t[0]=='end_header':
+				break
+			elif t[0]=='property':
+				if t[1]=='list':
+					fields_names.append(t[4])
+					fields_types.append(t[1:4])
+				else:
+					fields_names.append(t[2])
+					fields_types.append(t[1])
+			elif t[0]=='element':
+				if t[1]=='vertex':
+					nbPoints=int(t[2])
+					fields_names=fields_vertex_names
+					fields_types=fields_vertex_types	
+					assert(len(t)==3)
+				if t[1]=='face':
+					nbFaces=int(t[2])
+					fields_names=fields_face_names
+					fields_types=fields_face_types	
+				if t[1]=='edge':
+					nbEdges=int(t[2])
+					fields_names=fields_edges_names
+					fields_types=fields_edges_types				
+			else:
+				print ('unkown key word')
+
+		nbVertexFields=len(fields_vertex_names)
+		DataArray=np.fromfile(f,  sep=' ',count=nbPoints*nbVertexFields).reshape(nbPoints,-1)
+
+		Data=dict()
+
+		for i,field,type in zip(range(nbVertexFields),fields_vertex_names,fields_vertex_types):
+			if type=='float':
+				py_type=np.float32
+			elif  type=='uint':
+				py_type=np.uint32
+			elif  type=='uchar':
+				py_type=np.uint16 #uint8
+			else:
+				print ('not yet coded')
+				raise
+
+			Data[field]=DataArray[:,i].astype(py_type)
+
+		points=np.column_stack ((Data['x'],Data['y'],Data['z']))
+		for key in ['x','y','z']:
+			del Data[key]		
+		if ('red' in Data) and ('green' in Data) and ('blue' in Data):
+			colors=np.column_stack ((Data['red'],Data['green'],Data['blue']))
+			for key in ['red','green','blue']:
+				del Data[key]			
+		else: 
+			colors=None
+
+		if getFaces:
+			edges=None
+			DataFaces=dict()
+			DataPolylines=dict()
+			for field in fields_face_names[1:]:
+				DataFaces[field]=[]#np.empty((nbFaces),dtype=np.uint32)
+				DataPolylines[field]   =[]
+			if nbFaces>0:
+				polylines=[]
+				faces=[]
+				for idface in range(nbFaces):
+					line=f.readline()
+					line = line.rstrip('\n')
+					t=[i for i in line.split(' ')]
+					for i in range(3,int(t[0])+1):
+						faces.append([int(t[1]),int(t[i-1]),int(t[i])])
+						for id,field in enumerate(fields_face_names[1:]):
+							#fields_face_names
+							DataFaces[field].append(float(t[int(t[0])+id+1]))
+					polylines.append(points[[int(x) for x in  t[1:int(t[0])+1]]])
+					for id,field in enumerate(fields_face_names[1:]):
+							#fields_face_names
+						DataPolylines[field].append(float(t[int(t[0])+id+1]))
+						#DataPolylines[field]=
+				for field in (fields_face_names[1:]):
+					DataFaces[field]=np.array(DataFaces[field])
+				faces=np.array(faces,dtype=np.int32)
+
+			else: 
+				faces=None
+				DataFaces=None
+				polylines=None
+				edges=None
+			if nbEdges>0:
+				data=np.fromfile(f,  sep=' ',count=nbEdges*2)
+				edges=data.reshape(nbEdges,2)
+			return points,colors, Data,faces,DataFaces,polylines,edges,DataPolylines
+		else:
+			return points,colors, Data
+
+
+def readBytes(filename):
+	with open(filename,'rb') as f:
+		return f.read()
+
+
+def pcdBody(filename):
+	"""returns the content of a PCD file after the DATA line"""
+	content=readBytes(filename)
+	return content[content.index(b'DATA'):].split(b'\n',1)[1]
+
+
+def timeit(function,nbRepeats=3):
+	"""returns the smallest duration of nbRepeats calls"""
+	durations=[]
+	for i in range(nbRepeats):
+		start=time.perf_counter()
+		function()
+		durations.append(time.perf_counter()-start)
+	return min(durations)
+
+
+def randomFrame(height,width):
+	"""random organized point cloud with colors and a few extra fields"""
+	points=(np.random.rand(height,width,3)*4-2).astype(np.float32)
+	colors=np.random.randint(0,256,(height,width,3)).astype(np.uint8)
+	data=dict([('intensity',np.random.rand(height,width).astype(np.float32)),('label',np.random.randint(0,100,(height,width)).astype(np.uint32))])
+	return points,colors,data
+
+
+def benchmarkSavePCDAscii(height=300,width=300,extraFields=True):
+	points,colors,data=randomFrame(height,width)
+	if not extraFields:
+		data=None
+	folder=tempfile.mkdtemp()
+	referenceFile=os.path.join(folder,'reference.pcd')
+	newFile=os.path.join(folder,'new.pcd')
+	durationReference=timeit(lambda:savePCDAsciiReference(referenceFile,points,colors,data),nbRepeats=1)
+	durationNew=timeit(lambda:pointCloudIO.savePCD(newFile,None,points,colors,data=data,format='ascii'))
+	assert readBytes(referenceFile)==pcdBody(newFile)
+	nbPoints=height*width
+	print('savePCD ascii %dx%d%s: before %.0f points/s, after %.0f points/s, speedup x%.1f'%(height,width,' with extra fields' if extraFields else '',nbPoints/durationReference,nbPoints/durationNew,durationReference/durationNew))
+
+
+def benchmarkPCDBinaryCompressed(height=300,width=300):
+	"""speed and size of binary_compressed files compared to the binary ones, with liblzf and with the pure python
+	codec. The round trips are checked in testPointCloudIO"""
+	points,colors,data=randomFrame(height,width)
+	# smooth surface with a constant background, closer to the clouds we generate than random values
+	points[:,:,2]=np.linspace(1,2,width)[None,:]
+	points[:height//2]=0
+	folder=tempfile.mkdtemp()
+	binaryFile=os.path.join(folder,'binary.pcd')
+	compressedFile=os.path.join(folder,'compressed.pcd')
+	pointCloudIO.savePCD(binaryFile,None,points,colors,data=data,format='binary')
+	lzf=pointCloudIO.lzf
+	for backend in ['liblzf','python']:
+		if backend=='liblzf' and lzf is None:
+			print('python-lzf is not installed, skipping the liblzf backend')
+			continue
+		pointCloudIO.lzf=lzf if backend=='liblzf' else None
+		try:
+			durationSave=timeit(lambda:pointCloudIO.savePCD(compressedFile,None,points,colors,data=data,format='binary_compressed'),nbRepeats=1)
+			durationLoad=timeit(lambda:pointCloudIO.loadPCD(compressedFile),nbRepeats=1)
+		finally:
+			pointCloudIO.lzf=lzf
+		nbPoints=height*width
+		print('savePCD/loadPCD binary_compressed %dx%d with %s: save %.0f points/s, load %.0f points/s, size %.0f%% of binary'%(height,width,backend,nbPoints/durationSave,nbPoints/durationLoad,100.0*os.path.getsize(compressedFile)/os.path.getsize(binaryFile)))
+
+
+def benchmarkPTX(height=300,width=300):
+	"""speed of savePTX and loadPTX compared to the previous implementations, the round trips are checked in
+	testPointCloudIO"""
+	points,colors,data=randomFrame(height,width)
+	folder=tempfile.mkdtemp()
+	referenceFile=os.path.join(folder,'reference.ptx')
+	newFile=os.path.join(folder,'new.ptx')
+	durationSaveReference=timeit(lambda:savePTXReference(referenceFile,points,colors),nbRepeats=1)
+	durationSave=timeit(lambda:pointCloudIO.savePTX(newFile,points,colors))
+	durationLoadReference=timeit(lambda:loadPTXReference(referenceFile),nbRepeats=1)
+	durationLoad=timeit(lambda:pointCloudIO.loadPTX(newFile))
+	nbPoints=height*width
+	print('savePTX %dx%d: before %.0f points/s, after %.0f points/s, speedup x%.1f'%(height,width,nbPoints/durationSaveReference,nbPoints/durationSave,durationSaveReference/durationSave))
+	print('loadPTX %dx%d: before %.0f points/s, after %.0f points/s, speedup x%.1f'%(height,width,nbPoints/durationLoadReference,nbPoints/durationLoad,durationLoadReference/durationLoad))
+
+
+def writePLY(filename,points,colors,faces,quality,format):
+	"""writes a PLY file with a list of faces of any size and a quality value per face"""
+	header=['ply','format %s 1.0'%format,'comment written by benchmarkPointCloudIO','element vertex %d'%len(points),
+		'property float x','property float y','property float z','property uchar red','property uchar green','property uchar blue',
+		'element face %d'%len(faces),'property list uchar int vertex_indices','property float quality','end_header']
+	with open(filename,'wb') as f:
+		f.write(('\n'.join(header)+'\n').encode('ascii'))
+		if format=='ascii':
+			for p,c in zip(points.tolist(),colors.tolist()):
+				f.write(('%r %r %r %d %d %d\n'%tuple(p+c)).encode('ascii'))
+			for face,q in zip(faces,quality.tolist()):
+				f.write(('%d '%len(face)+' '.join(str(i) for i in face)+' %r\n'%q).encode('ascii'))
+		else:
+			byteOrder='<' if format=='binary_little_endian' else '>'
+			vertices=np.empty(len(points),dtype=[('p',byteOrder+'f4',3),('c','u1',3)])
+			vertices['p']=points
+			vertices['c']=colors
+			f.write(vertices.tobytes())
+			for face,q in zip(faces,quality.tolist()):
+				f.write(np.array([len(face)],dtype='u1').tobytes()+np.array(face,dtype=byteOrder+'i4').tobytes()+np.array([q],dtype=byteOrder+'f4').tobytes())
+
+
+def checkSamePLY(a,b):
+	"""checks that two results of loadPLY are the same"""
+	points,colors,Data,faces,DataFaces,polylines,edges,DataPolylines=a
+	assert np.array_equal(points,b[0]) and points.dtype==b[0].dtype
+	assert np.array_equal(colors,b[1]) and colors.dtype==b[1].dtype
+	assert np.array_equal(faces,b[3]) and faces.dtype==b[3].dtype
+	assert np.array_equal(DataFaces['quality'],b[4]['quality'])
+	assert len(polylines)==len(b[5]) and all(np.array_equal(p,q) for p,q in zip(polylines,b[5]))
+	assert np.array_equal(DataPolylines['quality'],b[7]['quality'])
+
+
+def benchmarkLoadPLY(nbVertices=20000,nbFaces=40000):
+	"""loadPLY on ascii and binary files with triangles only and with a mix of triangles and quads, checked against
+	the previous implementation on the ascii files"""
+	points=np.random.rand(nbVertices,3).astype(np.float32)
+	colors=np.random.randint(0,256,(nbVertices,3))
+	quality=np.random.rand(nbFaces).astype(np.float32).astype(np.float64)
+	triangles=np.random.randint(0,nbVertices,(nbFaces,3)).tolist()
+	mixed=[face+[(face[0]+1)%nbVertices] if i%3==0 else face for i,face in enumerate(triangles)]
+	folder=tempfile.mkdtemp()
+	for name,faces in [('triangles',triangles),('mixed',mixed)]:
+		asciiFile=os.path.join(folder,name+'_ascii.ply')
+		writePLY(asciiFile,points,colors,faces,quality,'ascii')
+		durationReference=timeit(lambda:loadPLYReference(asciiFile),nbRepeats=1)
+		durationNew=timeit(lambda:pointCloudIO.loadPLY(asciiFile))
+		reference=loadPLYReference(asciiFile)
+		checkSamePLY(pointCloudIO.loadPLY(asciiFile),reference)
+		print('loadPLY ascii %d faces (%s): before %.0f faces/s, after %.0f faces/s, speedup x%.1f'%(nbFaces,name,nbFaces/durationReference,nbFaces/durationNew,durationReference/durationNew))
+		for format in ['binary_little_endian','binary_big_endian']:
+			binaryFile=os.path.join(folder,name+'_'+format+'.ply')
+			writePLY(binaryFile,points,colors,faces,quality,format)
+			duration=timeit(lambda:pointCloudIO.loadPLY(binaryFile))
+			checkSamePLY(pointCloudIO.loadPLY(binaryFile),reference)
+			print('loadPLY %s %d faces (%s): %.0f faces/s'%(format,nbFaces,name,nbFaces/duration))
+
+
+if __name__ == "__main__":
+	benchmarkSavePCDAscii(extraFields=False)
+	benchmarkSavePCDAscii(extraFields=True)
+	benchmarkPCDBinaryCompressed()
+	benchmarkPTX()
+	benchmarkLoadPLY()
@@ -0,0 +1,217 @@
+# Benchmark of the tracking of surfaceAlign on the crate and duck sequences and on synthetic sequences
+#
+# Each case tracks a model in a sequence starting from the ground truth first pose and reports the rotation and translation
+# errors with respect to the ground truth poses, the frame rate, the latency percentiles of the stages of the tracking
+# and the peak memory. The report is saved in JSON so that the results of two versions can be compared
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+from concurrent.futures import ProcessPoolExecutor
+try:
+	import resource
+except ImportError:
+	resource=None # not available on windows, the peak memory is then not reported
+from PIL import Image
+import pointCloudIO
+import RGBDSequenceIO
+import RGBDSequenceGeneration
+import surfaceAlign
+import batchTracking
+
+stages=['load','preprocessing','correspondences','solve']
+
+
+def peakMemory():
+	"""peak resident memory of the process in bytes, None if it cannot be measured on this platform"""
+	if resource is None:
+		return None
+	peak=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# kilobytes on linux, bytes on macOS
+	return peak if sys.platform=='darwin' else peak*1024
+
+
+def poseErrors(poses,groundTruth):
+	"""rotation errors in degrees and translation errors of the (N,4,4) poses with respect to the ground truth poses"""
+	rotations=np.einsum('nji,njk->nik',poses[:,:3,:3],groundTruth[:,:3,:3])
+	angles=np.degrees(np.arccos(np.clip((np.trace(rotations,axis1=1,axis2=2)-1)/2,-1,1)))
+	return angles,np.linalg.norm(poses[:,:3,3]-groundTruth[:,:3,3],axis=1)
+
+
+def errorStatistics(errors):
+	return dict([('mean',float(np.mean(errors))),('median',float(np.median(errors))),('p90',float(np.percentile(errors,90))),
+		('max',float(np.max(errors)))])
+
+
+def latencyPercentiles(durations):
+	"""percentiles of the durations in milliseconds"""
+	milliseconds=np.asarray(durations,dtype=np.float64)*1000
+	return dict([('mean',float(np.mean(milliseconds))),('p50',float(np.percentile(milliseconds,50))),
+		('p90',float(np.percentile(milliseconds,90))),('p99',float(np.percentile(milliseconds,99))),('max',float(np.max(milliseconds)))])
+
+
+def loadGroundTruth(sequenceFile):
+	"""ground truth poses of a sequence file written by RGBDSequenceIO, or of the groundTruthPoses.txt file written by
+	RGBDSequenceGeneration.generateSequence in the folder of a PCD files list"""
+	if sequenceFile.endswith('.rgbdseq'):
+		return np.array(RGBDSequenceIO.RGBDSequenceReader(sequenceFile).poses,dtype=np.float64)
+	return pointCloudIO.loadPoses(os.path.join(os.path.dirname(sequenceFile),'groundTruthPoses.txt'))
+
+
+def timedScenes(scenes,loadTimes):
+	"""yields the scenes read in memory, appending the time taken to read each of them to loadTimes"""
+	scenes=iter(scenes)
+	while True:
+		start=time.perf_counter()
+		try:
+			# the frames of a sequence file are memory mapped, np.array reads them
+			scene=np.array(next(scenes))
+		except StopIteration:
+			return
+		loadTimes.append(time.perf_counter()-start)
+		yield scene
+
+
+def synthesizeSequence(synthetic,folder):
+	"""renders the test sequence of a model described by the dictionary synthetic (objFile, texture, nbFrames,
+	imageSize, sensor and backend, see RGBDSequenceGeneration.generateSequence) in folder, returns the sequence file"""
+	RGBDSequenceGeneration.generateSequence(synthetic['objFile'],Image.open(synthetic['texture']),folder,synthetic.get('nbFrames',50),
+		outputFormats=('sequence',),nbWorkers=1,backend=synthetic.get('backend','opengl'),sensor=synthetic.get('sensor'),
+		imageSize=synthetic.get('imageSize',RGBDSequenceGeneration.sequenceImageSize))
+	return os.path.join(folder,'rgbd_sequence.rgbdseq')
+
+
+def runCase(case):
+	"""tracks the model of the case in its sequence starting from the ground truth first pose and returns the
+	accuracy, speed and memory measures, see defaultCases"""
+	parameters=case.get('parameters',dict())
+	if not isinstance(parameters,dict):
+		parameters=surfaceAlign.trackingParameters[parameters]
+	parameters=dict(parameters,**case.get('options',dict()))
+	start=time.perf_counter()
+	model=surfaceAlign.loadModelAssets(case['model'],False,parameters)
+	modelLoad=time.perf_counter()-start
+	scenes,nbFrames,intrinsics=batchTracking.openSequence(case['sequence'])
+	association=case.get('association','nearest' if intrinsics is None else 'projective')
+	tracker=surfaceAlign.createTracker(model,parameters,case.get('errorMetric'),association,intrinsics)
+	groundTruth=loadGroundTruth(case['sequence'])
+	baselineMemory=peakMemory()
+
+	latencies=dict((stage,[]) for stage in stages)
+	frameTimes=[]
+	iterations=[]
+	poses=[]
+	start=time.perf_counter()
+	previous=start
+	for pose,info in tracker.track(timedScenes(scenes,latencies['load']),groundTruth[0]):
+		now=time.perf_counter()
+		frameTimes.append(now-previous)
+		previous=now
+		poses.append(pose)
+		iterations.append(info['iterations'])
+		for stage in stages[1:]:
+			latencies[stage].append(info['timings'][stage])
+	duration=time.perf_counter()-start
+
+	rotationErrors,translationErrors=poseErrors(np.array(poses),groundTruth[:len(poses)])
+	return dict([('name',case['name']),('sequence',case['sequence']),('frames',len(poses)),('association',association),
+		('parameters',parameters),('rotationErrorDegrees',errorStatistics(rotationErrors)),
+		('translationError',errorStatistics(translationErrors)),('fps',len(poses)/duration),
+		('meanIterations',float(np.mean(iterations))),('modelLoadSeconds',modelLoad),
+		('frameLatencyMilliseconds',latencyPercentiles(frameTimes)),
+		('stageLatencyMilliseconds',dict((stage,latencyPercentiles(latencies[stage])) for stage in stages)),
+		('baselineMemoryBytes',baselineMemory),('peakMemoryBytes',peakMemory())])
+
+
+def defaultCases(sequenceFolder='sequence',nbFrames=100,imageSize=300,sensor=None,exactDepths=False):
+	"""the crate and duck sequences written by RGBDSequenceGeneration in sequenceFolder, and a synthetic sequence of each
+	model with nbFrames frames of size imageSize rendered without OpenGL, with the depth sensor artifacts obtained with
+	the keyword arguments sensor of rayCaster.simulateDepthSensor (its defaults if None), or exact depths if exactDepths"""
+	if sensor is None:
+		sensor=dict()
+	if exactDepths:
+		sensor=None
+	cases=[]
+	for name,texture in [('crate','data/crate/T_crate1_D.png'),('duck','data/duck/duckCM.png')]:
+		model='data/%s/%sResampled.obj'%(name,name)
+		cases.append(dict([('name',name),('model',model),('sequence',os.path.join(sequenceFolder,name,'rgbd_sequence.rgbdseq')),
+			('parameters',name)]))
+		cases.append(dict([('name','%s_synthetic'%name),('model',model),('parameters',name),
+			('synthetic',dict([('objFile','data/%s/%s.obj'%(name,name)),('texture',texture),('nbFrames',nbFrames),
+				('imageSize',imageSize),('sensor',sensor),('backend','software')]))]))
+	return cases
+
+
+def runBenchmark(cases,outputFile=None,isolated=True):
+	"""runs the cases and returns the report, also saved in the JSON file outputFile if it is given. The synthetic
+	sequences are rendered in a temporary folder before tracking. With isolated=True each case runs in a new process,
+	so that its peak memory does not include the memory used by the previous cases. A case that fails, for example
+	because its sequence has not been generated, does not stop the others and its error is reported instead"""
+	results=[]
+	temporaryFolder=tempfile.mkdtemp()
+	try:
+		for idCase,case in enumerate(cases):
+			case=dict(case)
+			try:
+				if 'synthetic' in case:
+					case['sequence']=synthesizeSequence(case['synthetic'],os.path.join(temporaryFolder,'%03d'%idCase))
+				if isolated:
+					with ProcessPoolExecutor(1) as pool:
+						result=pool.submit(runCase,case).result()
+				else:
+					result=runCase(case)
+			except Exception as error:
+				result=dict([('name',case['name']),('sequence',case.get('sequence')),('error',repr(error))])
+				print('%s: failed with %r'%(case['name'],error))
+			else:
+				print('%s: %d frames, %.1f fps, max errors %.3f degrees %.4f'%(result['name'],result['frames'],result['fps'],
+					result['rotationErrorDegrees']['max'],result['translationError']['max']))
+			if 'synthetic' in case:
+				result['sequence']=case['synthetic']
+			results.append(result)
+	finally:
+		shutil.rmtree(temporaryFolder,ignore_errors=True)
+	report=dict([('python',platform.python_version()),('numpy',np.__version__),('platform',platform.platform()),('cases',results)])
+	if outputFile is not None:
+		with open(outputFile,'w') as f:
+			json.dump(report,f,indent=1,sort_keys=True)
+	return report
+
+
+if __name__ == "__main__":
+	# python benchmarkTracking.py [report.json [sequenceFolder]]
+	runBenchmark(defaultCases(*sys.argv[2:3]),sys.argv[1] if len(sys.argv)>1 else 'benchmarkTracking.json')
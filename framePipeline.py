@@ -0,0 +1,101 @@
+# This file contains lazy generator stages to stream RGBD frames from the renderer or from a sequence file to the
+# tracker without writing them to disk. All the stages take and yield (rgb,xyz,pose) tuples, where rgb and xyz are
+# either H x W x 3 images or N x 3 colors and points, and pose is the ground truth pose or None.
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import threading
+try:
+	from queue import Queue, Full
+except ImportError:
+	from Queue import Queue, Full
+import pointCloudProcessing
+
+
+def prefetch(frames,size=2):
+	"""generator producing the frames of the iterable in a background thread at most size frames ahead of the
+	consumer, so that the rendering or the reading of the next frames overlaps with the processing of the current one
+	while the memory stays bounded. An exception raised by the producer is raised again in the consumer, and the
+	producer is closed in its own thread if the consumer stops early"""
+	queue=Queue(maxsize=size)
+	stop=threading.Event()
+	end=object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				queue.put(item,timeout=0.1)
+				return True
+			except Full:
+				pass
+		return False
+
+	def produce():
+		try:
+			for frame in frames:
+				if not put((frame,None)):
+					break
+		except BaseException as error:
+			put((end,error))
+		else:
+			put((end,None))
+		finally:
+			if hasattr(frames,'close'):
+				frames.close()
+
+	thread=threading.Thread(target=produce)
+	thread.daemon=True
+	thread.start()
+	try:
+		while True:
+			frame,error=queue.get()
+			if error is not None:
+				raise error
+			if frame is end:
+				break
+			yield frame
+	finally:
+		stop.set()
+		thread.join()
+
+
+def pointCloudFrames(frames,subsamplingStep=1,averaging=False):
+	"""converts the RGB and XYZ images into colors and points of the object, see pointCloudProcessing.organizedPointCloud"""
+	for array_rgb,array_xyz,pose in frames:
+		points,colors=pointCloudProcessing.organizedPointCloud(array_rgb,array_xyz,subsamplingStep,averaging)
+		yield colors,points,pose
+
+
+def voxelGridFrames(frames,voxelGridSize):
+	"""replaces the points and their colors by their averages in each voxel, see pointCloudProcessing.voxelGridFilter"""
+	for colors,points,pose in frames:
+		points,colors=pointCloudProcessing.voxelGridFilter(np.asarray(points,dtype=np.float64),voxelGridSize,attributes=colors)
+		yield colors,points,pose
@@ -0,0 +1,300 @@
+# This file contains a python implementation of the initial alignment done by pcl/surfaceAlign.cpp: FPFH features
+# computed with vectorized numpy and RANSAC hypotheses evaluated by batches, optionally on a pool of processes.
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+from scipy.spatial import cKDTree
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import pointCloudProcessing
+
+
+def pairFeatures(points1,normals1,points2,normals2):
+	"""the three angular features (f1,f2,f3) of pcl::computePairFeatures for arrays of pairs of oriented points and
+	whether they are defined. The source of the Darboux frame is the point whose normal is the most parallel to
+	the line joining the points, which makes the features symmetric"""
+	delta=points2-points1
+	lengths=np.linalg.norm(delta,axis=1)
+	lengths[lengths==0]=np.inf
+	angles1=np.sum(normals1*delta,axis=1)/lengths
+	angles2=np.sum(normals2*delta,axis=1)/lengths
+	swap=np.abs(angles1)<np.abs(angles2)
+	u=np.where(swap[:,None],normals2,normals1)
+	otherNormals=np.where(swap[:,None],normals1,normals2)
+	delta[swap]*=-1
+	f3=np.where(swap,-angles2,angles1)
+	v=np.cross(delta,u)
+	norms=np.linalg.norm(v,axis=1)
+	valid=np.isfinite(lengths)&(norms>0)
+	norms[~valid]=1
+	v/=norms[:,None]
+	w=np.cross(u,v)
+	f2=np.sum(v*otherNormals,axis=1)
+	f1=np.arctan2(np.sum(w*otherNormals,axis=1),np.sum(u*otherNormals,axis=1))
+	return f1,f2,f3,valid
+
+
+def computeFPFH(points,normals,radius,tree=None,nbBins=11):
+	"""Fast Point Feature Histograms as pcl::FPFHEstimation, returns an array of size N x 3*nbBins.
+	The simplified histograms (SPFH) of all the points are accumulated with a single bincount over the pairs of
+	neighbours, each pair being computed once, and the FPFH is the sum of the SPFH of the neighbours weighted by
+	their inverse squared distance, each of the three histograms being normalized to 100"""
+	points=np.asarray(points,dtype=np.float64)
+	nbPoints=len(points)
+	neighbourhoods=pointCloudProcessing.neighbourhoodMatrix(points,radius,tree)
+	entries=neighbourhoods.tocoo()
+	upper=entries.row<entries.col
+	pairs=np.column_stack((entries.row[upper],entries.col[upper]))
+	f1,f2,f3,valid=pairFeatures(points[pairs[:,0]],normals[pairs[:,0]],points[pairs[:,1]],normals[pairs[:,1]])
+	bins=np.column_stack((np.floor(nbBins*(f1+np.pi)/(2*np.pi)),np.floor(nbBins*(f2+1)*0.5),np.floor(nbBins*(f3+1)*0.5)))
+	bins=np.clip(bins,0,nbBins-1).astype(np.int64)+np.arange(3)*nbBins
+	counts=np.diff(neighbourhoods.indptr)
+	increments=100.0/np.maximum(counts,1)
+	spfh=np.zeros(nbPoints*3*nbBins)
+	for endPoint in range(2):
+		indices=pairs[valid,endPoint]
+		spfh+=np.bincount((indices[:,None]*3*nbBins+bins[valid]).reshape(-1),weights=np.repeat(increments[indices],3),
+			minlength=len(spfh))
+	spfh=spfh.reshape(nbPoints,3*nbBins)
+	weights=neighbourhoods.copy()
+	# as in pcl the duplicated points are not used
+	weights.data=np.divide(1,weights.data**2,out=np.zeros_like(weights.data),where=weights.data>0)
+	fpfh=weights.dot(spfh).reshape(nbPoints,3,nbBins)
+	sums=fpfh.sum(axis=2,keepdims=True)
+	sums[sums==0]=1
+	return (fpfh*(100/sums)).reshape(nbPoints,3*nbBins)
+
+
+def batchRigidTransforms(source,target):
+	"""closed form rigid transforms (Kabsch) of a batch of point sets of size B x n x 3, returns B x 4 x 4 matrices"""
+	sourceCenters=source.mean(axis=1)
+	targetCenters=target.mean(axis=1)
+	H=np.einsum('bki,bkj->bij',source-sourceCenters[:,None],target-targetCenters[:,None])
+	U,S,Vt=np.linalg.svd(H)
+	V=np.swapaxes(Vt,1,2)
+	D=np.ones((len(source),3))
+	D[:,2]=np.sign(np.linalg.det(np.matmul(V,np.swapaxes(U,1,2))))
+	rotations=np.matmul(V*D[:,None,:],np.swapaxes(U,1,2))
+	transforms=np.zeros((len(source),4,4))
+	transforms[:,:3,:3]=rotations
+	transforms[:,:3,3]=targetCenters-np.einsum('bij,bj->bi',rotations,sourceCenters)
+	transforms[:,3,3]=1
+	return transforms
+
+
+def evaluateHypotheses(modelPoints,modelNormals,modelTree,scenePoints,candidates,scoringPoints,seed,batchSize,minSampleDistance,
+		maxCorrespondenceDistance,searchDistance,edgeSimilarity=0.9,nbRefinements=15):
+	"""draws batchSize samples of 3 scene points at least minSampleDistance apart, pairs each with one of its candidate
+	model points chosen at random, rejects the triangles whose edge lengths differ between the scene and the model and
+	scores the scene to model transforms of the others by the fraction of scoringPoints closer than
+	maxCorrespondenceDistance to the tangent plane of their closest model point, searched within searchDistance.
+	Returns the best (inlierFraction,meanSquaredDistance,transform)"""
+	random=np.random.RandomState(seed)
+	samples=random.randint(len(scenePoints),size=(batchSize,3))
+	matches=candidates[samples,random.randint(candidates.shape[1],size=(batchSize,3))]
+	source=scenePoints[samples]
+	target=modelPoints[matches]
+	sourceEdges=np.linalg.norm(source-np.roll(source,1,axis=1),axis=2)
+	targetEdges=np.linalg.norm(target-np.roll(target,1,axis=1),axis=2)
+	keep=np.all(sourceEdges>=minSampleDistance,axis=1)
+	keep&=np.all(np.minimum(sourceEdges,targetEdges)>=edgeSimilarity*np.maximum(sourceEdges,targetEdges),axis=1)
+	if not np.any(keep):
+		return 0.0,np.inf,None
+	transforms=batchRigidTransforms(source[keep],target[keep])
+	fractions,meanSquaredDistances,indices=scoreTransforms(modelPoints,modelNormals,modelTree,scoringPoints,transforms,
+		searchDistance,maxCorrespondenceDistance)
+	best=np.lexsort((meanSquaredDistances,-fractions))[0]
+	result=(float(fractions[best]),float(meanSquaredDistances[best]),transforms[best])
+	# the transform of 3 points is coarse, the best one of the batch is refined by point to point ICP iterations on
+	# the scoring points
+	closest=indices[best]
+	for iteration in range(nbRefinements):
+		found=closest<len(modelPoints)
+		if np.sum(found)<3:
+			break
+		transform=batchRigidTransforms(scoringPoints[None,found],modelPoints[None,closest[found]])
+		fractions,meanSquaredDistances,indices=scoreTransforms(modelPoints,modelNormals,modelTree,scoringPoints,transform,
+			searchDistance,maxCorrespondenceDistance)
+		closest=indices[0]
+		if (fractions[0],-meanSquaredDistances[0])>(result[0],-result[1]):
+			result=(float(fractions[0]),float(meanSquaredDistances[0]),transform[0])
+	return result
+
+
+def scoreTransforms(modelPoints,modelNormals,modelTree,points,transforms,searchDistance,maxCorrespondenceDistance):
+	"""fraction of the points moved by each of the B x 4 x 4 transforms that are closer than maxCorrespondenceDistance
+	to the tangent plane of their closest model point, mean squared distance of these inliers and the indices of the
+	closest model points (len(modelPoints) if none is closer than searchDistance)"""
+	moved=np.einsum('bij,nj->bni',transforms[:,:3,:3],points)+transforms[:,None,:3,3]
+	distances,indices=modelTree.query(moved,distance_upper_bound=searchDistance)
+	found=np.isfinite(distances)
+	# the distance to the closest vertex is dominated by the spacing of the vertices of the model
+	closest=np.where(found,indices,0)
+	distances=np.abs(np.sum(modelNormals[closest]*(moved-modelPoints[closest]),axis=2))
+	inliers=found&(distances<maxCorrespondenceDistance)
+	squaredDistances=np.where(inliers,distances,0)**2
+	return inliers.mean(axis=1),squaredDistances.sum(axis=1)/np.maximum(inliers.sum(axis=1),1),indices
+
+
+def estimateModelNormals(modelPoints,modelNormals,RadiusSearch,tree=None):
+	"""normals of the model points estimated as for the scene, so that the features of both are comparable, and
+	oriented as the mesh normals if they are given or away from the center of the model"""
+	normals=pointCloudProcessing.estimateNormals(modelPoints,RadiusSearch,modelPoints.mean(axis=0),tree)
+	if modelNormals is not None:
+		normals[np.sum(normals*modelNormals,axis=1)<0]*=-1
+	else:
+		normals*=-1
+	return normals
+
+
+def computeModelFeatures(modelPoints,modelNormals,RadiusSearch,featureRadius,tree=None):
+	"""FPFH features of the model points, modelNormals are the normals of the mesh or None"""
+	normals=estimateModelNormals(modelPoints,modelNormals,RadiusSearch,tree)
+	return computeFPFH(modelPoints,normals,featureRadius,tree)
+
+
+workerData={}
+
+
+def initWorker(modelPoints,modelNormals):
+	"""builds the model KD-tree once in each process of the pool"""
+	workerData['modelPoints']=modelPoints
+	workerData['modelNormals']=modelNormals
+	workerData['modelTree']=cKDTree(modelPoints)
+
+
+def evaluateHypothesesInWorker(*args):
+	return evaluateHypotheses(workerData['modelPoints'],workerData['modelNormals'],workerData['modelTree'],*args)
+
+
+class GlobalRegistration():
+	"""Initial alignment of a rigid model in a point cloud without prior on the pose, as the
+	SampleConsensusInitialAlignment of surfaceAlign.cpp: the scene is downsampled with a voxel grid, the FPFH
+	features of the scene points are matched to the nbCandidates closest model features and RANSAC hypotheses
+	made of 3 matches are drawn by batches of batchSize. The batches are evaluated on a pool of nbWorkers processes
+	(in the calling process if nbWorkers is 0) and the search stops as soon as a hypothesis has inlierFraction of the
+	scoring scene points within maxCorrespondenceDistance of the model surface, or after maxIterations hypotheses.
+	The model normals and features are computed once in the constructor, or given with modelFeatures and the KD-trees
+	of the model points and features, see modelCache"""
+
+	def __init__(self,modelPoints,modelNormals=None,RadiusSearch=0.05,featureRadius=0.1,voxelGridSize=None,minSampleDistance=0.05,
+			maxCorrespondenceDistance=0.02,maxIterations=20000,inlierFraction=0.9,batchSize=500,nbCandidates=5,nbScoringPoints=300,
+			nbWorkers=None,modelFeatures=None,modelTree=None,featureTree=None):
+		self.modelPoints=np.asarray(modelPoints,dtype=np.float64)
+		self.RadiusSearch=RadiusSearch
+		self.featureRadius=featureRadius
+		self.voxelGridSize=voxelGridSize
+		self.minSampleDistance=minSampleDistance
+		self.maxCorrespondenceDistance=maxCorrespondenceDistance
+		self.maxIterations=maxIterations
+		self.inlierFraction=inlierFraction
+		self.batchSize=batchSize
+		self.nbCandidates=nbCandidates
+		self.nbScoringPoints=nbScoringPoints
+		self.nbWorkers=os.cpu_count() if nbWorkers is None else nbWorkers
+		self.modelTree=cKDTree(self.modelPoints) if modelTree is None else modelTree
+		self.modelSpacing=float(np.median(self.modelTree.query(self.modelPoints,k=2)[0][:,1]))
+		if modelNormals is None:
+			modelNormals=estimateModelNormals(self.modelPoints,None,RadiusSearch,self.modelTree)
+		self.modelNormals=np.asarray(modelNormals,dtype=np.float64)
+		if modelFeatures is None:
+			modelFeatures=computeModelFeatures(self.modelPoints,self.modelNormals,RadiusSearch,featureRadius,self.modelTree)
+		self.modelFeatures=modelFeatures
+		self.featureTree=cKDTree(modelFeatures) if featureTree is None else featureTree
+		self.pool=None
+
+	def sceneFeatures(self,scenePoints):
+		"""downsampled scene points and their FPFH features, the normals are oriented toward the camera"""
+		points=pointCloudProcessing.validPoints(scenePoints).astype(np.float64)
+		if self.voxelGridSize:
+			points=pointCloudProcessing.voxelGridFilter(points,self.voxelGridSize)
+		tree=cKDTree(points)
+		normals=pointCloudProcessing.estimateNormals(points,self.RadiusSearch,(0,0,0),tree)
+		return points,computeFPFH(points,normals,self.featureRadius,tree)
+
+	def align(self,scenePoints,seed=0):
+		"""returns the pose of the model (4x4 model to camera transform) and a dictionary with the number of
+		hypotheses, the inlier fraction of the best one and whether the search stopped early"""
+		points,features=self.sceneFeatures(scenePoints)
+		if len(points)<3:
+			raise ValueError('not enough scene points for the initial alignment')
+		nbCandidates=min(self.nbCandidates,len(self.modelFeatures))
+		candidates=self.featureTree.query(features,k=nbCandidates)[1].reshape(len(points),nbCandidates)
+		random=np.random.RandomState(seed)
+		scoringPoints=points[random.permutation(len(points))[:self.nbScoringPoints]]
+		nbBatches=max(1,-(-self.maxIterations//self.batchSize))
+		arguments=[(points,candidates,scoringPoints,seed*nbBatches+idBatch,self.batchSize,self.minSampleDistance,
+			self.maxCorrespondenceDistance,self.maxCorrespondenceDistance+self.modelSpacing) for idBatch in range(nbBatches)]
+		best=(0.0,np.inf,None)
+		nbHypotheses=0
+		if self.nbWorkers<=1:
+			for args in arguments:
+				result=evaluateHypotheses(self.modelPoints,self.modelNormals,self.modelTree,*args)
+				nbHypotheses+=self.batchSize
+				best=max(best,result,key=lambda result:(result[0],-result[1]))
+				if best[0]>=self.inlierFraction:
+					break
+		else:
+			if self.pool is None:
+				self.pool=ProcessPoolExecutor(self.nbWorkers,initializer=initWorker,initargs=(self.modelPoints,self.modelNormals))
+			# at most two batches per worker are pending, so that the remaining ones are not submitted after an early exit
+			arguments=iter(arguments)
+			pending=set()
+			while True:
+				for args in arguments:
+					pending.add(self.pool.submit(evaluateHypothesesInWorker,*args))
+					if len(pending)>=2*self.nbWorkers:
+						break
+				if not pending:
+					break
+				done,pending=wait(pending,return_when=FIRST_COMPLETED)
+				for future in done:
+					nbHypotheses+=self.batchSize
+					best=max(best,future.result(),key=lambda result:(result[0],-result[1]))
+				if best[0]>=self.inlierFraction:
+					for future in pending:
+						future.cancel()
+					break
+		if best[2] is None:
+			raise ValueError('no valid hypothesis found for the initial alignment')
+		info=dict([('hypotheses',nbHypotheses),('inlierFraction',best[0]),('fitness',best[1]),('converged',best[0]>=self.inlierFraction)])
+		return pointCloudProcessing.invertRigidTransform(best[2]),info
+
+	def close(self):
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool=None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
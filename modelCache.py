@@ -0,0 +1,159 @@
+# This file contains an on disk cache of the processed models used by the tracking: points, normals and FPFH features,
+# keyed by the content of the OBJ file and the parameters, with least recently used eviction.
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+import json
+import hashlib
+from scipy.spatial import cKDTree
+import pointCloudIO
+import pointCloudProcessing
+import globalRegistration
+
+modelCacheVersion=2
+
+
+class ModelCache():
+	"""Folder of npz files, one per key, limited to maxSize bytes in total. The modification time of a file is
+	updated each time it is loaded and the least recently used files are removed first when the limit is exceeded.
+	Only arrays are stored, the cache folder should only be written by this class"""
+
+	def __init__(self,folder='cache',maxSize=1<<30):
+		self.folder=folder
+		self.maxSize=maxSize
+
+	def key(self,objFile,parameters):
+		"""hash of the content of the OBJ file and of the parameters, which must be serializable in JSON"""
+		with open(objFile,'rb') as f:
+			contentHash=hashlib.sha1(f.read()).hexdigest()
+		description=json.dumps([modelCacheVersion,contentHash,parameters],sort_keys=True)
+		return hashlib.sha1(description.encode('ascii')).hexdigest()
+
+	def fileName(self,key):
+		return os.path.join(self.folder,key+'.npz')
+
+	def load(self,key):
+		"""returns the dictionary of arrays saved with key, or None if it is not in the cache or cannot be read"""
+		fileName=self.fileName(key)
+		if not os.path.exists(fileName):
+			return None
+		try:
+			with np.load(fileName) as cache:
+				assets=dict((name,cache[name]) for name in cache.files)
+			os.utime(fileName)
+		except Exception:
+			# a truncated or incompatible file is treated as a miss and computed again
+			return None
+		return assets
+
+	def save(self,key,assets):
+		"""saves a dictionary of arrays and evicts the least recently used files. Nothing is saved if the folder
+		cannot be written"""
+		fileName=self.fileName(key)
+		temporaryFileName=fileName+'.%d.tmp.npz'%os.getpid()
+		try:
+			if not os.path.exists(self.folder):
+				os.makedirs(self.folder)
+			np.savez(temporaryFileName,**assets)
+			os.replace(temporaryFileName,fileName)
+		except (IOError,OSError):
+			if os.path.exists(temporaryFileName):
+				os.remove(temporaryFileName)
+			return
+		self.evict(keep=fileName)
+
+	def entries(self):
+		"""the cache files with their size and last use time, from the least to the most recently used"""
+		if not os.path.exists(self.folder):
+			return []
+		entries=[]
+		for name in os.listdir(self.folder):
+			if name.endswith('.npz') and not name.endswith('.tmp.npz'):
+				fileName=os.path.join(self.folder,name)
+				stat=os.stat(fileName)
+				entries.append((stat.st_mtime,stat.st_size,fileName))
+		entries.sort()
+		return entries
+
+	def evict(self,keep=None):
+		"""removes the least recently used files until the total size is below maxSize, except the file keep"""
+		entries=self.entries()
+		totalSize=sum(size for time,size,fileName in entries)
+		for time,size,fileName in entries:
+			if totalSize<=self.maxSize:
+				break
+			if fileName==keep:
+				continue
+			try:
+				os.remove(fileName)
+				totalSize-=size
+			except OSError:
+				pass
+
+	def clear(self):
+		for time,size,fileName in self.entries():
+			os.remove(fileName)
+
+
+def computeModelAssets(objFile,RadiusSearch=None,featureRadius=None):
+	"""points and normals of the vertices of the OBJ file and the KD-tree of the points, and if RadiusSearch and
+	featureRadius are given the FPFH features of the points and their KD-tree"""
+	vertices,texcoords,normals,faces=pointCloudIO.loadOBJ(objFile)
+	points=vertices.astype(np.float64)
+	assets=dict([('points',points),('normals',pointCloudProcessing.computeVertexNormals(points,faces[:,:,0])),('modelTree',cKDTree(points))])
+	if RadiusSearch is not None and featureRadius is not None:
+		assets['features']=globalRegistration.computeModelFeatures(points,assets['normals'],RadiusSearch,featureRadius,assets['modelTree'])
+		assets['featureTree']=cKDTree(assets['features'])
+	return assets
+
+
+def buildTrees(assets):
+	"""adds the KD-trees of the points and of the features to assets loaded from the cache"""
+	assets['modelTree']=cKDTree(assets['points'])
+	if 'features' in assets:
+		assets['featureTree']=cKDTree(assets['features'])
+	return assets
+
+
+def loadModelAssets(objFile,RadiusSearch=None,featureRadius=None,cache=None):
+	"""see computeModelAssets, the assets are loaded from the ModelCache cache if they have already been computed
+	with the same OBJ file content and parameters. The KD-trees are not stored in the cache but built again, which is
+	fast compared to the features and does not depend on the pickle format of scipy"""
+	if cache is None:
+		return computeModelAssets(objFile,RadiusSearch,featureRadius)
+	key=cache.key(objFile,dict([('RadiusSearch',RadiusSearch),('featureRadius',featureRadius)]))
+	assets=cache.load(key)
+	if assets is not None:
+		return buildTrees(assets)
+	assets=computeModelAssets(objFile,RadiusSearch,featureRadius)
+	cache.save(key,dict((name,value) for name,value in assets.items() if not name.endswith('Tree')))
+	return assets
@@ -1,5 +1,181 @@
 import numpy as np
+import itertools
+import os
+import re
+import hashlib
+import RGBDSequenceIO
 #from  camera import RigidTransform3D
+try:
+	import lzf # python-lzf, binding to liblzf, much faster than the pure python fallback below
+except ImportError:
+	lzf=None
+
+def lzfDecompressPython(data,uncompressedSize):
+	"""pure python LZF decompression, used when python-lzf is not installed"""
+	data=bytes(data)
+	out=bytearray()
+	i=0
+	while i<len(data):
+		ctrl=data[i]
+		i+=1
+		if ctrl<32:
+			# literal run of ctrl+1 bytes
+			out+=data[i:i+ctrl+1]
+			i+=ctrl+1
+		else:
+			# back reference
+			length=ctrl>>5
+			if length==7:
+				length+=data[i]
+				i+=1
+			ref=len(out)-((ctrl&0x1f)<<8)-data[i]-1
+			i+=1
+			length+=2
+			if ref<0:
+				raise ValueError('invalid LZF data')
+			while length>0:
+				# the reference can overlap the bytes being written
+				chunk=out[ref:ref+min(length,len(out)-ref)]
+				out+=chunk
+				ref+=len(chunk)
+				length-=len(chunk)
+	if len(out)!=uncompressedSize:
+		raise ValueError('LZF data decompressed to %d bytes instead of %d'%(len(out),uncompressedSize))
+	return bytes(out)
+
+def lzfCompressPython(data):
+	"""pure python LZF compression, used when python-lzf is not installed. Greedy matching of 3-byte sequences
+	with back references of at most 264 bytes up to 8192 bytes behind, as in liblzf"""
+	data=bytes(data)
+	n=len(data)
+	out=bytearray()
+	lastPosition=dict()
+	def writeLiterals(start,end):
+		for s in range(start,end,32):
+			e=min(s+32,end)
+			out.append(e-s-1)
+			out.extend(data[s:e])
+	i=0
+	literalStart=0
+	while i<n-2:
+		key=data[i:i+3]
+		ref=lastPosition.get(key)
+		lastPosition[key]=i
+		if ref is not None and i-ref<=8192:
+			maxLength=min(264,n-i)
+			length=3
+			while length<maxLength and data[ref+length]==data[i+length]:
+				length+=1
+			writeLiterals(literalStart,i)
+			offset=i-ref-1
+			if length-2<7:
+				out.append(((length-2)<<5)|(offset>>8))
+			else:
+				out.append((7<<5)|(offset>>8))
+				out.append(length-2-7)
+			out.append(offset&0xff)
+			i+=length
+			literalStart=i
+		else:
+			i+=1
+	writeLiterals(literalStart,n)
+	return bytes(out)
+
+def lzfCompress(data):
+	if len(data)==0:
+		return b''
+	if lzf is None:
+		return lzfCompressPython(data)
+	# the maximum length allows for the worst case expansion of incompressible data
+	compressed=lzf.compress(data,len(data)+len(data)//16+64)
+	if compressed is None:
+		# python-lzf returns None when the output does not fit in the maximum length
+		return lzfCompressPython(data)
+	return compressed
+
+def lzfDecompress(data,uncompressedSize):
+	if uncompressedSize==0:
+		return b''
+	if lzf is None:
+		return lzfDecompressPython(data,uncompressedSize)
+	return lzf.decompress(data,uncompressedSize)
+
+def writeFormattedRows(f,rowFormat,columns,chunkSize=100000):
+	"""writes a table in text format, row i being rowFormat%(columns[0][i],columns[1][i],...)
+	the rows are formatted chunkSize at a time using a single string formatting operation for the whole chunk
+	instead of one per row, which bounds the memory used while removing most of the python overhead.
+	The columns are 1D numpy arrays, they are converted to python scalars so that the formatting gives the same
+	strings as the % operator applied on numpy scalars"""
+	nbRows=len(columns[0])
+	for start in range(0,nbRows,chunkSize):
+		end=min(start+chunkSize,nbRows)
+		values=[]
+		for column in columns:
+			chunk=column[start:end]
+			if chunk.dtype.kind=='f' and chunk.dtype!=np.float64:
+				chunk=chunk.astype(np.float64)
+			values.append(chunk.tolist())
+		f.write((rowFormat+'\n')*(end-start)%tuple(itertools.chain.from_iterable(zip(*values))))
+
+def formatPTXHeader(nbColumns,nbRows,transformMtx):
+	"""the ten header lines of a scan: the grid size, the scanner position, the scanner axes and a 4x4 matrix
+	holding the rotation"""
+	lines=['%d'%nbColumns,'%d'%nbRows,'%.5f %.5f %.5f'%tuple(transformMtx[:,3])]
+	for row in transformMtx[:3,:3].T:
+		lines.append('%.5f %.5f %.5f'%tuple(row))
+	M=np.zeros((4,4))
+	M[3,3]=1
+	M[:3,:3]=transformMtx[:3,:3].T
+	for row in M:
+		lines.append('%.5f %.5f %.5f %.5f'%tuple(row))
+	return '\n'.join(lines)+'\n'
+
+class PTXWriter():
+	"""writes a PTX file with one or several scans, each scan being written at once with writeScan or streamed by blocks
+	of columns with beginScan and writeColumns, as the points are stored one column after another in the file.
+	The rows are formatted by chunks using writeFormattedRows"""
+
+	def __init__(self,filename):
+		self.file=open(filename,'w')
+		self.nbMissingColumns=0
+
+	def beginScan(self,nbColumns,nbRows,transformMtx=None):
+		if self.nbMissingColumns>0:
+			raise ValueError('%d columns of the previous scan have not been written'%self.nbMissingColumns)
+		if transformMtx is None:
+			transformMtx=np.column_stack((np.eye(3),np.zeros((3,1))))
+		self.transformMtx=transformMtx
+		self.nbRows=nbRows
+		self.nbMissingColumns=nbColumns
+		self.file.write(formatPTXHeader(nbColumns,nbRows,transformMtx))
+
+	def writeColumns(self,points,colors=None):
+		"""writes the next columns points[:,j] of the current scan, points being an array of size nbRows x nbColumnsInBlock x 3"""
+		assert points.shape[2]==3
+		if points.shape[0]!=self.nbRows or points.shape[1]>self.nbMissingColumns:
+			raise ValueError('the block of columns does not fit in the scan')
+		pointsInScannerCoordinateSystem=(points-self.transformMtx[:,3]).dot(self.transformMtx[:3,:3].T)# the ptx format seems to have the convention that the point are goiven in the scaner coordinate system
+		if colors is None:
+			colors=np.ones((points.shape[0],points.shape[1],3),dtype=np.uint8)*np.array([127,127,127])
+		p=np.dstack((np.flipud(pointsInScannerCoordinateSystem),np.ones((points.shape[0],points.shape[1],1),dtype=np.uint8),np.flipud(colors)))
+		p=np.transpose(p,[1,0,2]).reshape(-1,7)
+		writeFormattedRows(self.file,'%.5f %.5f %.5f %d %d %d %d',[p[:,k] for k in range(7)])
+		self.nbMissingColumns-=points.shape[1]
+
+	def writeScan(self,points,colors=None,transformMtx=None):
+		self.beginScan(points.shape[1],points.shape[0],transformMtx)
+		self.writeColumns(points,colors)
+
+	def close(self):
+		self.file.close()
+		if self.nbMissingColumns>0:
+			raise ValueError('%d columns of the last scan have not been written'%self.nbMissingColumns)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,*args):
+		self.close()
 
 def savePTX(filename,points,colors=None,transformMtx=None):
 	"""export data to the leica ptx format
@@ -9,56 +185,81 @@ def savePTX(filename,points,colors=None,transformMtx=None):
 	2 5 8
 	3 6 9
 	"""
-	if transformMtx is None:
-		transformMtx=np.column_stack((np.eye(3),np.zeros((3,1))))
-	pointsInScannerCoordinateSystem=(points-transformMtx[:,3]).dot(transformMtx[:3,:3].T)# the ptx format seems to have the convention that the point are goiven in the scaner coordinate system
-	with open(filename, 'w') as f:
-		assert points.shape[2]==3
-		f.write(str(points.shape[1])+'\n')
-		f.write(str(points.shape[0])+'\n')
-		np.savetxt(f,transformMtx[:,3].reshape([1,3]),'%.5f')
-		np.savetxt(f,transformMtx[:3,:3].T,'%.5f')
-		M=np.zeros((4,4))
-		M[3,3]=1
-		M[:3,:3]=transformMtx[:3,:3].T
-		np.savetxt(f,M,'%.5f')
-		if colors is None:
-			colors=np.ones((points.shape[0],points.shape[1],3),dtype=np.uint8)*np.array([127,127,127])
-		p=np.dstack((np.flipud(pointsInScannerCoordinateSystem),np.ones((points.shape[0],points.shape[1],1),dtype=np.uint8),np.flipud(colors)))
-		np.savetxt(f,np.transpose(p,[1,0,2]).reshape(-1,7),'%.5f %.5f %.5f %d %d %d %d')
+	with PTXWriter(filename) as writer:
+		writer.writeScan(points,colors,transformMtx)
 
+def readLineBlocks(f,nbLines,blockSize=1<<22):
+	"""reads the next nbLines lines of the binary file f by blocks of about blockSize bytes, yields bytes objects
+	made of complete lines and leaves f at the start of the line that follows"""
+	remaining=nbLines
+	pending=b''
+	while remaining>0:
+		block=f.read(blockSize)
+		data=pending+block
+		if len(block)==0:
+			# last line without end of line character
+			if len(data.strip())>0 and remaining==1:
+				yield data
+				return
+			raise ValueError('unexpected end of file, %d lines are missing'%remaining)
+		newlines=np.flatnonzero(np.frombuffer(data,dtype=np.uint8)==10)
+		if len(newlines)>=remaining:
+			end=newlines[remaining-1]+1
+			f.seek(end-len(data),os.SEEK_CUR)
+			yield data[:end]
+			return
+		if len(newlines)>0:
+			end=newlines[-1]+1
+			yield data[:end]
+			remaining-=len(newlines)
+			data=data[end:]
+		pending=data
 
+def iterPTXScans(filename,transform_the_points=True,blockSize=1<<22):
+	"""reads the scans of a PTX file one after the other and yields (points,colors,transformMtx) for each of them,
+	so that files with many scans can be read without loading them all. transformMtx is the 3x4 matrix given to
+	savePTX and colors is None if the points have no color. The numbers are parsed by blocks of lines with the
+	bytes tokenizer of python and a single conversion to float per block"""
+	with open(filename,'rb') as f:
+		while True:
+			line=f.readline()
+			while line.isspace():
+				line=f.readline()
+			if len(line)==0:
+				return
+			nbcols=int(line)
+			nblines=int(f.readline())
+			header=np.array(b''.join([f.readline() for i in range(8)]).split(),dtype=np.float64)
+			translation=header[:3]
+			rotation=header[3:12].reshape(3,3).T
+			blocks=[]
+			for block in readLineBlocks(f,nbcols*nblines,blockSize):
+				blocks.append(np.array(block.split(),dtype=np.float64))
+			data=np.concatenate(blocks)
+			nbFields=data.size//(nbcols*nblines)
+			points_with_color=data.reshape(nbcols*nblines,nbFields)
+			pointsInScannerCoordinateSystem=np.transpose(points_with_color[:,:3].reshape((nbcols,nblines,3)),[1,0,2])[::-1,:,:]
+			if transform_the_points:
+				points=pointsInScannerCoordinateSystem.dot(rotation)+translation# the ptx format seems to have the convention that the point are goiven in the scaner coordinate system
+			else:
+				points=pointsInScannerCoordinateSystem
+			if nbFields>=7:
+				colors=np.transpose(points_with_color[:,4:7].reshape((nbcols,nblines,3)).astype(int),[1,0,2])[::-1,:,:]
+			else:
+				colors=None
+			yield points,colors,np.column_stack((rotation,translation))
 
 def loadPTX(filename,transform_the_points=True):
-	with open(filename, 'r') as f:
-
-		nbcols=int(f.readline())
-		nblines=int(f.readline())
-		#print (nblines)
-		#print (nbcols)
-
-		#np.loadtxt does not allow yet to specify a number of rows, np ticket 1731.
-		#http://np-discussion.10968.n7.nabble.com/using-loadtxt-for-given-number-of-rows-td3635.html
-		translation=np.fromfile(f, sep=' ', count=3)
-		rotation=np.fromfile(f, sep=' ', count=9).reshape(3,3).T
-		print (rotation)
-		M=np.fromfile(f, sep=' ', count=16).reshape(4,4)		
-		#transform=RigidTransform3D(rotation,translation,fix_rotation=True)
-		data=np.fromfile(f,  sep=' ',count=-1)
-		points_with_color=data.reshape(-1,7)
-		pointsInScannerCoordinateSystem=np.transpose(points_with_color[:,:3].reshape((nbcols,nblines,3)),[1,0,2])[::-1,:,:]
-		if transform_the_points:
-			points=transform.apply(pointsInScannerCoordinateSystem)# the ptx format seems to have the convention that the point are goiven in the scaner coordinate system
-		else: 
-			points=pointsInScannerCoordinateSystem
-		colors=np.transpose(points_with_color[:,4:7].reshape((nbcols,nblines,3)).astype(int),[1,0,2])[::-1,:,:]
-
-		return points, colors , transform
+	"""reads the first scan of a PTX file, returns points, colors and the 3x4 transform, see iterPTXScans"""
+	for points,colors,transform in iterPTXScans(filename,transform_the_points):
+		return points,colors,transform
+	raise ValueError('%s does not contain any scan'%filename)
 
 def savePCD(filename,transform,points,colors, data=None,format='ascii'):
 	"""export data to the Point Cloud Library PCD format
 	the file can then be visualized using the pcl executable pcd_viewer that can be called from the terminal
-	there seem to be a problem with the exportation of the point colors..."""
+	there seem to be a problem with the exportation of the point colors...
+	format can be 'ascii', 'binary' or 'binary_compressed' (LZF compression, as written by PCL)"""
 	
 	
 	fields_str = 'x y z rgb'
@@ -76,8 +277,8 @@ def savePCD(filename,transform,points,colors, data=None,format='ascii'):
 		typeconversion[np.int32]=('I',4)		
 		typeconversion[np.uint8]=('U',1)	
 		typeconversion[np.uint16]=('U',2)		
-		type+=' '+' '.join([typeconversion[d.dtype.type][0] for d in data.itervalues()])
-		size+=' '+' '.join([str(typeconversion[d.dtype.type][1]) for d in data.itervalues()])
+		type+=' '+' '.join([typeconversion[d.dtype.type][0] for d in data.values()])
+		size+=' '+' '.join([str(typeconversion[d.dtype.type][1]) for d in data.values()])
 		count+=' 1'*len(data.keys())
 	
 	with open(filename, 'w') as f:
@@ -108,27 +309,29 @@ def savePCD(filename,transform,points,colors, data=None,format='ascii'):
 		#convert rgb clors to the weird float format
 		colors_unint32=colors.astype(np.uint32)
 		rgb_int = (colors_unint32[:,:,0] << 16) | (colors_unint32[:,:,1] << 8) | (colors_unint32[:,:,2])
-		s=np.ndarray.tostring(rgb_int)
-		colors_float=np.fromstring(s,dtype=np.float32).reshape((colors.shape[0],colors.shape[1]))
+		colors_float=np.ascontiguousarray(rgb_int).view(np.float32).reshape((colors.shape[0],colors.shape[1]))
 				
 			
 		if format=='ascii':
 			f.write('DATA ascii\n')
-			for i in range(points.shape[0]):
-				for j in range(points.shape[1]):
-					p=points[i,j]
-					
-					rgb_string= "%.8e"%	colors_float[i,j]
-					s='%.7f'%p[0]+' '+'%.7f'%p[1]+' '+'%.7f'%p[2]+' '+rgb_string
-					if data:
-						for k in data.keys():
-							s+=' '+str(data[k][i,j])
-					f.write(s+'\n')	
-		elif format=='binary':
-			f.write('DATA binary\n')
+			columns=[points[:,:,0].ravel(),points[:,:,1].ravel(),points[:,:,2].ravel(),colors_float.ravel()]
+			rowFormat='%.7f %.7f %.7f %.8e'
+			if data:
+				for k in data.keys():
+					column=np.asarray(data[k]).ravel()
+					if column.dtype.kind in 'iu':
+						columns.append(column)
+						rowFormat+=' %d'
+					else:
+						# same strings as str() applied on each numpy scalar
+						columns.append(column.astype(str))
+						rowFormat+=' %s'
+			writeFormattedRows(f,rowFormat,columns)
+		elif format in ['binary','binary_compressed']:
+			f.write('DATA '+format+'\n')
 			if data is not None:
-				nptypes=[np.float32]*4+[d.dtype.type for d in data.itervalues()]
-				fieldnames=['x','y','z','rgb']+data.keys()
+				nptypes=[np.float32]*4+[d.dtype.type for d in data.values()]
+				fieldnames=['x','y','z','rgb']+list(data.keys())
 				
 			else:
 				nptypes=[np.float32]*4
@@ -142,121 +345,277 @@ def savePCD(filename,transform,points,colors, data=None,format='ascii'):
 			if data is not None:
 				for k in data.keys():
 					DataArray[k]=data[k]
-			DataArray.tofile(f)
+			if format=='binary':
+				DataArray.tofile(f)
+			else:
+				# PCL stores each field contiguously before compressing, followed by the next field
+				uncompressed=b''.join([np.ascontiguousarray(DataArray[name]).tobytes() for name in fieldnames])
+				compressed=lzfCompress(uncompressed)
+				f.flush()
+				f.buffer.write(np.array([len(compressed),len(uncompressed)],dtype='<u4').tobytes())
+				f.buffer.write(compressed)
 		else:
 			print( "unkown format")
 			raise
 		
 
 
-def loadPCD(filename,default_color=[128,128,128]):
+def readPCDHeader(f):
+	"""parses the header of a PCD file opened in binary mode, the file is then positioned at the start of the data.
+	Returns the header entries, the custom maps, the data format and the structured dtype of a point"""
 	header_dict=dict()
 	maps=dict()
-	with open(filename, 'r') as f:
-		while True:
-			line=f.readline()
-			line = line.rstrip('\n')
-			line = line.rstrip('\r')
-			t=line.split(' ')
-			if t[0][0]=='#':
-				if t[1]=='map:': # this is not part of the PCD format , but is a custom way to save some information
-					e=t[3].split(':')
-					if not(t[2] in maps):
-						maps[t[2]]=dict()
-					maps[t[2]][int(e[0])]=e[1]
-				else:
-					continue
-			if t[0]=='DATA':
-				datatype=t[1]
-				break
-			else :
-				header_dict[t[0]]=t[1:]
-
-		#Data=numpy.empty((header_dict['WIDTH'],header_dict['HEIGHT']),dtype=float)
-		nbPoints=int(header_dict['POINTS'][0])
+	while True:
+		line=f.readline()
+		if len(line)==0:
+			raise ValueError('unexpected end of file in the PCD header')
+		line=line.decode('ascii').rstrip('\r\n')
+		if len(line)==0:
+			continue
+		t=line.split(' ')
+		if t[0][0]=='#':
+			if t[1]=='map:': # this is not part of the PCD format , but is a custom way to save some information
+				e=t[3].split(':')
+				if not(t[2] in maps):
+					maps[t[2]]=dict()
+				maps[t[2]][int(e[0])]=e[1]
+			else:
+				continue
+		if t[0]=='DATA':
+			datatype=t[1]
+			break
+		else :
+			header_dict[t[0]]=t[1:]
 
+	py_types=[]
+	for field,type,size,count in zip(header_dict['FIELDS'],header_dict['TYPE'],header_dict['SIZE'],header_dict['COUNT']):
+		
+		if type=='F':
+			if size=='4':
+				py_type=np.float32
+			else:
+				print ('not coded yet')
+		elif  type=='U':
+			if size=='4':
+				py_type=np.uint32
+			elif size=='1':
+				py_type=np.uint8
+			elif size=='2':
+				py_type=np.uint16
+			else:
+				print ('not coded yet')
+		elif  type=='I':
+			if size=='4':
+				py_type=np.int32
+			else:
+				print( 'not coded yet')
+		py_types.append(py_type)		
+	dt = np.dtype([(field,py_type) if int(count)==1 else (field,py_type,(int(count),)) for field,py_type,count in zip(header_dict['FIELDS'],py_types,header_dict['COUNT'])])
+	return header_dict,maps,datatype,dt
 
-		py_types=[]
-		for field,type,size,count in zip(header_dict['FIELDS'],header_dict['TYPE'],header_dict['SIZE'],header_dict['COUNT']):
-			
-			if type=='F':
-				if size=='4':
-					py_type=np.float32
-				else:
-					print ('not coded yet')
-			elif  type=='U':
-				if size=='4':
-					py_type=np.uint32
-				elif size=='1':
-					py_type=np.uint8
-				elif size=='2':
-					py_type=np.uint16
-				else:
-					print ('not coded yet')
-			elif  type=='I':
-				if size=='4':
-					py_type=np.int32
-				else:
-					print( 'not coded yet')
-			py_types.append(py_type)		
-		dt = np.dtype(list(zip(header_dict['FIELDS'],py_types)))
-		Data=dict()
-		if datatype=='ascii':
-			DataArray=np.fromfile(f,  sep=' ',count=-1).reshape(nbPoints,-1)
-
-			nbFields=len(header_dict['FIELDS'])
-			col=0	
-			for field,py_type,count in zip(header_dict['FIELDS'],py_types,header_dict['COUNT']):	
-				if int(count)>1:
-					Data[field]=DataArray[:,col:col+int(count)].astype(py_type)
-				else:
-					Data[field]=DataArray[:,col].astype(py_type)
-				col+=int(count)			
-		elif  datatype=='binary':	
-			DataArray=np.fromfile(f, dtype=dt,count=nbPoints)
-			for key in header_dict['FIELDS']:
-				Data[key]=DataArray[key]
-		elif datatype=='binary_compressed':
-			print ('not yet coded looking at http://www.mathworks.fr/matlabcentral/fileexchange/40382-matlab-to-point-cloud-library/ it seem like it used lzf compression so we could use https://pypi.python.org/pypi/python-lzf')
-			raise
-		else:
-			print ('loading type '+ datatype+' not yet coded')
-			raise
+def readPCDBody(f,header_dict,datatype,dt):
+	"""reads the data of a PCD file positioned after its header and returns a dictionary with one array per field"""
+	nbPoints=int(header_dict['POINTS'][0])
+	Data=dict()
+	if datatype=='ascii':
+		nbFields=len(header_dict['FIELDS'])
+		DataArray=np.fromfile(f,  sep=' ',count=-1).reshape(nbPoints,sum([int(count) for count in header_dict['COUNT']]))
+
+		col=0	
+		for field,py_type,count in zip(header_dict['FIELDS'],[dt.fields[field][0].base for field in header_dict['FIELDS']],header_dict['COUNT']):	
+			if int(count)>1:
+				Data[field]=DataArray[:,col:col+int(count)].astype(py_type)
+			else:
+				Data[field]=DataArray[:,col].astype(py_type)
+			col+=int(count)			
+	elif  datatype=='binary':	
+		DataArray=np.fromfile(f, dtype=dt,count=nbPoints)
+		for key in header_dict['FIELDS']:
+			Data[key]=DataArray[key]
+	elif datatype=='binary_compressed':
+		compressedSize,uncompressedSize=np.frombuffer(f.read(8),dtype='<u4')
+		uncompressed=lzfDecompress(f.read(int(compressedSize)),int(uncompressedSize))
+		# the fields are stored one after the other, each one contiguously for all the points
+		DataArray=np.empty(nbPoints,dtype=dt)
+		offset=0
+		for key in header_dict['FIELDS']:
+			fieldType=dt.fields[key][0]
+			DataArray[key]=np.frombuffer(uncompressed,dtype=fieldType.base,count=nbPoints*int(np.prod(fieldType.shape)),offset=offset).reshape((nbPoints,)+fieldType.shape)
+			offset+=nbPoints*fieldType.itemsize
+		for key in header_dict['FIELDS']:
+			Data[key]=DataArray[key]
+	else:
+		print ('loading type '+ datatype+' not yet coded')
+		raise
+	return Data
+
+def unpackPCDColors(Data,nbPoints,default_color=[128,128,128]):
+	"""converts the rgb field of a PCD file into a (nbPoints,3) array of colors"""
+	colors=np.empty((nbPoints,3),dtype=np.uint8)
+	if 'rgb' in Data:
+		rgb_int=np.ascontiguousarray(Data['rgb']).view(np.int32)
+
+			#from http://www.pointclouds.org/documentation/tutorials/adding_custom_ptype.php:
+			# "The reason why rgb data is being packed as a float comes from the early development
+			#o f PCL as part of the ROS project, where RGB data is still being sent by wire as 
+			#float numbers. We expect this data type to be dropped as soon as all legacy code has 
+			#been rewritten (most likely in PCL 2.x).
+		colors=np.column_stack(((rgb_int>>16)& 0x0000ff,(rgb_int>>8)& 0x0000ff,(rgb_int)& 0x0000ff))
+	elif   'rgba' in Data:
+		print ('not et coded')
+		colors[:,0].fill(default_color[0])
+		colors[:,1].fill(default_color[1])
+		colors[:,2].fill(default_color[2])			
+	else:
+		colors[:,0].fill(default_color[0])
+		colors[:,1].fill(default_color[1])
+		colors[:,2].fill(default_color[2])
+	return colors
+
+def loadPCD(filename,default_color=[128,128,128]):
+	with open(filename, 'rb') as f:
+		header_dict,maps,datatype,dt=readPCDHeader(f)
+		nbPoints=int(header_dict['POINTS'][0])
+		Data=readPCDBody(f,header_dict,datatype,dt)
 
 		if ('x' in Data) and ('y' in Data) and ('y' in Data):
-			points=np.column_stack ((Data['x'],Data['y'],Data['z'])).reshape(int(header_dict['HEIGHT'][0]),int(header_dict['WIDTH'][0]),-1)
+			points=np.column_stack ((Data['x'],Data['y'],Data['z'])).reshape(int(header_dict['HEIGHT'][0]),int(header_dict['WIDTH'][0]),3)
 		else:
 			points=[]		
-		colors=np.empty((nbPoints,3),dtype=np.uint8)
-		from struct import pack,unpack
+		colors=unpackPCDColors(Data,nbPoints,default_color)
 		if 'rgb' in Data:
-			s=np.ndarray.tostring(np.array(Data['rgb']))
-			rgb_int=np.fromstring(s,dtype=np.int32)
-
-				#from http://www.pointclouds.org/documentation/tutorials/adding_custom_ptype.php:
-				# "The reason why rgb data is being packed as a float comes from the early development
-				#o f PCL as part of the ROS project, where RGB data is still being sent by wire as 
-				#float numbers. We expect this data type to be dropped as soon as all legacy code has 
-				#been rewritten (most likely in PCL 2.x).
-			colors=np.column_stack(((rgb_int>>16)& 0x0000ff,(rgb_int>>8)& 0x0000ff,(rgb_int)& 0x0000ff))
 			del Data['rgb']
-		elif   'rgba' in Data:
-			print ('not et coded')
-			colors[:,0].fill(default_color[0])
-			colors[:,1].fill(default_color[1])
-			colors[:,2].fill(default_color[2])			
-		else:
-			colors[:,0].fill(default_color[0])
-			colors[:,1].fill(default_color[1])
-			colors[:,2].fill(default_color[2])
 		if  'normal_x' in Data:
-			Data['normals']=np.column_stack ((Data['normal_x'],Data['normal_y'],Data['normal_z'])).reshape(int(header_dict['HEIGHT'][0]),int(header_dict['WIDTH'][0]),-1)
+			Data['normals']=np.column_stack ((Data['normal_x'],Data['normal_y'],Data['normal_z'])).reshape(int(header_dict['HEIGHT'][0]),int(header_dict['WIDTH'][0]),3)
 
 		for key in ['x','y','z']:
 			if key in Data:
 				del Data[key]
 		return points,colors, Data,maps
 
+class PCDFile():
+	"""Lazy access to a PCD file. Only the header is parsed when the object is created.
+	The body of binary files is memory mapped as an array of the structured point dtype when first accessed,
+	points and fields are then views on the file and nothing is read from the disk until they are used.
+	The colors are unpacked from the rgb field only when requested.
+	Ascii and binary_compressed files can not be mapped, they are decoded in memory on first access."""
+
+	def __init__(self,filename):
+		self.filename=filename
+		with open(filename, 'rb') as f:
+			self.header,self.maps,self.datatype,self.dtype=readPCDHeader(f)
+			self.dataOffset=f.tell()
+		self.nbPoints=int(self.header['POINTS'][0])
+		self.height=int(self.header['HEIGHT'][0])
+		self.width=int(self.header['WIDTH'][0])
+		self.fieldNames=self.header['FIELDS']
+		self.dataArray=None
+		self.colorsArray=None
+
+	@property
+	def data(self):
+		"""array of nbPoints elements of the structured point dtype"""
+		if self.dataArray is None:
+			if self.nbPoints==0:
+				self.dataArray=np.empty(0,dtype=self.dtype)
+			elif self.datatype=='binary':
+				self.dataArray=np.memmap(self.filename,dtype=self.dtype,mode='r',offset=self.dataOffset,shape=(self.nbPoints,))
+			else:
+				with open(self.filename, 'rb') as f:
+					f.seek(self.dataOffset)
+					Data=readPCDBody(f,self.header,self.datatype,self.dtype)
+				self.dataArray=np.empty(self.nbPoints,dtype=self.dtype)
+				for key in self.fieldNames:
+					self.dataArray[key]=Data[key]
+		return self.dataArray
+
+	def field(self,name):
+		"""view of a field with shape (height,width)"""
+		values=self.data[name]
+		return values.reshape((self.height,self.width)+values.shape[1:])
+
+	@property
+	def points(self):
+		"""(height,width,3) array of the point coordinates, a read only view of the file when the x, y and z fields
+		are consecutive float32 values as in the files written by savePCD"""
+		data=self.data
+		fields=self.dtype.fields
+		if all(fields[name][0]==np.float32 for name in 'xyz') and fields['y'][1]==fields['x'][1]+4 and fields['z'][1]==fields['x'][1]+8:
+			x=data['x']
+			return np.lib.stride_tricks.as_strided(x,shape=(self.height,self.width,3),strides=(self.width*self.dtype.itemsize,self.dtype.itemsize,4),writeable=False)
+		return np.column_stack((data['x'],data['y'],data['z'])).reshape(self.height,self.width,3)
+
+	@property
+	def colors(self):
+		"""(nbPoints,3) array of colors unpacked from the rgb field on first access"""
+		if self.colorsArray is None:
+			data=self.data
+			self.colorsArray=unpackPCDColors(dict([(name,data[name]) for name in self.fieldNames]),self.nbPoints)
+		return self.colorsArray
+
+	def close(self):
+		"""releases the memory map, the views obtained from this object keep it open until they are deleted"""
+		self.dataArray=None
+		self.colorsArray=None
+
+def openPCD(filename):
+	"""opens a PCD file without reading its data, see PCDFile"""
+	return PCDFile(filename)
+
+def openPCDSequence(filename):
+	"""opens all the PCD files listed in a sequence file such as the pcdSequence.txt written by generateSequence,
+	only their headers are read. Blank lines and lines starting with # are skipped, the paths are relative
+	to the folder of the sequence file"""
+	folder=os.path.dirname(filename)
+	frames=[]
+	with open(filename, 'r') as f:
+		for line in f:
+			line=line.strip()
+			if len(line)==0 or line[0]=='#':
+				continue
+			frames.append(PCDFile(os.path.join(folder,line)))
+	return frames
+
+def savePoses(filename,poses):
+	"""saves a sequence of 4x4 poses in a text file with one pose per line, the 16 coefficients being listed row by row"""
+	poses=np.asarray(poses).reshape(-1,16)
+	with open(filename,'w') as f:
+		f.write('# one 4x4 pose per line, row major\n')
+		writeFormattedRows(f,' '.join(['%.9g']*16),[poses[:,k] for k in range(16)])
+
+def loadPoses(filename):
+	"""reads a file written by savePoses, returns an array of size nbPoses x 4 x 4"""
+	with open(filename,'rb') as f:
+		lines=[line for line in f.read().splitlines() if len(line.strip())>0 and not line.startswith(b'#')]
+	return np.array(b' '.join(lines).split(),dtype=np.float64).reshape(-1,4,4)
+
+def exportRGBDSequence(filename,outputFolder,formats=('pcd','ptx'),pcdFormat='binary',frames=None):
+	"""exports the frames of a sequence file written with RGBDSequenceIO into one PCD and/or PTX file per frame
+	together with a pcdSequence.txt list, with the same file names as generateSequence.
+	Only the pixels covered by the object are exported, frames is an optional list of frame indices"""
+	sequence=RGBDSequenceIO.RGBDSequenceReader(filename)
+	if frames is None:
+		frames=range(len(sequence))
+	if not os.path.exists(outputFolder):
+		os.makedirs(outputFolder)
+	pcdFileNames=[]
+	for idFrame in frames:
+		array_rgb,array_xyz,pose=sequence[idFrame]
+		keep=~np.isnan(array_xyz[:,:,0])
+		points=np.ascontiguousarray(array_xyz[keep],dtype=np.float32).reshape(1,-1,3)
+		colors=array_rgb[keep].reshape(1,-1,3)
+		if 'pcd' in formats:
+			pcdFileName='pointCLoud%03.0d.pcd'%idFrame
+			savePCD(os.path.join(outputFolder,pcdFileName),None,points,colors,format=pcdFormat)
+			pcdFileNames.append(pcdFileName)
+		if 'ptx' in formats:
+			savePTX(os.path.join(outputFolder,'pointCLoud%03.0d.ptx'%idFrame),points,colors)
+	sequence.close()
+	if 'pcd' in formats:
+		with open(os.path.join(outputFolder,'pcdSequence.txt'),'w') as f:
+			for pcdFileName in pcdFileNames:
+				f.write(pcdFileName+'\n')
+
 def loadOFF(filename):
 	point=None
 	with open(filename, 'r') as f:
@@ -272,121 +631,351 @@ def loadOFF(filename):
 	return points
 
 
-def loadPLY(filename,getFaces=True):
-	header_dict=dict()
-	with open(filename, 'r') as f:
-		line=f.readline().rstrip('\n')
-		assert(line=='ply')
-		line=f.readline().rstrip('\n')
-		assert(line=='format ascii 1.0')
-		fields_vertex_names=[]
-		fields_vertex_types=[]
-		fields_face_names=[]
-		fields_face_types=[]	
-		fields_edges_names=[]
-		fields_edges_types=[]			
-		nbFaces=0
-		nbEdges=0
-		while True:
-			line=f.readline()
-			line = line.rstrip('\n')
-			t=line.split(' ')
+plyTypes=dict([('char','i1'),('uchar','u1'),('short','i2'),('ushort','u2'),('int','i4'),('uint','u4'),('float','f4'),('double','f8'),
+	('int8','i1'),('uint8','u1'),('int16','i2'),('uint16','u2'),('int32','i4'),('uint32','u4'),('float32','f4'),('float64','f8')])
+# types of the vertex fields returned by loadPLY, the other types are returned unchanged
+plyVertexOutputTypes=dict([('float',np.float32),('uint',np.uint32),('uchar',np.uint16)])
 
-			if t[0]=='comment':
-				continue
-			elif t[0]=='end_header':
-				break
-			elif t[0]=='property':
-				if t[1]=='list':
-					fields_names.append(t[4])
-					fields_types.append(t[1:4])
-				else:
-					fields_names.append(t[2])
-					fields_types.append(t[1])
-			elif t[0]=='element':
-				if t[1]=='vertex':
-					nbPoints=int(t[2])
-					fields_names=fields_vertex_names
-					fields_types=fields_vertex_types	
-					assert(len(t)==3)
-				if t[1]=='face':
-					nbFaces=int(t[2])
-					fields_names=fields_face_names
-					fields_types=fields_face_types	
-				if t[1]=='edge':
-					nbEdges=int(t[2])
-					fields_names=fields_edges_names
-					fields_types=fields_edges_types				
+def readPLYHeader(f):
+	"""reads the header of a PLY file opened in binary mode, returns the format ('ascii', 'binary_little_endian' or
+	'binary_big_endian') and the list of elements as (name,count,properties), each property being (name,type) or
+	(name,(countType,itemType)) for lists, with the type names used in the file"""
+	line=f.readline().rstrip(b'\r\n')
+	assert(line==b'ply')
+	format=None
+	elements=[]
+	while True:
+		line=f.readline()
+		if len(line)==0:
+			raise ValueError('unexpected end of file in the PLY header')
+		t=line.decode('ascii').split()
+		if len(t)==0 or t[0] in ['comment','obj_info']:
+			continue
+		elif t[0]=='end_header':
+			break
+		elif t[0]=='format':
+			format=t[1]
+			if not format in ['ascii','binary_little_endian','binary_big_endian']:
+				raise ValueError('unknown PLY format %s'%format)
+		elif t[0]=='element':
+			elements.append((t[1],int(t[2]),[]))
+		elif t[0]=='property':
+			if t[1]=='list':
+				elements[-1][2].append((t[4],(t[2],t[3])))
 			else:
-				print ('unkown key word')
-
-		nbVertexFields=len(fields_vertex_names)
-		DataArray=np.fromfile(f,  sep=' ',count=nbPoints*nbVertexFields).reshape(nbPoints,-1)
+				elements[-1][2].append((t[2],t[1]))
+		else:
+			print ('unkown key word')
+	return format,elements
 
-		Data=dict()
+def plyScalarsDtype(properties,byteOrder):
+	return np.dtype([(name,byteOrder+plyTypes[type]) for name,type in properties])
 
-		for i,field,type in zip(range(nbVertexFields),fields_vertex_names,fields_vertex_types):
-			if type=='float':
-				py_type=np.float32
-			elif  type=='uint':
-				py_type=np.uint32
-			elif  type=='uchar':
-				py_type=np.uint16 #uint8
+def readPLYElementAscii(tokens,position,count,properties):
+	"""parses an element from the list of tokens of the body of an ascii file starting at the given position,
+	returns the dictionary of properties and the position of the next element. The lists are returned
+	as a pair (lengths,values) with the values of all the lists concatenated"""
+	listIds=[i for i,(name,type) in enumerate(properties) if isinstance(type,tuple)]
+	nbProperties=len(properties)
+	if len(listIds)==0:
+		values=np.array(tokens[position:position+count*nbProperties],dtype=np.float64).reshape(count,nbProperties)
+		return dict([(name,values[:,i]) for i,(name,type) in enumerate(properties)]),position+count*nbProperties
+	if len(listIds)==1 and count>0:
+		# if all the lists have the same length as the first one the element is a table that is parsed at once
+		listId=listIds[0]
+		length=int(tokens[position+listId])
+		rowSize=nbProperties+length
+		if len(tokens)>=position+count*rowSize:
+			values=np.array(tokens[position:position+count*rowSize],dtype=np.float64).reshape(count,rowSize)
+			if np.all(values[:,listId]==length):
+				element=dict()
+				for i,(name,type) in enumerate(properties):
+					if i<listId:
+						element[name]=values[:,i]
+					elif i>listId:
+						element[name]=values[:,i+length]
+				element[properties[listId][0]]=(np.full(count,length,dtype=np.int64),values[:,listId+1:listId+1+length].flatten())
+				return element,position+count*rowSize
+	# lists of various lengths, the rows are parsed one at a time
+	rows=[]
+	for idRow in range(count):
+		row=[]
+		for name,type in properties:
+			if isinstance(type,tuple):
+				length=int(tokens[position])
+				row.append(tokens[position+1:position+1+length])
+				position+=1+length
 			else:
-				print ('not yet coded')
-				raise
+				row.append(tokens[position])
+				position+=1
+		rows.append(row)
+	element=dict()
+	for i,(name,type) in enumerate(properties):
+		if isinstance(type,tuple):
+			lists=[row[i] for row in rows]
+			element[name]=(np.array([len(l) for l in lists],dtype=np.int64),np.array(list(itertools.chain.from_iterable(lists)),dtype=np.float64))
+		else:
+			element[name]=np.array([row[i] for row in rows],dtype=np.float64)
+	return element,position
 
-			Data[field]=DataArray[:,i].astype(py_type)
+def readPLYElementBinary(f,count,properties,byteOrder):
+	"""reads an element from a binary file, the lists are returned as a pair (lengths,values)"""
+	listIds=[i for i,(name,type) in enumerate(properties) if isinstance(type,tuple)]
+	if len(listIds)==0:
+		dtype=plyScalarsDtype(properties,byteOrder)
+		values=np.frombuffer(f.read(count*dtype.itemsize),dtype=dtype,count=count)
+		return dict([(name,values[name]) for name,type in properties])
+	if len(listIds)==1 and count>0:
+		# if all the lists have the same length as the first one the element is read as a single structured array
+		listId=listIds[0]
+		name,(countType,itemType)=properties[listId]
+		position=f.tell()
+		before=plyScalarsDtype(properties[:listId],byteOrder)
+		f.seek(before.itemsize,os.SEEK_CUR)
+		length=int(np.frombuffer(f.read(np.dtype(plyTypes[countType]).itemsize),dtype=byteOrder+plyTypes[countType])[0])
+		f.seek(position)
+		fields=[(n,byteOrder+plyTypes[t]) for n,t in properties[:listId]]
+		fields+=[('__length',byteOrder+plyTypes[countType]),(name,byteOrder+plyTypes[itemType],(length,))]
+		fields+=[(n,byteOrder+plyTypes[t]) for n,t in properties[listId+1:]]
+		dtype=np.dtype(fields)
+		data=f.read(count*dtype.itemsize)
+		if len(data)==count*dtype.itemsize:
+			values=np.frombuffer(data,dtype=dtype,count=count)
+			if np.all(values['__length']==length):
+				element=dict([(n,values[n]) for n,t in properties if n!=name])
+				element[name]=(np.full(count,length,dtype=np.int64),values[name].reshape(-1))
+				return element
+		f.seek(position)
+	# lists of various lengths, the offset of each property in each row is found sequentially from the lengths of
+	# the lists and the values are then gathered at once for each property
+	start=f.tell()
+	buffer=f.read()
+	bufferArray=np.frombuffer(buffer,dtype=np.uint8)
+	byteOrderName='little' if byteOrder=='<' else 'big'
+	layout=[]
+	for name,type in properties:
+		if isinstance(type,tuple):
+			countDtype=np.dtype(plyTypes[type[0]])
+			layout.append((True,countDtype.itemsize,countDtype.kind=='i',np.dtype(plyTypes[type[1]]).itemsize))
+		else:
+			layout.append((False,np.dtype(plyTypes[type]).itemsize,False,0))
+	offsets=np.empty((len(properties),count),dtype=np.int64)
+	lengths=np.zeros((len(properties),count),dtype=np.int64)
+	offset=0
+	for idRow in range(count):
+		for k,(isList,size,signed,itemSize) in enumerate(layout):
+			offsets[k,idRow]=offset
+			if isList:
+				length=int.from_bytes(buffer[offset:offset+size],byteOrderName,signed=signed)
+				lengths[k,idRow]=length
+				offset+=size+length*itemSize
+			else:
+				offset+=size
+	f.seek(start+offset)
+	element=dict()
+	for k,(name,type) in enumerate(properties):
+		isList,size,signed,itemSize=layout[k]
+		if isList:
+			itemDtype=np.dtype(byteOrder+plyTypes[type[1]])
+			rowStarts=np.cumsum(lengths[k])-lengths[k]
+			positionInList=np.arange(lengths[k].sum())-np.repeat(rowStarts,lengths[k])
+			itemOffsets=np.repeat(offsets[k]+size,lengths[k])+positionInList*itemSize
+			values=bufferArray[itemOffsets[:,None]+np.arange(itemSize)].view(itemDtype).reshape(-1)
+			element[name]=(lengths[k],values)
+		else:
+			scalarDtype=np.dtype(byteOrder+plyTypes[type])
+			element[name]=bufferArray[offsets[k][:,None]+np.arange(size)].view(scalarDtype).reshape(-1)
+	return element
 
-		points=np.column_stack ((Data['x'],Data['y'],Data['z']))
-		for key in ['x','y','z']:
-			del Data[key]		
-		if ('red' in Data) and ('green' in Data) and ('blue' in Data):
-			colors=np.column_stack ((Data['red'],Data['green'],Data['blue']))
-			for key in ['red','green','blue']:
-				del Data[key]			
-		else: 
-			colors=None
-
-		if getFaces:
-			edges=None
-			DataFaces=dict()
-			DataPolylines=dict()
-			for field in fields_face_names[1:]:
-				DataFaces[field]=[]#np.empty((nbFaces),dtype=np.uint32)
-				DataPolylines[field]   =[]
-			if nbFaces>0:
-				polylines=[]
-				faces=[]
-				for idface in range(nbFaces):
-					line=f.readline()
-					line = line.rstrip('\n')
-					t=[i for i in line.split(' ')]
-					for i in range(3,int(t[0])+1):
-						faces.append([int(t[1]),int(t[i-1]),int(t[i])])
-						for id,field in enumerate(fields_face_names[1:]):
-							#fields_face_names
-							DataFaces[field].append(float(t[int(t[0])+id+1]))
-					polylines.append(points[[int(x) for x in  t[1:int(t[0])+1]]])
-					for id,field in enumerate(fields_face_names[1:]):
-							#fields_face_names
-						DataPolylines[field].append(float(t[int(t[0])+id+1]))
-						#DataPolylines[field]=
-				for field in (fields_face_names[1:]):
-					DataFaces[field]=np.array(DataFaces[field])
-				faces=np.array(faces,dtype=np.int32)
-
-			else: 
-				faces=None
-				DataFaces=None
-				polylines=None
-				edges=None
-			if nbEdges>0:
-				data=np.fromfile(f,  sep=' ',count=nbEdges*2)
-				edges=data.reshape(nbEdges,2)
-			return points,colors, Data,faces,DataFaces,polylines,edges,DataPolylines
+def readPLY(filename):
+	"""reads all the elements of an ascii or binary PLY file, returns a dictionary that gives for each element
+	its properties as a dictionary of arrays, lists being stored as a pair (lengths,values) where values
+	is the concatenation of all the lists, and the list of elements as given by readPLYHeader"""
+	with open(filename, 'rb') as f:
+		format,elements=readPLYHeader(f)
+		result=dict()
+		if format=='ascii':
+			tokens=f.read().split()
+			position=0
+			for name,count,properties in elements:
+				element,position=readPLYElementAscii(tokens,position,count,properties)
+				# the values are converted to the types declared in the header
+				for propertyName,type in properties:
+					if isinstance(type,tuple):
+						lengths,values=element[propertyName]
+						element[propertyName]=(lengths,values.astype(plyTypes[type[1]]))
+					else:
+						element[propertyName]=element[propertyName].astype(plyTypes[type])
+				result[name]=element
 		else:
-			return points,colors, Data
+			byteOrder='<' if format=='binary_little_endian' else '>'
+			for name,count,properties in elements:
+				element=readPLYElementBinary(f,count,properties,byteOrder)
+				# native byte order
+				for propertyName,type in properties:
+					if isinstance(type,tuple):
+						lengths,values=element[propertyName]
+						element[propertyName]=(lengths,values.astype(values.dtype.newbyteorder('=')))
+					else:
+						element[propertyName]=element[propertyName].astype(element[propertyName].dtype.newbyteorder('='))
+				result[name]=element
+	return result,elements
+
+def loadPLY(filename,getFaces=True):
+	"""loads the vertices, the faces and the edges of an ascii, binary_little_endian or binary_big_endian PLY file.
+	The faces are triangulated as fans, DataFaces gives the face properties for each triangle and DataPolylines
+	for each face, polylines is the list of the vertices of each face"""
+	elementsData,elements=readPLY(filename)
+	properties=dict([(name,elementProperties) for name,count,elementProperties in elements])
+
+	Data=dict()
+	for field,type in properties['vertex']:
+		if isinstance(type,tuple) or not type in plyTypes:
+			print ('not yet coded')
+			raise ValueError('unsupported vertex property type %s'%str(type))
+		Data[field]=elementsData['vertex'][field].astype(plyVertexOutputTypes.get(type,plyTypes[type]))
+
+	points=np.column_stack ((Data['x'],Data['y'],Data['z']))
+	for key in ['x','y','z']:
+		del Data[key]
+	if ('red' in Data) and ('green' in Data) and ('blue' in Data):
+		colors=np.column_stack ((Data['red'],Data['green'],Data['blue']))
+		for key in ['red','green','blue']:
+			del Data[key]
+	else:
+		colors=None
+
+	if not getFaces:
+		return points,colors, Data
+
+	DataPolylines=dict()
+	faces=None
+	DataFaces=None
+	polylines=None
+	faceLists=[name for name,type in properties.get('face',[]) if isinstance(type,tuple)]
+	if len(faceLists)>0:
+		lengths,indices=elementsData['face'][faceLists[0]]
+		indices=indices.astype(np.int64)
+		for name,type in properties['face']:
+			if not isinstance(type,tuple):
+				DataPolylines[name]=elementsData['face'][name].astype(np.float64)
+		if len(lengths)>0:
+			# fan triangulation, the triangles of a face with vertices v0...vn-1 are [v0,vk,vk+1] for k in 1...n-2
+			listStarts=np.cumsum(lengths)-lengths
+			nbTriangles=np.maximum(lengths-2,0)
+			triangleFace=np.repeat(np.arange(len(lengths)),nbTriangles)
+			k=np.arange(nbTriangles.sum())-np.repeat(np.cumsum(nbTriangles)-nbTriangles,nbTriangles)+1
+			firstVertices=listStarts[triangleFace]
+			faces=np.column_stack((indices[firstVertices],indices[firstVertices+k],indices[firstVertices+k+1])).astype(np.int32)
+			DataFaces=dict([(name,values[triangleFace]) for name,values in DataPolylines.items()])
+			if np.all(lengths==lengths[0]):
+				polylines=list(points[indices.reshape(len(lengths),lengths[0])])
+			else:
+				polylines=np.split(points[indices],np.cumsum(lengths)[:-1])
+	if 'edge' in elementsData and len(properties['edge'])>=2:
+		edgeProperties=properties['edge']
+		edges=np.column_stack((elementsData['edge'][edgeProperties[0][0]],elementsData['edge'][edgeProperties[1][0]]))
+	else:
+		edges=None
+	return points,colors, Data,faces,DataFaces,polylines,edges,DataPolylines
+
+objCacheVersion=1
+
+def parseOBJLines(content,keyword):
+	"""returns the text following the keyword on each line of an OBJ file starting with that keyword"""
+	return re.findall(b'^'+keyword+b'[ \t]+([^\n]*)',content,flags=re.M)
+
+def parseOBJValues(lines,nbValues):
+	"""parses lines of numbers into an array with nbValues columns, the lines with fewer values are padded with zeros
+	and the additional values are ignored (w coordinates, vertex colors)"""
+	tokens=b' '.join(lines).split()
+	if len(tokens)==len(lines)*nbValues:
+		return np.array(tokens,dtype=np.float64).reshape(-1,nbValues)
+	values=np.zeros((len(lines),nbValues))
+	for i,line in enumerate(lines):
+		t=line.split()[:nbValues]
+		values[i,:len(t)]=np.array(t,dtype=np.float64)
+	return values
+
+def parseOBJ(content):
+	"""parses the content of an OBJ file given as bytes, returns the vertices, the texture coordinates (u,v,w),
+	the normals and the faces as an array of size nbTriangles x 3 x 3 giving the vertex, texture coordinate and
+	normal indices of each corner, starting from zero, -1 marking the missing indices. Polygons are triangulated
+	as fans. Only the geometry is read, the materials and groups are ignored"""
+	vertices=parseOBJValues(parseOBJLines(content,b'v'),3)
+	texcoords=parseOBJValues(parseOBJLines(content,b'vt'),3)
+	normals=parseOBJValues(parseOBJLines(content,b'vn'),3)
+	faceLines=parseOBJLines(content,b'f')
+	if len(faceLines)==0:
+		raise ValueError('the OBJ file does not contain any face')
+	corners=b' '.join(faceLines).split()
+	if len(corners)==3*len(faceLines):
+		lengths=np.full(len(faceLines),3)
+	else:
+		lengths=np.array([len(line.split()) for line in faceLines])
+	# the corners are v, v/t, v//n or v/t/n, the missing indices are replaced by 0 before converting all of them at once
+	nbComponents=corners[0].count(b'/')+1
+	indices=np.array(b' '.join(corners).replace(b'//',b'/0/').replace(b'/',b' ').split(),dtype=np.int64)
+	if len(indices)!=len(corners)*nbComponents:
+		raise ValueError('the faces do not all have the same vertex format')
+	indices=indices.reshape(-1,nbComponents)
+	if np.any(indices<0):
+		raise ValueError('relative indices are not supported')
+	cornerIndices=np.full((len(corners),3),-1,dtype=np.int64)
+	cornerIndices[:,:nbComponents]=indices-1
+	# fan triangulation, the triangles of a face with corners c0...cn-1 are [c0,ck,ck+1] for k in 1...n-2
+	if np.all(lengths==3):
+		faces=cornerIndices.reshape(-1,3,3)
+	else:
+		faceStarts=np.cumsum(lengths)-lengths
+		nbTriangles=lengths-2
+		triangleFace=np.repeat(np.arange(len(lengths)),nbTriangles)
+		k=np.arange(nbTriangles.sum())-np.repeat(np.cumsum(nbTriangles)-nbTriangles,nbTriangles)+1
+		firstCorners=faceStarts[triangleFace]
+		faces=np.stack((cornerIndices[firstCorners],cornerIndices[firstCorners+k],cornerIndices[firstCorners+k+1]),axis=1)
+	for i,(name,array) in enumerate([('vertex',vertices),('texture coordinate',texcoords),('normal',normals)]):
+		if np.any(faces[:,:,i]>=len(array)):
+			raise ValueError('%s index out of range'%name)
+	return vertices,texcoords,normals,faces.astype(np.int32)
+
+def loadOBJ(filename,useCache=True):
+	"""loads an OBJ file, see parseOBJ. The arrays are saved in a binary cache file next to the OBJ file the first time
+	it is loaded and are then read from the cache as long as the hash of the content of the OBJ file does not change.
+	The cache is not used if it cannot be written"""
+	with open(filename,'rb') as f:
+		content=f.read()
+	if not useCache:
+		return parseOBJ(content)
+	contentHash=hashlib.sha1(content).hexdigest()
+	cacheFileName=filename+'.cache.npz'
+	if os.path.exists(cacheFileName):
+		try:
+			with np.load(cacheFileName) as cache:
+				if int(cache['version'])==objCacheVersion and str(cache['hash'])==contentHash:
+					return cache['vertices'],cache['texcoords'],cache['normals'],cache['faces']
+		except (IOError,ValueError,KeyError):
+			pass
+	vertices,texcoords,normals,faces=parseOBJ(content)
+	temporaryFileName=cacheFileName+'.%d.tmp.npz'%os.getpid()
+	try:
+		np.savez(temporaryFileName,version=objCacheVersion,hash=contentHash,vertices=vertices,texcoords=texcoords,normals=normals,faces=faces)
+		os.replace(temporaryFileName,cacheFileName)
+	except (IOError,OSError):
+		if os.path.exists(temporaryFileName):
+			os.remove(temporaryFileName)
+	return vertices,texcoords,normals,faces
+
+def interleaveOBJ(vertices,texcoords,normals,faces):
+	"""returns the float32 array of size (3*nbTriangles) x 9 with the position, the texture coordinates and the normal
+	of each corner of each triangle, in the same layout as ModernGL.ext.obj Obj.pack() with the default packer
+	(vx vy vz tx ty tz nx ny nz), missing values being set to zero"""
+	corners=faces.reshape(-1,3)
+	interleaved=np.zeros((len(corners),9),dtype=np.float32)
+	for i,array in enumerate([vertices,texcoords,normals]):
+		valid=corners[:,i]>=0
+		interleaved[valid,3*i:3*i+3]=array[corners[valid,i]]
+	return interleaved
+
 if __name__ == "__main__":
 	points,colors, transform,maps=loadPCD('data/scan_ascii.pcd')
 	from matplotlib import pyplot as plt
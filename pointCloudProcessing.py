@@ -0,0 +1,286 @@
+# This file contains geometric processing functions on point clouds and triangulated surfaces: rigid transforms,
+# normals estimation and downsampling.
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy import sparse
+
+
+def transformPoints(transform,points):
+	"""applies the 4x4 rigid transform to an array of points of size ... x 3"""
+	return points.dot(transform[:3,:3].T)+transform[:3,3]
+
+
+def rotationFromVector(rotationVector):
+	"""rotation matrix of the rotation of angle |rotationVector| around rotationVector (Rodrigues formula)"""
+	angle=np.linalg.norm(rotationVector)
+	if angle<1e-12:
+		return np.eye(3)
+	axis=rotationVector/angle
+	K=np.array([[0,-axis[2],axis[1]],[axis[2],0,-axis[0]],[-axis[1],axis[0],0]])
+	return np.eye(3)+np.sin(angle)*K+(1-np.cos(angle))*K.dot(K)
+
+
+def vectorFromRotation(rotation):
+	"""rotation vector of a rotation matrix, inverse of rotationFromVector"""
+	angle=np.arccos(np.clip((np.trace(rotation)-1)/2,-1,1))
+	axis=np.array([rotation[2,1]-rotation[1,2],rotation[0,2]-rotation[2,0],rotation[1,0]-rotation[0,1]])
+	if angle<1e-6:
+		return axis/2
+	if np.pi-angle<1e-6:
+		# sin(angle) vanishes, the axis is read from the symmetric part R+I=2*axis*axis^T instead
+		symmetric=rotation+np.eye(3)
+		column=symmetric[:,np.argmax(np.diag(symmetric))]
+		direction=column/np.linalg.norm(column)
+		return direction*angle*(1 if direction.dot(axis)>=0 else -1)
+	return axis*angle/(2*np.sin(angle))
+
+
+def rigidTransform(rotation,translation):
+	"""4x4 matrix of the transform x -> rotation.dot(x)+translation"""
+	transform=np.eye(4)
+	transform[:3,:3]=rotation
+	transform[:3,3]=translation
+	return transform
+
+
+def invertRigidTransform(transform):
+	return rigidTransform(transform[:3,:3].T,-transform[:3,:3].T.dot(transform[:3,3]))
+
+
+def computeVertexNormals(vertices,faces):
+	"""normals of the vertices of a triangulated surface, obtained by summing the normals of the adjacent triangles
+	weighted by their areas. faces is an array of size nbTriangles x 3 with the vertex indices"""
+	triangles=vertices[faces]
+	triangleNormals=np.cross(triangles[:,1]-triangles[:,0],triangles[:,2]-triangles[:,0])
+	normals=np.zeros(vertices.shape)
+	for k in range(3):
+		normals[:,k]=np.bincount(faces.reshape(-1),weights=np.repeat(triangleNormals[:,k],3),minlength=len(vertices))
+	norms=np.linalg.norm(normals,axis=1)
+	norms[norms==0]=1
+	return normals/norms[:,None]
+
+
+def voxelGridFilter(points,voxelSize,maxDenseVoxels=1<<20,attributes=None):
+	"""replaces the points contained in each cubic voxel of side voxelSize by their centroid, as pcl::VoxelGrid.
+	If attributes (for example the colors) is an array of size N x C, the averages of the attributes of the points
+	of each voxel are returned as well.
+	The three voxel coordinates are packed into a single integer key so that the voxels are found with a 1D np.unique,
+	or without sorting with a bincount over the keys when the grid has less than maxDenseVoxels voxels"""
+	if len(points)==0:
+		# a frame where the object is not visible
+		centroids=np.empty((0,3))
+		return centroids if attributes is None else (centroids,np.empty((0,attributes.shape[1])))
+	voxels=np.floor(points/voxelSize).astype(np.int64)
+	voxels-=voxels.min(axis=0)
+	size=voxels.max(axis=0)+1
+	keys=(voxels[:,0]*size[1]+voxels[:,1])*size[2]+voxels[:,2]
+	nbVoxels=int(np.prod(size))
+	if nbVoxels<=max(maxDenseVoxels,len(points)):
+		counts=np.bincount(keys,minlength=nbVoxels)
+		occupied=np.flatnonzero(counts)
+		labels=np.zeros(nbVoxels,dtype=np.int64)
+		labels[occupied]=np.arange(len(occupied))
+		inverse=labels[keys]
+		counts=counts[occupied]
+	else:
+		unique,inverse,counts=np.unique(keys,return_inverse=True,return_counts=True)
+	centroids=np.empty((len(counts),3))
+	for k in range(3):
+		centroids[:,k]=np.bincount(inverse,weights=points[:,k],minlength=len(counts))/counts
+	if attributes is None:
+		return centroids
+	averages=np.empty((len(counts),attributes.shape[1]))
+	for k in range(attributes.shape[1]):
+		averages[:,k]=np.bincount(inverse,weights=attributes[:,k],minlength=len(counts))/counts
+	return centroids,averages
+
+
+def neighbourhoodMatrix(points,radius,tree=None):
+	"""sparse N x N matrix with the distances between the pairs of distinct points closer than radius, the pairs are
+	found with a single KD-tree query instead of one query per point"""
+	if tree is None:
+		tree=cKDTree(points)
+	pairs=tree.query_pairs(radius,output_type='ndarray')
+	distances=np.linalg.norm(points[pairs[:,0]]-points[pairs[:,1]],axis=1)
+	rows=np.concatenate((pairs[:,0],pairs[:,1]))
+	columns=np.concatenate((pairs[:,1],pairs[:,0]))
+	return sparse.csr_matrix((np.concatenate((distances,distances)),(rows,columns)),shape=(len(points),len(points)))
+
+
+def estimateNormals(points,radius,viewpoint=(0,0,0),tree=None):
+	"""normals of a point cloud as pcl::NormalEstimation: eigenvector of the smallest eigenvalue of the covariance of
+	the points within radius (including the point itself), oriented toward the viewpoint. The covariances of all the
+	points are obtained from sparse products with the neighbourhood matrix"""
+	points=np.asarray(points,dtype=np.float64)
+	adjacency=neighbourhoodMatrix(points,radius,tree)
+	adjacency.data[:]=1
+	adjacency=adjacency+sparse.identity(len(points),format='csr')
+	counts=np.asarray(adjacency.sum(axis=1)).reshape(-1)
+	means=adjacency.dot(points)/counts[:,None]
+	covariances=np.empty((len(points),3,3))
+	for i in range(3):
+		for j in range(i,3):
+			covariances[:,i,j]=adjacency.dot(points[:,i]*points[:,j])/counts-means[:,i]*means[:,j]
+			covariances[:,j,i]=covariances[:,i,j]
+	normals=smallestEigenvectors(covariances)
+	flip=np.sum(normals*(np.asarray(viewpoint)-points),axis=1)<0
+	normals[flip]*=-1
+	return normals
+
+
+def smallestEigenvectors(matrices):
+	"""unit eigenvectors of the smallest eigenvalues of an array of N x 3 x 3 symmetric matrices, in closed form
+	using the trigonometric solution of the characteristic polynomial, which is several times faster than
+	np.linalg.eigh on many small matrices. The eigenvector is the largest cross product of two rows of
+	A-lambda*I, (0,0,1) is returned for multiples of the identity"""
+	q=np.trace(matrices,axis1=1,axis2=2)/3
+	shifted=matrices-q[:,None,None]*np.eye(3)
+	p=np.sqrt(np.sum(shifted**2,axis=(1,2))/6)
+	safeP=np.where(p>0,p,1)
+	r=np.clip(np.linalg.det(shifted/safeP[:,None,None])/2,-1,1)
+	smallest=q+2*p*np.cos(np.arccos(r)/3+2*np.pi/3)
+	rows=matrices-smallest[:,None,None]*np.eye(3)
+	crosses=np.stack((np.cross(rows[:,0],rows[:,1]),np.cross(rows[:,0],rows[:,2]),np.cross(rows[:,1],rows[:,2])),axis=1)
+	norms=np.linalg.norm(crosses,axis=2)
+	best=np.argmax(norms,axis=1)
+	indices=np.arange(len(matrices))
+	vectors=crosses[indices,best]
+	norms=norms[indices,best]
+	vectors[norms==0]=(0,0,1)
+	norms[norms==0]=1
+	return vectors/norms[:,None]
+
+
+def organizedNormals(xyz,maxDepthChange=None):
+	"""normals of an organized H x W x 3 XYZ image with NaN background as the cross product of the differences
+	between the neighbouring pixels along the rows and along the columns, oriented toward the camera at the origin.
+	Central differences are used where both neighbours are valid and one-sided ones otherwise. The differences
+	whose depth change is larger than maxDepthChange are not used, the normals that cannot be computed are NaN.
+	Only the bounding box of the valid pixels is processed"""
+	xyz=np.asarray(xyz)
+	normals=np.full(xyz.shape,np.nan)
+	valid=~np.isnan(xyz[:,:,2])
+	rows=np.flatnonzero(valid.any(axis=1))
+	columns=np.flatnonzero(valid.any(axis=0))
+	if len(rows)==0:
+		return normals
+	box=(slice(rows[0],rows[-1]+1),slice(columns[0],columns[-1]+1))
+	# the components are processed as separate contiguous planes with the NaN replaced by zeros, the difference at each
+	# pixel is a combination of the pixel and its two neighbours whose coefficients depend on which ones are valid
+	valid=np.pad(valid[box],1,mode='constant')
+	planes=[np.pad(np.nan_to_num(xyz[box+(k,)].astype(np.float64)),1,mode='constant') for k in range(3)]
+	center=(slice(1,-1),slice(1,-1))
+	differences=[]
+	for before,after in [((slice(1,-1),slice(0,-2)),(slice(1,-1),slice(2,None))),((slice(0,-2),slice(1,-1)),(slice(2,None),slice(1,-1)))]:
+		forwardValid=valid[after]&valid[center]
+		backwardValid=valid[before]&valid[center]
+		if maxDepthChange is not None:
+			forwardValid&=np.abs(planes[2][after]-planes[2][center])<=maxDepthChange
+			backwardValid&=np.abs(planes[2][center]-planes[2][before])<=maxDepthChange
+		afterWeight=np.where(backwardValid,0.5,1.0)*forwardValid
+		beforeWeight=np.where(forwardValid,0.5,1.0)*backwardValid
+		difference=[afterWeight*(plane[after]-plane[center])+beforeWeight*(plane[center]-plane[before]) for plane in planes]
+		differences.append(difference)
+	u,v=differences
+	cross=[u[1]*v[2]-u[2]*v[1],u[2]*v[0]-u[0]*v[2],u[0]*v[1]-u[1]*v[0]]
+	norms=np.sqrt(cross[0]**2+cross[1]**2+cross[2]**2)
+	# the norm is made negative for the normals pointing away from the camera to flip them in the division
+	norms[cross[0]*planes[0][center]+cross[1]*planes[1][center]+cross[2]*planes[2][center]>0]*=-1
+	norms[norms==0]=np.nan
+	for k in range(3):
+		normals[box+(k,)]=cross[k]/norms
+	return normals
+
+
+def validPoints(points):
+	"""returns the points of a point cloud or of an organized H x W x 3 array as a N x 3 array without the NaN points"""
+	points=np.asarray(points).reshape(-1,3)
+	return points[~np.isnan(points).any(axis=1)]
+
+
+def organizedPointCloud(array_rgb,array_xyz,subsamplingStep=1,averaging=False):
+	"""float32 points and [0,1] colors of the object pixels of an RGB image and its XYZ image with NaN background,
+	keeping one pixel out of subsamplingStep in each direction or averaging the object pixels of each block of
+	subsamplingStep x subsamplingStep pixels if averaging is True, which reduces the noise"""
+	keep=~np.isnan(array_xyz[:,:,0])
+	if averaging and subsamplingStep>1:
+		xyz=blockAverage(array_xyz,subsamplingStep,keep).reshape(-1,3)
+		colors=blockAverage(array_rgb,subsamplingStep,keep).reshape(-1,3)/255.0
+		keepSubsampled=~np.isnan(xyz[:,0])
+		return xyz[keepSubsampled].astype(np.float32),colors[keepSubsampled]
+	keepSubsampled=keep[::subsamplingStep,::subsamplingStep]
+	points=array_xyz[::subsamplingStep,::subsamplingStep][keepSubsampled].astype(np.float32)
+	colors=array_rgb[::subsamplingStep,::subsamplingStep][keepSubsampled]/255.0
+	return points,colors
+
+
+def blockAverage(image,step,mask=None):
+	"""averages the pixels of an H x W x C image by blocks of step x step pixels ignoring the NaN pixels, or the pixels
+	where mask is False if it is given. The blocks without any valid pixel are NaN, the last rows and columns are
+	dropped if the size of the image is not a multiple of step"""
+	height=(image.shape[0]//step)*step
+	width=(image.shape[1]//step)*step
+	blocks=image[:height,:width].reshape(height//step,step,width//step,step,-1).astype(np.float64)
+	if mask is None:
+		valid=~np.isnan(blocks).any(axis=4,keepdims=True)
+	else:
+		valid=mask[:height,:width].reshape(height//step,step,width//step,step,1)
+	sums=np.where(valid,blocks,0).sum(axis=(1,3))
+	counts=valid.sum(axis=(1,3))
+	with np.errstate(invalid='ignore',divide='ignore'):
+		average=sums/counts
+	average[np.broadcast_to(counts==0,average.shape)]=np.nan
+	return average.reshape(average.shape[:2]+image.shape[2:])
+
+
+def buildPyramid(array_rgb,array_xyz,nbLevels):
+	"""coarse to fine representation of an organized frame, returns the list of (rgb,xyz) images for levels 0 (full
+	resolution) to nbLevels-1, each level averaging blocks of 2 x 2 pixels of the previous one. Only the pixels of the
+	object (XYZ not NaN) are averaged, the RGB images are float images with NaN background and array_rgb can be None"""
+	levels=[(None if array_rgb is None else np.where(np.isnan(array_xyz[:,:,:1]),np.nan,array_rgb.astype(np.float64)),array_xyz)]
+	for level in range(1,nbLevels):
+		rgb,xyz=levels[-1]
+		valid=~np.isnan(xyz).any(axis=2)
+		levels.append((None if rgb is None else blockAverage(rgb,2,valid),blockAverage(xyz,2,valid)))
+	return levels
+
+
+def pyramidIntrinsics(intrinsics,level):
+	"""intrinsics of the images of a pyramid level, the center of the pixel (0,0) of level l is at the center of the
+	block of 2^l x 2^l pixels of level 0 it averages"""
+	scale=2.0**-level
+	K=np.array(intrinsics,dtype=np.float64)
+	K[0,0]*=scale
+	K[1,1]*=scale
+	K[:2,2]=(K[:2,2]+0.5)*scale-0.5
+	return K
@@ -0,0 +1,132 @@
+# This file contains the motion models used to predict the pose of the tracked object in the next frame from the poses
+# found in the previous frames, the ICP then starts from the predicted pose instead of the previous one
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import pointCloudProcessing
+
+
+def poseIncrement(pose,nextPose):
+	"""6 dimensional vector (rotation vector, translation) of the motion from pose to nextPose expressed in the
+	object coordinate system, i.e. of the transform I such that nextPose=pose.I"""
+	increment=pointCloudProcessing.invertRigidTransform(pose).dot(nextPose)
+	return np.concatenate((pointCloudProcessing.vectorFromRotation(increment[:3,:3]),increment[:3,3]))
+
+
+def applyIncrement(pose,increment):
+	"""moves the pose by the 6 dimensional increment given by poseIncrement"""
+	return pose.dot(pointCloudProcessing.rigidTransform(pointCloudProcessing.rotationFromVector(increment[:3]),increment[3:]))
+
+
+class ConstantVelocityPredictor():
+	"""predicts that the object keeps the motion it had between the last two frames, the motion being composed on
+	the right of the pose so that a constant rotation around the object center gives a constant increment"""
+
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		"""forgets the previous poses, for example when the tracking has been lost"""
+		self.pose=None
+		self.velocity=None
+
+	def predict(self):
+		"""pose expected in the next frame, the last pose if only one is known and None if none is known"""
+		if self.pose is None or self.velocity is None:
+			return self.pose
+		return applyIncrement(self.pose,self.velocity)
+
+	def update(self,pose):
+		"""gives the pose found in the current frame"""
+		if self.pose is not None:
+			self.velocity=poseIncrement(self.pose,pose)
+		self.pose=np.array(pose,dtype=np.float64)
+
+
+class KalmanPosePredictor():
+	"""constant velocity Kalman filter on the pose. The state is the increment of the pose relative to the last filtered
+	pose and the velocity (increment per frame) in the object coordinate system, the acceleration being a white noise
+	whose standard deviation per frame is rotationNoise (radians) and translationNoise for each axis. The poses found
+	by the ICP are measurements of the pose with the standard deviations rotationMeasurementNoise and
+	translationMeasurementNoise, so that the predictions are less sensitive to the errors of the ICP than the ones
+	of the ConstantVelocityPredictor. The filtered pose becomes the reference of the increments after each update"""
+
+	def __init__(self,rotationNoise=0.01,translationNoise=0.01,rotationMeasurementNoise=0.002,translationMeasurementNoise=0.002,
+			initialVelocityNoise=1.0):
+		accelerationVariances=np.array([rotationNoise]*3+[translationNoise]*3)**2
+		# the acceleration a moves the increment by a/2 and the velocity by a during a frame
+		G=np.vstack((0.5*np.eye(6),np.eye(6)))
+		self.Q=G.dot(np.diag(accelerationVariances)).dot(G.T)
+		self.R=np.diag(np.array([rotationMeasurementNoise]*3+[translationMeasurementNoise]*3)**2)
+		self.F=np.block([[np.eye(6),np.eye(6)],[np.zeros((6,6)),np.eye(6)]])
+		self.initialVelocityNoise=initialVelocityNoise
+		self.reset()
+
+	def reset(self):
+		"""forgets the previous poses, for example when the tracking has been lost"""
+		self.pose=None
+		self.velocity=np.zeros(6)
+		self.covariance=None
+
+	def predict(self):
+		"""pose expected in the next frame, None if no pose is known"""
+		if self.pose is None:
+			return None
+		return applyIncrement(self.pose,self.velocity)
+
+	def update(self,pose):
+		"""gives the pose found in the current frame"""
+		if self.pose is None:
+			self.pose=np.array(pose,dtype=np.float64)
+			self.covariance=np.diag(np.concatenate((np.diag(self.R),np.full(6,self.initialVelocityNoise**2))))
+			return
+		# prediction from the previous filtered pose, the increment starts from zero
+		state=np.concatenate((self.velocity,self.velocity))
+		covariance=self.F.dot(self.covariance).dot(self.F.T)+self.Q
+
+		# correction with the measured increment
+		innovation=poseIncrement(self.pose,pose)-state[:6]
+		gain=np.linalg.solve(covariance[:6,:6]+self.R,covariance[:6,:]).T
+		state+=gain.dot(innovation)
+		self.covariance=covariance-gain.dot(covariance[:6,:])
+		self.pose=applyIncrement(self.pose,state[:6])
+		self.velocity=state[6:]
+
+
+def createPredictor(motionModel):
+	"""predictor of the motion model 'constant_velocity' or 'kalman', None if motionModel is None"""
+	if motionModel is None:
+		return None
+	if motionModel=='constant_velocity':
+		return ConstantVelocityPredictor()
+	if motionModel=='kalman':
+		return KalmanPosePredictor()
+	raise ValueError('unknown motion model %s'%motionModel)
@@ -0,0 +1,273 @@
+# This file contains a ray caster that renders the RGBD maps of a mesh by intersecting the camera rays with a bounding volume
+# hierarchy of its triangles, and the simulation of the artifacts of a structured light depth sensor
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import hashlib
+import collections
+import softwareRenderer
+
+
+def buildBVH(triangles,leafSize=4):
+	"""bounding volume hierarchy of the (T,3,3) triangles, built top down one level at a time: the triangles of each
+	node with more than leafSize triangles are sorted along the longest axis of the node box and split in two halves.
+	Returns a dictionary with the lower and upper corners of the node boxes, the (N,2) children of each node (-1 for
+	the leaves), the depth of the tree, the first and count arrays giving the range of the triangles of each leaf in the order array, the
+	first vertices v0 and the edges e1=v1-v0, e2=v2-v0 of the triangles in this order for the intersection tests"""
+	nbTriangles=len(triangles)
+	triangleLower=triangles.min(axis=1)
+	triangleUpper=triangles.max(axis=1)
+	centroids=triangles.mean(axis=1)
+	maxNodes=2*nbTriangles
+	lower=np.empty((maxNodes,3))
+	upper=np.empty((maxNodes,3))
+	children=np.full((maxNodes,2),-1,dtype=np.int64)
+	first=np.zeros(maxNodes,dtype=np.int64)
+	count=np.zeros(maxNodes,dtype=np.int64)
+
+	order=np.arange(nbTriangles)
+	nodes=np.array([0])
+	starts=np.array([0])
+	counts=np.array([nbTriangles])
+	nbNodes=1
+	depth=0
+	while len(nodes)>0:
+		# boxes of the nodes of the level, reduced over their range of triangles with a dummy row after the last one
+		bounds=np.column_stack((starts,starts+counts)).ravel()
+		lower[nodes]=np.minimum.reduceat(np.vstack((triangleLower[order],np.zeros((1,3)))),bounds)[::2]
+		upper[nodes]=np.maximum.reduceat(np.vstack((triangleUpper[order],np.zeros((1,3)))),bounds)[::2]
+		first[nodes]=starts
+		count[nodes]=counts
+
+		split=counts>leafSize
+		nodes,starts,counts=nodes[split],starts[split],counts[split]
+		if len(nodes)==0:
+			break
+		depth+=1
+		axes=np.argmax(upper[nodes]-lower[nodes],axis=1)
+
+		# sorts the triangles of each node along its axis, the nodes ranges are disjoint and sorted
+		segments=np.repeat(np.arange(len(nodes)),counts)
+		positions=np.arange(len(segments))-np.repeat(np.cumsum(counts)-counts,counts)+np.repeat(starts,counts)
+		keys=centroids[order[positions],axes[segments]]
+		order[positions]=order[positions][np.lexsort((keys,segments))]
+
+		children[nodes,0]=nbNodes+2*np.arange(len(nodes))
+		children[nodes,1]=children[nodes,0]+1
+		nbNodes+=2*len(nodes)
+		half=counts//2
+		nodes=children[nodes].ravel()
+		starts=np.column_stack((starts,starts+half)).ravel()
+		counts=np.column_stack((half,counts-half)).ravel()
+
+	# the boxes and triangles are stored as tuples of coordinate arrays for the vectorized intersection tests
+	ordered=triangles[order]
+	return dict(lower=tuple(lower[:nbNodes].T.copy()),upper=tuple(upper[:nbNodes].T.copy()),children=children[:nbNodes],
+		first=first[:nbNodes],count=count[:nbNodes],depth=depth,order=order,v0=tuple(ordered[:,0].T.copy()),
+		e1=tuple((ordered[:,1]-ordered[:,0]).T.copy()),e2=tuple((ordered[:,2]-ordered[:,0]).T.copy()))
+
+
+bvhCache=collections.OrderedDict()
+
+
+def cachedBVH(triangles,leafSize=4,maxCachedMeshes=8):
+	"""returns the bounding volume hierarchy of the triangles, built only the first time it is requested for a given
+	mesh, so that renderers of the same mesh created for each frame share it. The hierarchies of the maxCachedMeshes
+	last used meshes are kept in memory"""
+	key=(hashlib.sha1(np.ascontiguousarray(triangles).tobytes()).hexdigest(),leafSize)
+	if key in bvhCache:
+		bvhCache.move_to_end(key)
+	else:
+		bvhCache[key]=buildBVH(triangles,leafSize)
+		while len(bvhCache)>maxCachedMeshes:
+			bvhCache.popitem(last=False)
+	return bvhCache[key]
+
+
+def cross(a,b):
+	"""cross products of the vectors given as tuples of three coordinate arrays"""
+	return a[1]*b[2]-a[2]*b[1],a[2]*b[0]-a[0]*b[2],a[0]*b[1]-a[1]*b[0]
+
+
+def dot(a,b):
+	return a[0]*b[0]+a[1]*b[1]+a[2]*b[2]
+
+
+def intersectTriangles(origin,directions,v0,e1,e2,near):
+	"""Moller-Trumbore intersection of the rays starting at origin with the triangles given by their first vertex and
+	two edges, the directions and triangles being given as tuples of three coordinate arrays. Returns the distances along
+	the rays, in units of the directions length, and the barycentric coordinates u,v of the intersections, the distance
+	is inf if the ray misses the triangle"""
+	p=cross(directions,e2)
+	determinant=dot(e1,p)
+	with np.errstate(divide='ignore',invalid='ignore'):
+		inverse=1/determinant
+		s=(origin[0]-v0[0],origin[1]-v0[1],origin[2]-v0[2])
+		u=dot(s,p)*inverse
+		q=cross(s,e1)
+		v=dot(directions,q)*inverse
+		t=dot(e2,q)*inverse
+	hit=(determinant!=0)&(u>=0)&(v>=0)&(u+v<=1)&(t>near)
+	return np.where(hit,t,np.inf),u,v
+
+
+def boxDistances(bvh,nodes,origin,inverseDirections):
+	"""slab test of the rays with the boxes of the nodes, returns the distances along the rays at which they enter and
+	leave the boxes, the box is missed if the first is larger than the second"""
+	tmin=-np.inf
+	tmax=np.inf
+	with np.errstate(invalid='ignore'):
+		for axis in range(3):
+			t1=(bvh['lower'][axis][nodes]-origin[axis])*inverseDirections[axis]
+			t2=(bvh['upper'][axis][nodes]-origin[axis])*inverseDirections[axis]
+			# fmin and fmax ignore the nan given by rays parallel to a slab starting on its plane
+			tmin=np.fmax(tmin,np.fmin(t1,t2))
+			tmax=np.fmin(tmax,np.fmax(t1,t2))
+	return tmin,tmax
+
+
+def castRays(bvh,origin,directions,near=0.0):
+	"""closest intersection of the rays starting at origin with the (R,3) directions with the triangles of the bounding
+	volume hierarchy. All the rays traverse the hierarchy at once, each with its own stack of nodes: at each iteration
+	every ray pops a node, intersects its triangles if it is a leaf or pushes the children whose box it hits otherwise,
+	the closest child last so that it is visited first and the farther boxes are skipped once an intersection closer
+	than them has been found. Returns the distances along the rays (inf if the ray misses the mesh), the indices of the
+	triangles hit (-1 if none) and the barycentric coordinates u,v of the intersections in these triangles"""
+	nbRays=len(directions)
+	distances=np.full(nbRays,np.inf)
+	hitTriangles=np.full(nbRays,-1,dtype=np.int64)
+	barycentrics=np.zeros((nbRays,2))
+	directions=tuple(np.ascontiguousarray(directions.T))
+	with np.errstate(divide='ignore'):
+		inverseDirections=tuple(1/component for component in directions)
+
+	# flattened stacks of the nodes to visit with the distances at which the rays enter their boxes, a stack holds
+	# at most one node per level plus the two children of the deepest one
+	stackSize=bvh['depth']+2
+	stackNodes=np.zeros(nbRays*stackSize,dtype=np.int64)
+	stackDistances=np.zeros(nbRays*stackSize)
+	stackTops=np.arange(nbRays)*stackSize
+	tmin,tmax=boxDistances(bvh,np.zeros(nbRays,dtype=np.int64),origin,inverseDirections)
+	rays=np.flatnonzero(tmax>=np.maximum(tmin,near))
+	stackDistances[stackTops[rays]]=tmin[rays]
+	stackTops[rays]+=1
+
+	while len(rays)>0:
+		stackTops[rays]-=1
+		tops=stackTops[rays]
+		closer=stackDistances[tops]<distances[rays]
+		visiting,nodes=rays[closer],stackNodes[tops[closer]]
+
+		# intersections with the triangles of the leaves, the closest one of each ray is kept if it is closer than the previous ones
+		leaves=bvh['children'][nodes,0]<0
+		leafRays,leafNodes=visiting[leaves],nodes[leaves]
+		counts=bvh['count'][leafNodes]
+		pairRays=np.repeat(leafRays,counts)
+		pairTriangles=np.arange(len(pairRays))-np.repeat(np.cumsum(counts)-counts,counts)+np.repeat(bvh['first'][leafNodes],counts)
+		t,u,v=intersectTriangles(origin,tuple(component[pairRays] for component in directions),
+			*[tuple(component[pairTriangles] for component in bvh[name]) for name in ['v0','e1','e2']],near=near)
+		order=np.lexsort((t,pairRays))
+		closest=order[np.r_[True,pairRays[order[1:]]!=pairRays[order[:-1]]]] if len(order)>0 else order
+		closest=closest[t[closest]<distances[pairRays[closest]]]
+		distances[pairRays[closest]]=t[closest]
+		hitTriangles[pairRays[closest]]=bvh['order'][pairTriangles[closest]]
+		barycentrics[pairRays[closest]]=np.column_stack((u[closest],v[closest]))
+
+		# children of the inner nodes, the far one is pushed first
+		visiting,nodes=visiting[~leaves],nodes[~leaves]
+		inverse=tuple(component[visiting] for component in inverseDirections)
+		children=bvh['children'][nodes]
+		tmin0,tmax0=boxDistances(bvh,children[:,0],origin,inverse)
+		tmin1,tmax1=boxDistances(bvh,children[:,1],origin,inverse)
+		hit0=(tmax0>=np.maximum(tmin0,near))&(tmin0<distances[visiting])
+		hit1=(tmax1>=np.maximum(tmin1,near))&(tmin1<distances[visiting])
+		firstIsFar=tmin0>tmin1
+		for push in [(firstIsFar,~firstIsFar),(~firstIsFar,firstIsFar)]:
+			for child,hit,tchild,selected in [(0,hit0,tmin0,push[0]),(1,hit1,tmin1,push[1])]:
+				selected=selected&hit
+				pushing=visiting[selected]
+				stackNodes[stackTops[pushing]]=children[selected,child]
+				stackDistances[stackTops[pushing]]=tchild[selected]
+				stackTops[pushing]+=1
+		rays=rays[stackTops[rays]>rays*stackSize]
+	return distances,hitTriangles,barycentrics
+
+
+class RayCaster(softwareRenderer.SoftwareRenderer):
+	"""Renders the same maps as softwareRenderer.SoftwareRenderer, with the same shading, but finds the surface seen in
+	each pixel by intersecting the ray through the pixel center with the mesh, which gives the exact float coordinates of
+	the point seen. The bounding volume hierarchy of the triangles is built in the model coordinates once per mesh
+	(see cachedBVH) and the rays are moved in the model coordinates for each pose, so that rendering a frame only costs
+	the traversal of the hierarchy"""
+
+	def __init__(self,vertex_data,texture_image,imageSize,focal_length,light,batchSize=64,nbWorkers=None,near=0.1,leafSize=4):
+		softwareRenderer.SoftwareRenderer.__init__(self,vertex_data,texture_image,imageSize,focal_length,light,batchSize,nbWorkers,near)
+		self.bvh=cachedBVH(self.vertices.reshape(-1,3,3),leafSize)
+
+		# rays through the pixel centers in camera coordinates, with a unit z component so that the distance along a ray is the depth
+		cols,rows=np.meshgrid(np.arange(imageSize),np.arange(imageSize))
+		self.rayDirections=np.column_stack(((self.center-cols.ravel())/focal_length,(self.center-rows.ravel())/focal_length,np.ones(imageSize*imageSize)))
+
+	def visibleSurface(self,modelTransform,vertices):
+		"""finds the triangle seen in each pixel by ray casting, returns the indices of the covered pixels in the
+		flattened image, the index of the triangle seen in each of them and the barycentric coordinates of the point seen"""
+		rotation=modelTransform[:3,:3]
+		origin=-rotation.T.dot(modelTransform[:3,3])
+		distances,triangles,barycentrics=castRays(self.bvh,origin,self.rayDirections.dot(rotation),self.near)
+		covered=np.flatnonzero(triangles>=0)
+		u,v=barycentrics[covered,0],barycentrics[covered,1]
+		return covered,triangles[covered],np.column_stack((1-u-v,u,v))
+
+
+def simulateDepthSensor(array_xyz,array_normals,focal_length,rng,noise=True,baseline=0.075,disparityStep=0.125,dropoutAngle=60.0,maxIncidenceAngle=80.0):
+	"""adds the main artifacts of a structured light depth sensor such as the Kinect to the XYZ image, in metres, given
+	the normals oriented toward the camera and the focal length in pixels:
+	 - axial noise with the standard deviation 0.0012+0.0019*(z-0.4)^2 measured by Nguyen et al. (2012) if noise is True
+	 - quantization of the depth, the disparity focal_length*baseline/z being measured in steps of disparityStep pixels
+	 - dropout at grazing angles, the probability to lose a pixel growing linearly from 0 to 1 as the angle between the
+	   ray and the normal goes from dropoutAngle to maxIncidenceAngle degrees
+	The points stay on the rays of their pixels. Returns the new XYZ image, depth and normals with nan on the dropped pixels"""
+	depth=array_xyz[:,:,2].astype(np.float64)
+	valid=~np.isnan(depth)
+	with np.errstate(invalid='ignore'):
+		rays=array_xyz/np.linalg.norm(array_xyz,axis=2)[:,:,None]
+		angles=np.degrees(np.arccos(np.clip(-np.sum(rays*array_normals,axis=2),-1,1)))
+		valid&=rng.random(depth.shape)>=np.clip((angles-dropoutAngle)/(maxIncidenceAngle-dropoutAngle),0,1)
+	depth[~valid]=np.nan
+	if noise:
+		depth+=rng.standard_normal(depth.shape)*(0.0012+0.0019*(depth-0.4)**2)
+	if disparityStep>0:
+		disparity=focal_length*baseline/depth
+		depth=focal_length*baseline/(np.round(disparity/disparityStep)*disparityStep)
+	array_xyz=(array_xyz*(depth/array_xyz[:,:,2])[:,:,None]).astype(np.float32)
+	array_normals=array_normals.copy()
+	array_normals[~valid]=np.nan
+	return array_xyz,depth.astype(np.float32),array_normals
@@ -0,0 +1,327 @@
+# This file contains a software rasterizer written with numpy that renders the same maps as RGBDSequenceGeneration.RGBDRenderer,
+# it is used to generate the synthetic RGBD sequences on machines without OpenGL
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
+
+def smoothstep(edge0,edge1,x):
+	"""same as the GLSL smoothstep function"""
+	t=np.clip((x-edge0)/(edge1-edge0),0.0,1.0)
+	return t*t*(3-2*t)
+
+
+def sampleTexture(texture,texcoords):
+	"""bilinear lookup in the (H,W,C) texture at the (N,2) texture coordinates using the OpenGL conventions: the first
+	row of the array is at v=0, the texel centers are at half integers and the coordinates wrap around"""
+	height,width=texture.shape[:2]
+	x=texcoords[:,0]*width-0.5
+	y=texcoords[:,1]*height-0.5
+	x0=np.floor(x)
+	y0=np.floor(y)
+	fx=(x-x0)[:,None]
+	fy=(y-y0)[:,None]
+	x0=x0.astype(np.int64)%width
+	y0=y0.astype(np.int64)%height
+	x1=(x0+1)%width
+	y1=(y0+1)%height
+	return (texture[y0,x0]*(1-fx)+texture[y0,x1]*fx)*(1-fy)+(texture[y1,x0]*(1-fx)+texture[y1,x1]*fx)*fy
+
+
+def buildMipmaps(texture):
+	"""list of the mipmap levels of the texture, each level averages blocks of 2x2 texels of the previous one"""
+	mipmaps=[texture]
+	while max(texture.shape[:2])>1:
+		height,width=max(texture.shape[0]//2,1),max(texture.shape[1]//2,1)
+		texture=texture[:2*height,:2*width].reshape(height,-1,width,texture.shape[1]//width,texture.shape[2]).mean(axis=(1,3))
+		mipmaps.append(texture)
+	return mipmaps
+
+
+def sampleMipmaps(mipmaps,texcoords,levelOfDetail):
+	"""trilinear lookup: bilinear lookups in the two mipmap levels around the (N,) level of detail, linearly interpolated"""
+	levelOfDetail=np.clip(levelOfDetail,0,len(mipmaps)-1)
+	level=np.floor(levelOfDetail).astype(np.int64)
+	fraction=(levelOfDetail-level)[:,None]
+	colors=np.empty((len(texcoords),mipmaps[0].shape[2]))
+	for idLevel in np.unique(level):
+		selected=level==idLevel
+		colors[selected]=sampleTexture(mipmaps[idLevel],texcoords[selected])
+		if idLevel+1<len(mipmaps):
+			colors[selected]+=fraction[selected]*(sampleTexture(mipmaps[idLevel+1],texcoords[selected])-colors[selected])
+	return colors
+
+
+def textureLevelOfDetail(pixels,depths,texcoords,weights,textureSize):
+	"""mipmap level of detail of each pixel as computed by OpenGL, from the derivatives along the image axes of the
+	perspective correct texture coordinates. pixels (N,3,2), depths (N,3) and texcoords (N,3,2) are those of the
+	vertices of the triangle covering each pixel and weights (N,3) the barycentric coordinates of the pixel center"""
+	a,b,c=pixels[:,0],pixels[:,1],pixels[:,2]
+	area=(b[:,0]-a[:,0])*(c[:,1]-a[:,1])-(b[:,1]-a[:,1])*(c[:,0]-a[:,0])
+	z=np.sum(weights*depths,axis=1)
+	uv=np.einsum('nk,nkc->nc',weights,texcoords)
+	rho=0
+	# derivatives of the screen space barycentric coordinates along the columns and along the rows
+	for derivatives in [np.column_stack((b[:,1]-c[:,1],c[:,1]-a[:,1],a[:,1]-b[:,1])),np.column_stack((c[:,0]-b[:,0],a[:,0]-c[:,0],b[:,0]-a[:,0]))]:
+		derivatives=derivatives/(area[:,None]*depths)
+		duv=(np.einsum('nk,nkc->nc',derivatives,texcoords)-uv*np.sum(derivatives,axis=1)[:,None])*z[:,None]
+		rho=np.maximum(rho,np.linalg.norm(duv*textureSize,axis=1))
+	return np.log2(np.maximum(rho,1e-12))
+
+
+def rasterize(pixels,depths,imageSize,maxCandidates=1<<20):
+	"""z-buffered rasterization of the triangles whose vertices project on the (T,3,2) (column,row) pixel coordinates
+	with the (T,3) positive depths. Returns the index of the closest triangle covering each pixel center (-1 on the
+	background) and the perspective correct barycentric coordinates of the pixel centers in these triangles, as
+	(imageSize*imageSize) and (imageSize*imageSize,3) arrays. The pixel centers of the bounding box of each triangle
+	are tested all at once by chunks of triangles that have at most about maxCandidates pixels in their bounding boxes"""
+	nbPixels=imageSize*imageSize
+	zbuffer=np.full(nbPixels,np.inf)
+	triangleIds=np.full(nbPixels,-1,dtype=np.int64)
+	barycentrics=np.zeros((nbPixels,3))
+
+	p0,p1,p2=pixels[:,0],pixels[:,1],pixels[:,2]
+	area=(p1[:,0]-p0[:,0])*(p2[:,1]-p0[:,1])-(p1[:,1]-p0[:,1])*(p2[:,0]-p0[:,0])
+	colMin=np.maximum(np.ceil(pixels[:,:,0].min(axis=1)),0).astype(np.int64)
+	colMax=np.minimum(np.floor(pixels[:,:,0].max(axis=1)),imageSize-1).astype(np.int64)
+	rowMin=np.maximum(np.ceil(pixels[:,:,1].min(axis=1)),0).astype(np.int64)
+	rowMax=np.minimum(np.floor(pixels[:,:,1].max(axis=1)),imageSize-1).astype(np.int64)
+	ids=np.flatnonzero((area!=0)&(colMax>=colMin)&(rowMax>=rowMin))
+	widths=colMax[ids]-colMin[ids]+1
+	counts=widths*(rowMax[ids]-rowMin[ids]+1)
+	ends=np.cumsum(counts)
+
+	start=0
+	while start<len(ids):
+		end=max(np.searchsorted(ends,ends[start]-counts[start]+maxCandidates,side='right'),start+1)
+		chunk=ids[start:end]
+		chunkCounts=counts[start:end]
+
+		# one candidate per pixel center of the bounding box of each triangle
+		candidates=np.repeat(np.arange(len(chunk)),chunkCounts)
+		offsets=np.arange(len(candidates))-np.repeat(np.cumsum(chunkCounts)-chunkCounts,chunkCounts)
+		width=widths[start:end][candidates]
+		col=colMin[chunk][candidates]+offsets%width
+		row=rowMin[chunk][candidates]+offsets//width
+		triangles=chunk[candidates]
+
+		# screen space barycentric coordinates, the pixel centers on the edges are covered by both triangles
+		a,b,c=p0[triangles],p1[triangles],p2[triangles]
+		l0=((b[:,0]-col)*(c[:,1]-row)-(b[:,1]-row)*(c[:,0]-col))/area[triangles]
+		l1=((c[:,0]-col)*(a[:,1]-row)-(c[:,1]-row)*(a[:,0]-col))/area[triangles]
+		l2=1-l0-l1
+		inside=(l0>=0)&(l1>=0)&(l2>=0)
+		lambdas=np.column_stack((l0[inside],l1[inside],l2[inside]))
+		triangles=triangles[inside]
+		keys=row[inside]*imageSize+col[inside]
+
+		# perspective correction, the inverse of the depth is linear in screen space
+		weights=lambdas/depths[triangles]
+		z=1/np.sum(weights,axis=1)
+		weights*=z[:,None]
+
+		# closest candidate of each pixel, kept if it is closer than the previous chunks
+		order=np.lexsort((z,keys))
+		first=order[np.r_[True,keys[order[1:]]!=keys[order[:-1]]]] if len(order)>0 else order
+		first=first[z[first]<zbuffer[keys[first]]]
+		zbuffer[keys[first]]=z[first]
+		triangleIds[keys[first]]=triangles[first]
+		barycentrics[keys[first]]=weights[first]
+		start=end
+
+	return triangleIds,barycentrics
+
+
+def stackMaps(frames):
+	"""converts a list of (array_rgb,array_xyz,array_depth,array_normals) tuples into a tuple of arrays with one image per frame"""
+	return tuple(np.stack(maps) for maps in zip(*frames))
+
+
+workerData={}
+
+
+def initWorker(renderer):
+	"""keeps a copy of the renderer in each process of the pool, the frames are rendered in the process"""
+	renderer.nbWorkers=0
+	workerData['renderer']=renderer
+
+
+def renderMapsInWorker(modelTransform):
+	return workerData['renderer'].renderMaps(modelTransform)
+
+
+class SoftwareRenderer():
+	"""Renders the RGB image, the XYZ image, the linear depth and the normals of a textured mesh with the same camera,
+	shading and conventions as RGBDSequenceGeneration.RGBDRenderer, whose methods it mirrors, without OpenGL.
+	Each frame is rasterized with a z-buffer and the XYZ coordinates, normals and texture coordinates are interpolated
+	with perspective correct barycentric coordinates. The frames of a batch are rendered on a pool of nbWorkers
+	processes (in the calling process if nbWorkers is 0). The texture is sampled with trilinear mipmapping as in OpenGL,
+	triangles crossing the near plane are not clipped but discarded"""
+
+	def __init__(self,vertex_data,texture_image,imageSize,focal_length,light,batchSize=64,nbWorkers=None,near=0.1):
+		self.vertex_data=vertex_data
+		self.texture_image=texture_image
+		self.imageSize=imageSize
+		self.focal_length=focal_length
+		self.light=np.array(light,dtype=np.float64)
+		self.batchSize=batchSize
+		self.nbWorkers=os.cpu_count() if nbWorkers is None else nbWorkers
+		self.near=near
+		self.center=(imageSize-1)/2.0
+
+		# vertex_data has the layout given by pointCloudIO.interleaveOBJ, three rows per triangle
+		if hasattr(vertex_data,'pack'):
+			vertex_data=np.frombuffer(vertex_data.pack(),dtype=np.float32).reshape(-1,9)
+		vertex_data=np.asarray(vertex_data,dtype=np.float64)
+		self.vertices=vertex_data[:,0:3]
+		self.texcoords=vertex_data[:,3:5].reshape(-1,3,2)
+		self.normals=vertex_data[:,6:9]
+
+		# the texture is flipped as in RGBDRenderer so that v=0 is the bottom of the image
+		texture=np.asarray(texture_image.convert('RGB'),dtype=np.float64)[::-1]/255.0
+		self.textureSize=np.array([texture.shape[1],texture.shape[0]])
+		self.mipmaps=buildMipmaps(texture)
+		self.pool=None
+
+	def __getstate__(self):
+		# the renderer is copied into the processes of the pool without the pool itself
+		state=self.__dict__.copy()
+		state['pool']=None
+		return state
+
+	def visibleSurface(self,modelTransform,vertices):
+		"""finds the triangle seen in each pixel given the (T,3,3) triangles in camera coordinates, returns the indices
+		of the covered pixels in the flattened image, the index of the triangle seen in each of them and the barycentric
+		coordinates of the point seen in the triangle"""
+		# the x and y axes of the camera point to the left and to the top of the image, see RGBDSequenceIO.cameraIntrinsics
+		visible=np.flatnonzero(np.all(vertices[:,:,2]>self.near,axis=1))
+		depths=vertices[visible,:,2]
+		pixels=self.center-self.focal_length*vertices[visible,:,:2]/depths[:,:,None]
+		triangleIds,barycentrics=rasterize(pixels,depths,self.imageSize)
+		covered=np.flatnonzero(triangleIds>=0)
+		return covered,visible[triangleIds[covered]],barycentrics[covered]
+
+	def renderMaps(self,modelTransform):
+		"""returns the RGB image, the XYZ image, the linear depth (distance along the optical axis) and the normals
+		oriented toward the camera. Background pixels are nan in the last three"""
+		imageSize=self.imageSize
+		modelTransform=np.asarray(modelTransform,dtype=np.float64)
+		vertices=(self.vertices.dot(modelTransform[:3,:3].T)+modelTransform[:3,3]).reshape(-1,3,3)
+		normals=self.normals.dot(modelTransform[:3,:3].T).reshape(-1,3,3)
+
+		covered,triangles,weights=self.visibleSurface(modelTransform,vertices)
+		xyz=np.einsum('nk,nkc->nc',weights,vertices[triangles])
+		normal=np.einsum('nk,nkc->nc',weights,normals[triangles])
+		normal/=np.linalg.norm(normal,axis=1)[:,None]
+		texcoords=np.einsum('nk,nkc->nc',weights,self.texcoords[triangles])
+
+		# same shading as the fragment shader of RGBDRenderer
+		toLight=xyz-self.light
+		toLight/=np.linalg.norm(toLight,axis=1)[:,None]
+		lum=np.arccos(np.clip(np.sum(normal*toLight,axis=1),-1,1))/np.pi
+		lum=smoothstep(0.0,1.0,lum*lum)
+		lum*=smoothstep(0.0,80.0,xyz[:,2])*0.3+0.7
+		lum=lum*0.3+0.7
+		depths=vertices[triangles,:,2]
+		pixels=self.center-self.focal_length*vertices[triangles,:,:2]/depths[:,:,None]
+		levelOfDetail=textureLevelOfDetail(pixels,depths,self.texcoords[triangles],weights,self.textureSize)
+		color=sampleMipmaps(self.mipmaps,texcoords,levelOfDetail)*0.75+0.25
+		normal[np.sum(normal*xyz,axis=1)>0]*=-1
+
+		array_rgb=np.full((imageSize*imageSize,3),0.9)
+		array_rgb[covered]=color*lum[:,None]
+		array_rgb=np.round(np.clip(array_rgb,0,1)*255).astype(np.uint8).reshape(imageSize,imageSize,3)
+		array_xyz=np.full((imageSize*imageSize,3),np.nan,dtype=np.float32)
+		array_xyz[covered]=xyz
+		array_normals=np.full((imageSize*imageSize,3),np.nan,dtype=np.float32)
+		array_normals[covered]=normal
+		array_xyz=array_xyz.reshape(imageSize,imageSize,3)
+		array_depth=array_xyz[:,:,2].copy()
+		return array_rgb,array_xyz,array_depth,array_normals.reshape(imageSize,imageSize,3)
+
+	def render(self,modelTransform):
+		"""returns two numpy arrays, containing respectively the RGB image and the 3D point cloud scene from the camera"""
+		array_rgb,array_xyz,array_depth,array_normals=self.renderMaps(modelTransform)
+		return array_rgb,array_xyz
+
+	def renderDepth(self,modelTransform):
+		"""returns the linear depth map (distance along the optical axis), with nan on the background"""
+		return self.renderMaps(modelTransform)[2]
+
+	def renderMapsBatch(self,modelTransforms):
+		"""renders the mesh in each of the poses given by the (N,4,4) array modelTransforms and returns (N,H,W,3) RGB
+		and XYZ arrays, the (N,H,W) depths and (N,H,W,3) normals"""
+		modelTransforms=np.asarray(modelTransforms).reshape(-1,4,4)
+		results=[np.concatenate(maps) for maps in zip(*[chunk for start,chunk in self.iterateBatches(modelTransforms)])]
+		return tuple(results)
+
+	def renderBatch(self,modelTransforms):
+		"""renders the mesh in each of the poses given by the (N,4,4) array modelTransforms and returns
+		(N,H,W,3) RGB and XYZ arrays"""
+		array_rgb,array_xyz,array_depth,array_normals=self.renderMapsBatch(modelTransforms)
+		return array_rgb,array_xyz
+
+	def iterateBatches(self,modelTransforms):
+		"""generator rendering the poses by chunks of batchSize, yields the index of the first pose of the chunk and
+		the tuple of maps returned by renderMapsBatch for this chunk. With a pool of processes the next chunk is
+		rendered while the current one is used, at most two chunks are kept in memory"""
+		modelTransforms=np.asarray(modelTransforms).reshape(-1,4,4)
+		starts=range(0,len(modelTransforms),self.batchSize)
+		if self.nbWorkers<=1:
+			for start in starts:
+				yield start,stackMaps([self.renderMaps(modelTransform) for modelTransform in modelTransforms[start:start+self.batchSize]])
+			return
+		if self.pool is None:
+			self.pool=ProcessPoolExecutor(self.nbWorkers,initializer=initWorker,initargs=(self,))
+		pending=collections.deque()
+		try:
+			for start in starts:
+				pending.append((start,[self.pool.submit(renderMapsInWorker,modelTransform) for modelTransform in modelTransforms[start:start+self.batchSize]]))
+				if len(pending)>1:
+					start,futures=pending.popleft()
+					yield start,stackMaps([future.result() for future in futures])
+			while pending:
+				start,futures=pending.popleft()
+				yield start,stackMaps([future.result() for future in futures])
+		finally:
+			# the frames that are not needed anymore if the iteration stops early are not rendered
+			for start,futures in pending:
+				for future in futures:
+					future.cancel()
+
+	def release(self):
+		"""shuts down the pool of processes"""
+		if self.pool is not None:
+			self.pool.shutdown()
+			self.pool=None
@@ -0,0 +1,397 @@
+# This file contains a python implementation of the tracking done by pcl/surfaceAlign.cpp: the pose of a rigid
+# model is refined in each frame with the Iterative Closest Point method, starting from the pose in the previous frame.
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+import time
+from scipy.spatial import cKDTree
+from scipy import ndimage
+import pointCloudIO
+import pointCloudProcessing
+import RGBDSequenceIO
+import globalRegistration
+import modelCache
+import posePrediction
+
+# parameters of runTrackingPCL_Crate.bat and runTrackingPCL_Duck.bat, in the order of the surfaceAlign executable arguments
+trackingParameters=dict([
+	('crate',dict([('icpMaxIter',30),('voxelGridSize',0.05),('minSampleDistance',0.05),('maxCorrespondenceDistance',0.02),
+		('ICPMaxCorrespondenceDistance',0.1),('initMaxIter',200),('RadiusSearch',0.05),('featureRadius',0.1)])),
+	('duck',dict([('icpMaxIter',30),('voxelGridSize',0.03),('minSampleDistance',0.1),('maxCorrespondenceDistance',0.008),
+		('ICPMaxCorrespondenceDistance',0.05),('initMaxIter',200),('RadiusSearch',0.3),('featureRadius',0.1)]))])
+
+
+def loadModel(objFile):
+	"""returns the vertices of the OBJ file and their normals computed from the triangles"""
+	vertices,texcoords,normals,faces=pointCloudIO.loadOBJ(objFile)
+	return vertices,pointCloudProcessing.computeVertexNormals(vertices,faces[:,:,0])
+
+
+def pointToPointUpdate(source,target):
+	"""rigid transform minimizing the sum of the squared distances between the transformed source points and the
+	target points, in closed form using the SVD of the cross-covariance matrix (Kabsch)"""
+	sourceCenter=source.mean(axis=0)
+	targetCenter=target.mean(axis=0)
+	H=(source-sourceCenter).T.dot(target-targetCenter)
+	U,S,Vt=np.linalg.svd(H)
+	D=np.eye(3)
+	D[2,2]=np.sign(np.linalg.det(Vt.T.dot(U.T)))
+	rotation=Vt.T.dot(D).dot(U.T)
+	return pointCloudProcessing.rigidTransform(rotation,targetCenter-rotation.dot(sourceCenter))
+
+
+def pointToPlaneUpdate(source,target,targetNormals,pointToPointMask=None):
+	"""rigid transform minimizing the sum of the squared distances between the transformed source points and the
+	tangent planes at the target points, using the small angle approximation of the rotation. The pairs where
+	pointToPointMask is True contribute their point to point distance instead"""
+	A=np.column_stack((np.cross(source,targetNormals),targetNormals))
+	b=np.sum(targetNormals*(target-source),axis=1)
+	if pointToPointMask is not None and np.any(pointToPointMask):
+		# the rotation w moves s by w x s=-[s]x w, giving three rows per pair
+		points=source[pointToPointMask]
+		zeros=np.zeros(len(points))
+		ones=np.ones(len(points))
+		Ax=np.column_stack((zeros,points[:,2],-points[:,1],ones,zeros,zeros))
+		Ay=np.column_stack((-points[:,2],zeros,points[:,0],zeros,ones,zeros))
+		Az=np.column_stack((points[:,1],-points[:,0],zeros,zeros,zeros,ones))
+		residuals=target[pointToPointMask]-points
+		A=np.vstack((A[~pointToPointMask],Ax,Ay,Az))
+		b=np.concatenate((b[~pointToPointMask],residuals[:,0],residuals[:,1],residuals[:,2]))
+	x=np.linalg.lstsq(A.T.dot(A),A.T.dot(b),rcond=None)[0]
+	return pointCloudProcessing.rigidTransform(pointCloudProcessing.rotationFromVector(x[:3]),x[3:])
+
+
+def centroidAlignment(modelPoints,scenePoints):
+	"""pose without rotation that moves the centroid of the model onto the centroid of the scene"""
+	return pointCloudProcessing.rigidTransform(np.eye(3),scenePoints.mean(axis=0)-modelPoints.mean(axis=0))
+
+
+class ICPTracker():
+	"""Iterative closest point tracking of a rigid model in a sequence of point clouds, as the ICP loop of surfaceAlign.cpp.
+	As in PCL the scene is the source that is moved onto the model, the poses returned are the model to camera transforms.
+	errorMetric is 'point_to_point' (closed form SVD update) or 'point_to_plane' which needs the model normals and
+	usually converges in fewer iterations.
+	With association='nearest' each scene point is paired with the closest model point using a KD-tree built once on
+	the model, if voxelGridSize is given the scene points are first replaced by the centroids of the voxels.
+	modelTree is the KD-tree of the model points if it has already been built, see modelCache.
+	With association='projective' the scenes are organized H x W x 3 XYZ images with NaN background and the
+	intrinsics matrix of the camera (see RGBDSequenceIO.cameraIntrinsics) is needed: the model points facing the
+	camera are projected in the image with the current pose and paired with the scene point in the same pixel,
+	which costs O(nbModelPoints) per iteration without any tree. The model points falling on the background are
+	paired with the scene point of the closest pixel of the object, otherwise nothing would prevent the model from
+	sliding along planar faces such as the ones of the crate.
+	levelIterations enables the coarse to fine alignment on organized scenes: levelIterations[l] iterations are done
+	on the level l of the pyramid of the XYZ image (see pointCloudProcessing.buildPyramid), starting from the coarsest
+	level, instead of icpMaxIter iterations at full resolution. With the projective association the coarse levels
+	also use a random subset of the model points, 4 times smaller at each level, and the model points falling on the
+	background are pulled toward the silhouette with their point to point distance as the plane of a face of the crate
+	does not constrain the sliding any more once its edges have been averaged away.
+	With motionModel='constant_velocity' or 'kalman' the ICP of each frame starts from the pose predicted from the
+	previous frames (see posePrediction) instead of the previous pose. The ICP stops when the rotation angle and the
+	translation of the update are both below transformationEpsilon or, if euclideanFitnessEpsilon is given, when the
+	mean squared distance of the pairs changes by less than euclideanFitnessEpsilon times its value between two
+	iterations, so that the frames starting close to the solution only need a few iterations"""
+
+	def __init__(self,modelPoints,modelNormals=None,icpMaxIter=30,ICPMaxCorrespondenceDistance=0.1,voxelGridSize=None,
+			errorMetric=None,transformationEpsilon=1e-6,association='nearest',intrinsics=None,levelIterations=None,modelTree=None,
+			motionModel=None,euclideanFitnessEpsilon=None):
+		self.modelPoints=np.asarray(modelPoints,dtype=np.float64)
+		self.modelNormals=None if modelNormals is None else np.asarray(modelNormals,dtype=np.float64)
+		if errorMetric is None:
+			errorMetric='point_to_point' if modelNormals is None else 'point_to_plane'
+		if errorMetric=='point_to_plane' and modelNormals is None:
+			raise ValueError('the point to plane error needs the model normals')
+		if association=='projective' and intrinsics is None:
+			raise ValueError('the projective association needs the camera intrinsics')
+		self.errorMetric=errorMetric
+		self.icpMaxIter=icpMaxIter
+		self.ICPMaxCorrespondenceDistance=ICPMaxCorrespondenceDistance
+		self.voxelGridSize=voxelGridSize
+		self.transformationEpsilon=transformationEpsilon
+		self.euclideanFitnessEpsilon=euclideanFitnessEpsilon
+		self.motionModel=motionModel
+		# an unknown motion model raises an error here rather than in the first frame
+		posePrediction.createPredictor(motionModel)
+		self.association=association
+		self.intrinsics=None if intrinsics is None else np.asarray(intrinsics,dtype=np.float64)
+		self.levelIterations=levelIterations
+		nbLevels=1 if levelIterations is None else len(levelIterations)
+		permutation=np.random.RandomState(0).permutation(len(self.modelPoints))
+		self.modelSubsets=[np.sort(permutation[:max(len(permutation)//4**level,min(len(permutation),500))]) for level in range(nbLevels)]
+		if intrinsics is not None:
+			self.levelIntrinsics=[pointCloudProcessing.pyramidIntrinsics(self.intrinsics,level) for level in range(nbLevels)]
+		if association=='nearest':
+			self.tree=cKDTree(self.modelPoints) if modelTree is None else modelTree
+		elif association!='projective':
+			raise ValueError('unknown association %s'%association)
+
+	def preprocess(self,scenePoints):
+		"""valid scene points, downsampled if voxelGridSize is set, or for the projective association the organized XYZ
+		image with its background filled and the background mask"""
+		if self.association=='projective':
+			scene=np.asarray(scenePoints,dtype=np.float64)
+			if scene.ndim!=3:
+				raise ValueError('the projective association needs organized H x W x 3 scenes')
+			background=np.isnan(scene).any(axis=2)
+			if np.all(background):
+				return scene,background
+			# each background pixel receives the point of the closest pixel of the object, computed once per frame
+			rows,columns=ndimage.distance_transform_edt(background,return_distances=False,return_indices=True)
+			return scene[rows,columns],background
+		points=pointCloudProcessing.validPoints(scenePoints).astype(np.float64)
+		if self.voxelGridSize:
+			points=pointCloudProcessing.voxelGridFilter(points,self.voxelGridSize)
+		return points
+
+	def nearestCorrespondences(self,points,sceneToModel):
+		source=pointCloudProcessing.transformPoints(sceneToModel,points)
+		distances,indices=self.tree.query(source,distance_upper_bound=self.ICPMaxCorrespondenceDistance)
+		inliers=np.isfinite(distances)
+		return source[inliers],indices[inliers],distances[inliers],None
+
+	def projectiveCorrespondences(self,scene,sceneToModel,level=0):
+		"""scene is the XYZ image of the pyramid level and its background mask as returned by preprocess, also returns
+		which scene points come from the background"""
+		scene,background=scene
+		modelToCamera=pointCloudProcessing.invertRigidTransform(sceneToModel)
+		subset=self.modelSubsets[level]
+		points=pointCloudProcessing.transformPoints(modelToCamera,self.modelPoints[subset])
+		visible=points[:,2]>0
+		if self.modelNormals is not None:
+			# back-face culling, the camera is at the origin
+			normals=self.modelNormals[subset].dot(modelToCamera[:3,:3].T)
+			visible&=np.sum(normals*points,axis=1)<0
+		indices=np.flatnonzero(visible)
+		points=points[indices]
+		indices=subset[indices]
+		height,width=scene.shape[:2]
+		K=self.levelIntrinsics[level]
+		columns=np.rint(K[0,0]*points[:,0]/points[:,2]+K[0,2]).astype(np.int64)
+		rows=np.rint(K[1,1]*points[:,1]/points[:,2]+K[1,2]).astype(np.int64)
+		inImage=(columns>=0)&(columns<width)&(rows>=0)&(rows<height)
+		indices=indices[inImage]
+		scenePoints=scene[rows[inImage],columns[inImage]]
+		silhouette=background[rows[inImage],columns[inImage]]
+		distances=np.linalg.norm(scenePoints-points[inImage],axis=1)
+		# the NaN background gives NaN distances that are rejected as well
+		inliers=distances<self.ICPMaxCorrespondenceDistance
+		source=pointCloudProcessing.transformPoints(sceneToModel,scenePoints[inliers])
+		return source,indices[inliers],distances[inliers],silhouette[inliers]
+
+	def correspondences(self,scene,sceneToModel,level=0):
+		"""returns the scene points paired with a model point moved in the model coordinate system, the indices of
+		the model points, the distances and the mask of the pairs made with a filled background pixel (None for
+		the nearest association)"""
+		if self.association=='projective':
+			return self.projectiveCorrespondences(scene,sceneToModel,level)
+		return self.nearestCorrespondences(scene,sceneToModel)
+
+	def align(self,scenePoints,initialPose):
+		"""refines the model pose initialPose (4x4 model to camera transform) in the scene, returns the refined pose and
+		a dictionary with the number of iterations, the number of inliers, the fitness score (mean squared distance
+		of the inliers as pcl getFitnessScore), whether the ICP has converged and the time in seconds spent in the
+		preprocessing, correspondences and solve stages"""
+		timings=dict([('preprocessing',0.0),('correspondences',0.0),('solve',0.0)])
+		start=time.perf_counter()
+		if self.levelIterations is None:
+			levelScenes=[scenePoints]
+			schedule=[(0,self.icpMaxIter)]
+		else:
+			if np.ndim(scenePoints)!=3:
+				raise ValueError('the coarse to fine alignment needs organized H x W x 3 scenes')
+			levelScenes=[xyz for rgb,xyz in pointCloudProcessing.buildPyramid(None,np.asarray(scenePoints,dtype=np.float64),len(self.levelIterations))]
+			schedule=[(level,self.levelIterations[level]) for level in reversed(range(len(self.levelIterations)))]
+		timings['preprocessing']+=time.perf_counter()-start
+		sceneToModel=pointCloudProcessing.invertRigidTransform(initialPose)
+		nbIterations=0
+		for level,levelMaxIter in schedule:
+			if levelMaxIter==0 and level>0:
+				continue
+			start=time.perf_counter()
+			scene=self.preprocess(levelScenes[level])
+			timings['preprocessing']+=time.perf_counter()-start
+			converged=False
+			previousFitness=None
+			for iteration in range(levelMaxIter):
+				start=time.perf_counter()
+				source,indices,distances,silhouette=self.correspondences(scene,sceneToModel,level)
+				timings['correspondences']+=time.perf_counter()-start
+				if len(indices)<6:
+					break
+				fitness=np.mean(distances**2)
+				if self.euclideanFitnessEpsilon is not None and previousFitness is not None and abs(previousFitness-fitness)<=self.euclideanFitnessEpsilon*fitness:
+					converged=True
+					break
+				previousFitness=fitness
+				nbIterations+=1
+				start=time.perf_counter()
+				if self.errorMetric=='point_to_plane':
+					update=pointToPlaneUpdate(source,self.modelPoints[indices],self.modelNormals[indices],silhouette if level>0 else None)
+				else:
+					update=pointToPointUpdate(source,self.modelPoints[indices])
+				sceneToModel=update.dot(sceneToModel)
+				timings['solve']+=time.perf_counter()-start
+				rotationChange=np.arccos(np.clip((np.trace(update[:3,:3])-1)/2,-1,1))
+				if rotationChange<self.transformationEpsilon and np.linalg.norm(update[:3,3])<self.transformationEpsilon:
+					converged=True
+					break
+		start=time.perf_counter()
+		source,indices,distances,silhouette=self.correspondences(scene,sceneToModel)
+		timings['correspondences']+=time.perf_counter()-start
+		info=dict([('iterations',nbIterations),('inliers',len(indices)),
+			('fitness',float(np.mean(distances**2)) if len(indices)>0 else np.inf),('converged',converged),('timings',timings)])
+		return pointCloudProcessing.invertRigidTransform(sceneToModel),info
+
+	def track(self,scenes,initialPose=None,initialAlignment=None,minInliers=10):
+		"""generator refining the pose in each scene of an iterable of point clouds, starting from the pose found in the
+		previous scene. The first pose is initialPose, or if it is None the pose found by initialAlignment (a
+		globalRegistration.GlobalRegistration object) or the centroid alignment. The initial alignment is run again
+		when the tracking is lost, i.e. when fewer than minInliers scene points are paired. Yields (pose,info)"""
+		pose=initialPose
+		predictor=posePrediction.createPredictor(self.motionModel)
+		for scenePoints in scenes:
+			pose,info=self.trackFrame(scenePoints,pose,initialAlignment,minInliers,predictor)
+			yield pose,info
+
+	def trackFrame(self,scenePoints,previousPose=None,initialAlignment=None,minInliers=10,predictor=None):
+		"""pose of the model in a scene starting from its pose in the previous scene, or from the pose predicted by
+		predictor if it is given (see posePrediction), which is then updated with the pose found, see track"""
+		predicted=predictor.predict() if predictor is not None else None
+		if predicted is not None:
+			previousPose=predicted
+		if previousPose is None:
+			previousPose=self.initialPose(scenePoints,initialAlignment)
+		pose,info=self.align(scenePoints,previousPose)
+		if info['inliers']<minInliers and initialAlignment is not None:
+			pose,info=self.align(scenePoints,self.initialPose(scenePoints,initialAlignment))
+			# the motion before the tracking was lost does not tell anything about the next frames
+			if predictor is not None:
+				predictor.reset()
+		if predictor is not None:
+			predictor.update(pose)
+		return pose,info
+
+	def initialPose(self,scenePoints,initialAlignment=None):
+		if initialAlignment is None:
+			return centroidAlignment(self.modelPoints,pointCloudProcessing.validPoints(scenePoints))
+		return initialAlignment.align(scenePoints)[0]
+
+
+def trackPCDSequence(objFile,pcdSequenceFile,outputFolder=None,initialPose=None,errorMetric=None,globalInitialization=False,cache=None,
+		**parameters):
+	"""tracks the model of the OBJ file in the point clouds listed in pcdSequenceFile with the parameters of the
+	surfaceAlign executable, returns the poses and saves them in outputFolder/poses.txt if outputFolder is given.
+	If globalInitialization is True the first pose is found with FPFH features and RANSAC as in surfaceAlign.cpp.
+	The processed model is loaded from the modelCache.ModelCache cache if it is given"""
+	model=loadModelAssets(objFile,globalInitialization,parameters,cache)
+	tracker=createTracker(model,parameters,errorMetric)
+	frames=pointCloudIO.openPCDSequence(pcdSequenceFile)
+	return runTracker(tracker,(frame.points for frame in frames),initialPose,outputFolder,model if globalInitialization else None,parameters)
+
+
+def trackRGBDSequence(objFile,sequenceFile,outputFolder=None,initialPose=None,errorMetric=None,association='projective',
+		globalInitialization=False,cache=None,**parameters):
+	"""tracks the model of the OBJ file in the XYZ images of a sequence file written by RGBDSequenceIO, using by default
+	the projective association with the intrinsics stored in the file, see trackPCDSequence"""
+	model=loadModelAssets(objFile,globalInitialization,parameters,cache)
+	sequence=RGBDSequenceIO.RGBDSequenceReader(sequenceFile)
+	tracker=createTracker(model,parameters,errorMetric,association,sequence.intrinsics)
+	return runTracker(tracker,sequence.xyz,initialPose,outputFolder,model if globalInitialization else None,parameters)
+
+
+def createTracker(model,parameters,errorMetric=None,association='nearest',intrinsics=None):
+	"""ICPTracker of the model, a dictionary returned by modelCache.loadModelAssets, with the parameters of the
+	surfaceAlign executable and the ICPTracker options given in parameters"""
+	return ICPTracker(model['points'],model['normals'],parameters.get('icpMaxIter',30),parameters.get('ICPMaxCorrespondenceDistance',0.1),
+		parameters.get('voxelGridSize'),errorMetric,parameters.get('transformationEpsilon',1e-6),association=association,
+		intrinsics=intrinsics,levelIterations=parameters.get('levelIterations'),modelTree=model['modelTree'],
+		motionModel=parameters.get('motionModel'),euclideanFitnessEpsilon=parameters.get('euclideanFitnessEpsilon'))
+
+
+def loadModelAssets(objFile,globalInitialization,parameters,cache=None):
+	"""points, normals and KD-tree of the model, and its features if globalInitialization is True"""
+	if globalInitialization:
+		return modelCache.loadModelAssets(objFile,parameters.get('RadiusSearch',0.05),parameters.get('featureRadius',0.1),cache)
+	return modelCache.loadModelAssets(objFile,cache=cache)
+
+
+def trackFrames(tracker,frames,initialPose=None,initialAlignment=None):
+	"""tracks the model in a stream of (rgb,xyz,pose) frames such as the ones produced by the stages of framePipeline,
+	one frame at a time. Yields (pose,info,frame) so that the estimated pose can be compared to the ground truth pose"""
+	pose=initialPose
+	predictor=posePrediction.createPredictor(tracker.motionModel)
+	for frame in frames:
+		pose,info=tracker.trackFrame(frame[1],pose,initialAlignment,predictor=predictor)
+		yield pose,info,frame
+
+
+def createGlobalRegistration(model,parameters):
+	"""initial alignment with the SampleConsensusInitialAlignment parameters of the surfaceAlign executable, model
+	is a dictionary returned by modelCache.loadModelAssets with the features"""
+	return globalRegistration.GlobalRegistration(model['points'],model['normals'],parameters.get('RadiusSearch',0.05),parameters.get('featureRadius',0.1),
+		parameters.get('voxelGridSize'),parameters.get('minSampleDistance',0.05),parameters.get('maxCorrespondenceDistance',0.02),
+		nbWorkers=parameters.get('nbWorkers'),modelFeatures=model['features'],modelTree=model['modelTree'],featureTree=model['featureTree'])
+
+
+def runTracker(tracker,scenes,initialPose,outputFolder,model=None,parameters=None,progress=None):
+	"""runs the tracker on the scenes, the initial alignment is done with the features of model if it is given.
+	progress(idFrame,pose,info) is called after each frame, by default the number of iterations and the score are printed"""
+	if parameters is None:
+		parameters=dict()
+	poses=[]
+	initialAlignment=None
+	if model is not None:
+		initialAlignment=createGlobalRegistration(model,parameters)
+	try:
+		for idFrame,(pose,info) in enumerate(tracker.track(scenes,initialPose,initialAlignment)):
+			if progress is None:
+				print('frame %d: %d iterations, %d inliers, score %f'%(idFrame,info['iterations'],info['inliers'],info['fitness']))
+			else:
+				progress(idFrame,pose,info)
+			poses.append(pose)
+	finally:
+		if initialAlignment is not None:
+			initialAlignment.close()
+	poses=np.array(poses)
+	if outputFolder is not None:
+		if not os.path.exists(outputFolder):
+			os.makedirs(outputFolder)
+		pointCloudIO.savePoses(os.path.join(outputFolder,'poses.txt'),poses)
+	return poses
+
+
+if __name__ == "__main__":
+	cache=modelCache.ModelCache('cache')
+	trackPCDSequence('data/crate/crateResampled.obj','sequence/crate/pcdSequence.txt','result/crate',globalInitialization=True,cache=cache,
+		**trackingParameters['crate'])
+	trackPCDSequence('data/duck/duckResampled.obj','sequence/duck/pcdSequence.txt','result/duck',globalInitialization=True,cache=cache,
+		**trackingParameters['duck'])
@@ -0,0 +1,232 @@
+# Round trip tests of the PCD and PTX files written and read by pointCloudIO
+#
+#	python -m unittest testPointCloudIO
+#
+# License FreeBSD:
+#
+# Copyright (c) 2018  Martin de La Gorce
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR
+# ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are those
+# of the authors and should not be interpreted as representing official policies,
+# either expressed or implied, of the FreeBSD Project.
+
+import numpy as np
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import pointCloudIO
+
+
+def randomFrame(height,width,seed=0):
+	"""random organized point cloud with colors, a few NaN points and float, unsigned and signed integer fields"""
+	rng=np.random.RandomState(seed)
+	points=(rng.rand(height,width,3)*4-2).astype(np.float32)
+	points[rng.rand(height,width)<0.1]=np.nan
+	colors=rng.randint(0,256,(height,width,3)).astype(np.uint8)
+	data=dict([('intensity',rng.rand(height,width).astype(np.float32)),('label',rng.randint(0,100,(height,width)).astype(np.uint32)),
+		('offset',rng.randint(-100,100,(height,width)).astype(np.int32))])
+	return points,colors,data
+
+
+class PCDTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder=tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def roundTrip(self,points,colors,data,format):
+		fileName=os.path.join(self.folder,format+'.pcd')
+		pointCloudIO.savePCD(fileName,None,points,colors,data=data,format=format)
+		return pointCloudIO.loadPCD(fileName)
+
+	def checkSameCloud(self,a,b,atol=0):
+		"""checks that two results of loadPCD contain the same points, colors and fields"""
+		self.assertTrue(np.allclose(a[0],b[0],rtol=0,atol=atol,equal_nan=True))
+		self.assertTrue(np.array_equal(a[1],b[1]))
+		self.assertEqual(sorted(a[2].keys()),sorted(b[2].keys()))
+		for k in a[2].keys():
+			self.assertEqual(a[2][k].dtype,b[2][k].dtype)
+			self.assertTrue(np.allclose(a[2][k],b[2][k],rtol=0,atol=atol))
+
+	def testFormats(self):
+		points,colors,data=randomFrame(30,40)
+		reference=self.roundTrip(points,colors,data,'binary')
+		self.assertTrue(np.array_equal(reference[0],points,equal_nan=True))
+		self.assertTrue(np.array_equal(reference[1],colors.reshape(-1,3)))
+		for name,values in data.items():
+			self.assertTrue(np.array_equal(reference[2][name],values.reshape(-1)))
+		self.checkSameCloud(self.roundTrip(points,colors,data,'binary_compressed'),reference)
+		# the ascii format keeps 7 decimals
+		self.checkSameCloud(self.roundTrip(points,colors,data,'ascii'),reference,atol=1e-6)
+
+	def testCompressedCodecs(self):
+		points,colors,data=randomFrame(30,40)
+		# smooth surface with a constant background, so that the codecs find repeated sequences
+		points[:,:,2]=np.linspace(1,2,40)[None,:]
+		points[:15]=0
+		reference=self.roundTrip(points,colors,data,'binary')
+		with mock.patch.object(pointCloudIO,'lzf',None):
+			self.checkSameCloud(self.roundTrip(points,colors,data,'binary_compressed'),reference)
+		if pointCloudIO.lzf is not None:
+			self.checkSameCloud(self.roundTrip(points,colors,data,'binary_compressed'),reference)
+
+	def testEmptyCloud(self):
+		points=np.zeros((1,0,3),dtype=np.float32)
+		colors=np.zeros((1,0,3),dtype=np.uint8)
+		for format in ['ascii','binary','binary_compressed']:
+			cloud=self.roundTrip(points,colors,None,format)
+			self.assertEqual(cloud[0].shape,(1,0,3))
+			self.assertEqual(cloud[1].shape,(0,3))
+		with mock.patch.object(pointCloudIO,'lzf',None):
+			self.assertEqual(self.roundTrip(points,colors,None,'binary_compressed')[0].shape,(1,0,3))
+
+	def testTruncatedHeader(self):
+		points,colors,data=randomFrame(2,3)
+		fileName=os.path.join(self.folder,'truncated.pcd')
+		pointCloudIO.savePCD(fileName,None,points,colors,format='binary')
+		with open(fileName,'rb') as f:
+			content=f.read()
+		with open(fileName,'wb') as f:
+			f.write(content[:content.index(b'POINTS')]+b'\n\n')
+		# loaded in a thread so that a header parser looping at the end of the file fails the test instead of hanging
+		errors=[]
+		def load():
+			for function in [pointCloudIO.loadPCD,pointCloudIO.openPCD]:
+				try:
+					function(fileName)
+				except ValueError as error:
+					errors.append(error)
+		thread=threading.Thread(target=load,daemon=True)
+		thread.start()
+		thread.join(10)
+		self.assertFalse(thread.is_alive())
+		self.assertEqual(len(errors),2)
+
+
+class PTXTest(unittest.TestCase):
+
+	def setUp(self):
+		self.folder=tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.folder)
+
+	def testFormat(self):
+		"""the points are written column after column, from the bottom to the top of each column"""
+		points=np.array([[[0.5,-1.25,2],[1,2,3]],[[4,5,6],[7,8,9]]],dtype=np.float32)
+		colors=np.array([[[255,0,10],[1,2,3]],[[4,5,6],[7,8,9]]],dtype=np.uint8)
+		fileName=os.path.join(self.folder,'small.ptx')
+		pointCloudIO.savePTX(fileName,points,colors)
+		expected=('2\n2\n0.00000 0.00000 0.00000\n1.00000 0.00000 0.00000\n0.00000 1.00000 0.00000\n0.00000 0.00000 1.00000\n'
+			'1.00000 0.00000 0.00000 0.00000\n0.00000 1.00000 0.00000 0.00000\n0.00000 0.00000 1.00000 0.00000\n0.00000 0.00000 0.00000 1.00000\n'
+			'4.00000 5.00000 6.00000 1 4 5 6\n0.50000 -1.25000 2.00000 1 255 0 10\n7.00000 8.00000 9.00000 1 7 8 9\n1.00000 2.00000 3.00000 1 1 2 3\n')
+		with open(fileName) as f:
+			self.assertEqual(f.read(),expected)
+
+	def testRoundTrip(self):
+		points,colors,data=randomFrame(30,40)
+		points=np.nan_to_num(points)
+		fileName=os.path.join(self.folder,'scan.ptx')
+		pointCloudIO.savePTX(fileName,points,colors)
+		loadedPoints,loadedColors,transform=pointCloudIO.loadPTX(fileName)
+		self.assertTrue(np.allclose(loadedPoints,points,rtol=0,atol=1e-5))
+		self.assertTrue(np.array_equal(loadedColors,colors))
+		self.assertTrue(np.array_equal(transform,np.column_stack((np.eye(3),np.zeros((3,1))))))
+		# saving the loaded points gives the same bytes
+		otherFileName=os.path.join(self.folder,'resaved.ptx')
+		pointCloudIO.savePTX(otherFileName,loadedPoints,loadedColors)
+		with open(fileName,'rb') as f, open(otherFileName,'rb') as g:
+			self.assertEqual(f.read(),g.read())
+
+	def testMultiScan(self):
+		points,colors,data=randomFrame(30,40)
+		points=np.nan_to_num(points)
+		angle=0.3
+		transformMtx=np.array([[np.cos(angle),-np.sin(angle),0,0.5],[np.sin(angle),np.cos(angle),0,-1],[0,0,1,2]])
+		fileName=os.path.join(self.folder,'multiScan.ptx')
+		with pointCloudIO.PTXWriter(fileName) as writer:
+			writer.writeScan(points,colors)
+			writer.beginScan(40,30,transformMtx)
+			for start in range(0,40,16):
+				writer.writeColumns(points[:,start:start+16],colors[:,start:start+16])
+		# small blocks so that the lines are split between the reads
+		scans=list(pointCloudIO.iterPTXScans(fileName,blockSize=1000))
+		self.assertEqual(len(scans),2)
+		for scanPoints,scanColors,scanTransform in scans:
+			self.assertTrue(np.allclose(scanPoints,points,rtol=0,atol=1e-4))
+			self.assertTrue(np.array_equal(scanColors,colors))
+		self.assertTrue(np.allclose(scans[1][2],transformMtx,rtol=0,atol=1e-5))
+
+	def testIncompleteScan(self):
+		points,colors,data=randomFrame(3,4)
+		writer=pointCloudIO.PTXWriter(os.path.join(self.folder,'incomplete.ptx'))
+		writer.beginScan(4,3)
+		writer.writeColumns(np.nan_to_num(points[:,:2]),colors[:,:2])
+		with self.assertRaises(ValueError):
+			writer.close()
+
+	def testNoColors(self):
+		points,colors,data=randomFrame(30,40)
+		points=np.nan_to_num(points)
+		fileName=os.path.join(self.folder,'noColor.ptx')
+		with open(fileName,'w') as f:
+			f.write(pointCloudIO.formatPTXHeader(40,30,np.column_stack((np.eye(3),np.zeros((3,1))))))
+			p=np.transpose(np.flipud(points),[1,0,2]).reshape(-1,3)
+			pointCloudIO.writeFormattedRows(f,'%.5f %.5f %.5f 0.5',[p[:,k] for k in range(3)])
+		loadedPoints,loadedColors,transform=pointCloudIO.loadPTX(fileName)
+		self.assertIsNone(loadedColors)
+		self.assertTrue(np.allclose(loadedPoints,points,rtol=0,atol=1e-5))
+
+
+class LZFTest(unittest.TestCase):
+
+	def samples(self):
+		rng=np.random.RandomState(0)
+		return [b'',b'a',b'abcabcabcabcabcabc'*50,rng.randint(0,256,5000).astype(np.uint8).tobytes(),
+			np.repeat(rng.randint(0,4,300),40).astype(np.uint8).tobytes()]
+
+	def testPython(self):
+		for data in self.samples():
+			compressed=pointCloudIO.lzfCompressPython(data)
+			self.assertEqual(pointCloudIO.lzfDecompressPython(compressed,len(data)),data)
+
+	@unittest.skipIf(pointCloudIO.lzf is None,'python-lzf is not installed')
+	def testLiblzf(self):
+		for data in self.samples():
+			compressed=pointCloudIO.lzfCompress(data)
+			self.assertIsNotNone(compressed)
+			self.assertEqual(pointCloudIO.lzfDecompress(compressed,len(data)),data)
+			# both codecs read the streams written by the other one
+			if len(data)>0:
+				self.assertEqual(pointCloudIO.lzfDecompressPython(compressed,len(data)),data)
+				self.assertEqual(pointCloudIO.lzfDecompress(pointCloudIO.lzfCompressPython(data),len(data)),data)
+
+
+if __name__ == "__main__":
+	unittest.main()